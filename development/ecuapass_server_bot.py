@@ -1,10 +1,33 @@
 #!/usr/bin/env python3
 
 import os, sys, json, time
+import ctypes, ctypes.util, select, struct, hashlib
 from traceback import format_exc as traceback_format_exc
 
 # For server
 from threading import Thread as threading_Thread
+from threading import Lock as threading_Lock
+from threading import Condition as threading_Condition
+from threading import Event as threading_Event
+from threading import local as threading_local
+from threading import Timer as threading_Timer
+from queue import Queue as queue_Queue
+from queue import PriorityQueue as queue_PriorityQueue
+from fnmatch import fnmatch
+from difflib import SequenceMatcher as difflib_SequenceMatcher
+from datetime import datetime
+from collections import deque as collections_deque
+from collections import namedtuple as collections_namedtuple
+from concurrent.futures import ProcessPoolExecutor as concurrent_ProcessPoolExecutor
+from multiprocessing import freeze_support as multiprocessing_freeze_support
+from tempfile import mkstemp as tempfile_mkstemp
+from subprocess import Popen as subprocess_Popen
+from subprocess import PIPE as subprocess_PIPE
+from subprocess import run as subprocess_run
+from subprocess import TimeoutExpired as subprocess_TimeoutExpired
+from sqlite3 import connect as sqlite3_connect
+from sqlite3 import Row as sqlite3_Row
+from sqlite3 import Error as sqlite3_Error
 
 from flask import Flask as flask_Flask 
 from flask import request as flask_request 
@@ -15,20 +38,88 @@ from werkzeug.serving import make_server
 from pickle import load as pickle_load
 from pickle import dump as pickle_dump
 import azure.core.credentials 
+from azure.core.exceptions import HttpResponseError
+from azure.core.polling.base_polling import LROBasePolling
 from azure.ai.formrecognizer import DocumentAnalysisClient
 
 import re
 
-# For bot
-import pyautogui as py
-from pyperclip import copy as pyperclip_copy
-from pyperclip import paste as pyperclip_paste
-
-
 USAGE = "ecuapass_server.py"
 APP_HOME_DIR = os.environ ["PYECUAPASS"]
 APP_KEYS_FILE = os.path.join (APP_HOME_DIR, "keys", "azure-keys-cognitive-resource.json")
-PAUSE = 0
+APP_CONFIG_FILE = os.path.join (APP_HOME_DIR, "ecuapass-server-config.json")
+APP_DATA_DIR = os.path.join (APP_HOME_DIR, "data")
+
+# Azure resource limits (overridden from APP_CONFIG_FILE)
+AZURE_MAX_TPS		 = 1	 # Max 'begin_analyze_document' requests per second
+AZURE_MAX_CONCURRENT = 4	 # Max analysis operations running at the same time
+AZURE_MONTHLY_PAGES  = 0	 # Max pages analyzed per month (0: no budget)
+AZURE_MAX_RETRIES	 = 3	 # Retries when Azure answers 429 (too many requests)
+AZURE_POLL_INITIAL	 = 0.25  # First interval (secs) between polls of an analysis
+AZURE_POLL_MAX		 = 2.0	 # Max interval (secs) between polls
+AZURE_POLL_BACKOFF	 = 1.5	 # Interval growth factor for long analysis
+AZURE_DOC_DEADLINE	 = 120	 # Max secs for one analysis before canceling it
+AZURE_DOC_RETRIES	 = 1	 # Times a canceled analysis is started again (by the same worker)
+
+# Document reduction before upload (overridden from APP_CONFIG_FILE)
+DOC_PREPROCESS		 = False # Reduce documents before uploading them to Azure
+DOC_PREP_WORKERS	 = 2	 # Processes reducing documents
+DOC_PREP_MAX_SIDE	 = 2200  # Max image side in pixels (~200 dpi for a letter page)
+DOC_PREP_QUALITY	 = 85	 # JPEG quality of reduced images
+DOC_PREP_PDF_PAGES	 = 1	 # PDF pages to analyze (cartaportes have one page)
+
+# Local checks of documents before Azure analysis (overridden from APP_CONFIG_FILE)
+PREFLIGHT_MAX_BYTES	 = 500*1024*1024 # Max file size accepted by Azure (S0 tier)
+PREFLIGHT_MAX_PAGES	 = 20	 # Max PDF pages of a document
+PREFLIGHT_MIN_SIDE	 = 50	 # Min image side in pixels accepted by Azure
+PREFLIGHT_MAX_SIDE	 = 10000 # Max image side in pixels accepted by Azure
+PREFLIGHT_PORTRAIT	 = True  # Reject landscape images (cartaportes are portrait)
+DOC_WORKERS			 = 8	 # Threads uploading documents to Azure concurrently
+DOC_QUEUE_SIZE		 = 32	 # Max documents waiting in each stage queue
+PIPELINE_BOT_QUEUE	 = 4	 # Max RESULTS files analyzed ahead of the bot
+BOT_PRIORITY		 = 1	 # Default priority of queued fills (lower is filled first)
+BOT_FILL_TIME		 = 90	 # Secs of one fill, used for ETAs until fills are timed
+BOT_SESSION			 = True	 # Queued fills share a session (window detected and checked once)
+BOT_METRICS_FILES	 = 1000	 # Bot metrics files (one per fill) kept in the data dir
+BOT_DISPLAYS		 = []	 # X displays with a bot session each (e.g. [":1", ":2"]). []: the desktop
+BOT_SESSION_TIMEOUT	 = 600	 # Max secs of one fill in a display session (its process is killed after it)
+BOT_REQUIRED_FIELDS	 = ["01_Distrito", "02_NumeroCPIC", "05_TipoProcedimiento", "10_PaisRemitente",
+                        "14_NombreRemitente", "16_PaisDestinatario", "19_NombreDestinatario",
+                        "38_CondicionesTransporte", "41_PesoBruto", "42_TotalBultos",
+                        "61_FechaEmision", "62_PaisEmision", "79_DescripcionCarga"]   # Fields the bot can't leave empty
+
+# HTTP server of the GUI requests (overridden from APP_CONFIG_FILE)
+SERVER_HOST    = "127.0.0.1"  # Bind address ("serverHost")
+SERVER_PORT    = 5000         # Port ("serverPort")
+SERVER_MODE    = "waitress"   # "waitress" (keep-alive, falls back to "threaded" if not installed),
+                              # "threaded" (werkzeug, a thread per request, no keep-alive) or "single"
+SERVER_THREADS = 16           # Worker threads of the waitress server ("serverThreads")
+
+# Bot input engine (overridden from APP_CONFIG_FILE)
+BOT_DRIVER   = "pyautogui"   # Input/screen driver of the bot: "pyautogui" or "fake" (headless)
+INPUT_PAUSE  = 0   # Secs pyautogui waits after each call (its default is 0.1)
+INPUT_DELAYS = {"key": 0.01, "text": 0.03, "box": 0.08, "date": 0.02, "scroll": 0.02}  # Secs between keys by field type
+BOT_WAIT_TIMEOUT   = 5.0   # Max secs waiting for the screen to change or settle
+BOT_WAIT_INTERVAL  = 0.05  # Secs between polls of the screen or clipboard
+BOT_WAIT_CLIPBOARD = 0.5   # Max secs waiting for copied text in the clipboard
+BOT_VERIFY         = "clipboard"  # Combo selections checked by "clipboard" (ctrl+c) or "screen" (region hash)
+VERIFY_HASH_SCALE  = 0.5   # Scale of the field region in its difference hash (a bit per scaled pixel)
+VERIFY_DISTANCE    = 12    # Min bits changed in the hash to take the field as changed (not a caret blink)
+VERIFY_TIMEOUT     = 0.2   # Max secs waiting for the field to change on screen (an option not found waits it)
+VERIFY_FIELD_WIDTH = 300   # Min width (pixels) of a field region, for options longer than the text
+VERIFY_FIELD_HEIGHT= 30    # Max height (pixels) of a field region (the open combo list below is left out)
+BOT_DATE_ENTRY = "type"  # Dates are typed ("type") or selected in the calendar ("calendar")
+BOT_CLEAR_TABS = 2       # Tabs from the clear button (clicked) to the first field ("botClearTabs")
+BOT_TITLE_TABS = 2       # Tabs from the page title (clicked to resume a form) to the first field ("botTitleTabs")
+ECUAPASS_VERSION = "1"   # Version of the ECUAPASS forms ("ecuapassVersion"), keys the combos cache
+LOCATOR_MARGIN   = 40    # Pixels around the last found box searched before the full screen
+LOCATOR_SCALE    = 1.0   # Scale of the first (coarse) search, e.g. 0.5. 1.0: no pyramid
+WATCH_DEBOUNCE		 = 2.0	 # Secs a new file must stay unchanged before processing it
+WATCH_POLL_INTERVAL	 = 1.0	 # Secs between directory scans (when inotify isn't available)
+
+# Workers of each stage of the documents pipeline (overridden by "stageWorkers" in APP_CONFIG_FILE)
+STAGE_WORKERS = {"discover": 1, "preflight": 4, "cache": 2, "upload": DOC_WORKERS,
+                 "newlines": 2, "extract": 1, "write": 2}
 
 
 """
@@ -41,7 +132,30 @@ line%2Ccsharp#environment-variables-and-application-configuration
 """
 def main ():
 	EcuServer.run_server()
-	
+
+#-----------------------------------------------------------
+# Server settings read from APP_CONFIG_FILE (JSON dict).
+# Keys not in the file take the default module values.
+#-----------------------------------------------------------
+class EcuConfig:
+	settings = None
+
+	def get (key, default=None):
+		if EcuConfig.settings is None:
+			EcuConfig.settings = {}
+			if os.path.isfile (APP_CONFIG_FILE):
+				try:
+					with open (APP_CONFIG_FILE) as fp:
+						EcuConfig.settings = json.load (fp)
+				except:
+					print (f"ERROR: Leyendo configuración '{APP_CONFIG_FILE}'. Usando valores por defecto.")
+		return EcuConfig.settings.get (key, default)
+
+	#-- Get path to a file in data dir (created if it doesn't exist)
+	def getDataPath (filename):
+		os.makedirs (APP_DATA_DIR, exist_ok=True)
+		return os.path.join (APP_DATA_DIR, filename)
+
 #-----------------------------------------------------------
 # Ecuapass server: listen GUI messages and run processes
 #-----------------------------------------------------------
@@ -51,11 +165,37 @@ class EcuServer:
 	server = None
 	runningDir = os.getcwd()
 
+	#-- Requests are served concurrently ("threaded" or "waitress" modes) so
+	#-- status requests are answered while long processing requests run
 	def run_server ():
+		host = EcuConfig.get ("serverHost", SERVER_HOST)
+		port = int (EcuConfig.get ("serverPort", SERVER_PORT))
+		mode = EcuConfig.get ("serverMode", SERVER_MODE)
 		EcuServer.printx ("Running server...")
 		EcuServer.printx ("Running dir : ", os.getcwd(), flush=True)
-		server = make_server('127.0.0.1', 5000, app)
-		server.serve_forever()
+		if mode == "waitress":
+			try:
+				from waitress import create_server as waitress_create_server
+			except ImportError:
+				EcuServer.printx ("ALERTA: 'waitress' no instalado (python-libraries-requeriments.txt). "
+				                  "Usando servidor 'threaded' sin keep-alive.")
+				mode = "threaded"
+
+		if mode == "waitress":
+			threads = EcuConfig.get ("serverThreads", SERVER_THREADS)
+			EcuServer.server = waitress_create_server (app, host=host, port=port, threads=threads)
+			EcuServer.printx (f"Listening   :  {host}:{port} (waitress, {threads} hilos, HTTP/1.1 keep-alive)", flush=True)
+			try:
+				EcuServer.server.run ()
+			except OSError:
+				if not EcuServer.shouldStop:    # Closed by 'stop'
+					raise
+			return
+
+		# Werkzeug closes the connection after each response (no keep-alive)
+		EcuServer.server = make_server (host, port, app, threaded=(mode != "single"))
+		EcuServer.printx (f"Listening   :  {host}:{port} (werkzeug, {'un hilo por petición' if mode != 'single' else 'una petición a la vez'})", flush=True)
+		EcuServer.server.serve_forever ()
 
 	@app.route('/start_processing', methods=['POST'])
 	def start_processing ():
@@ -70,13 +210,60 @@ class EcuServer:
 		EcuServer.printx ("Servicio    : ", service, flush=True)
 		EcuServer.printx ("Datos       : ", data, flush=True)
 
+		# Invalid options are a bad request (checked before starting the pipeline)
+		if service in ["doc_processing", "pipeline_processing"] and type (data) is dict:
+			error = EcuServer.checkOptions (data)
+			if error:
+				EcuServer.printx (error)
+				return {'result': error}, 400
+		if service == "bot_processing":
+			error = EcuServer.checkBotRequest (data)
+			if error:
+				EcuServer.printx (error)
+				return {'result': error}, 400
+
 		# Call your existing script's function to process the file
 		result = None
 		if (service == "doc_processing"):
-			result = EcuServer.processDocuments (workingDir=data)
+			if type (data) is dict:
+				result = EcuServer.runFolder (service, EcuServer.processDocuments, data.get ("workingDir"), data)
+			else:
+				result = EcuServer.runFolder (service, EcuServer.processDocuments, data)
 		elif (service == "bot_processing"):
-			result = mainBot (jsonFilepath=data)
+			if type (data) is dict:
+				result = EcuBotQueue.run (data ["file"], resume=data.get ("resume", False), force=data.get ("force", False))
+			else:
+				result = EcuBotQueue.run (jsonFilepath=data)
 			#result = "Servicio bot ejecutado"
+		elif (service == "bot_enqueue"):
+			result = EcuBotQueue.enqueueRequest (data)
+		elif (service == "bot_ledger"):
+			result = EcuLedger.getFills (data or {})
+		elif (service == "bot_metrics"):
+			result = EcuBotMetrics.getSummary (data or {})
+		elif (service == "bot_validate"):
+			result = EcuBotQueue.validateRequest (data)
+		elif (service == "bot_status"):
+			result = EcuBotQueue.getStatus ()
+		elif (service == "bot_plan"):
+			result = EcuPlan.getInfo (data or {})
+		elif (service == "locator_benchmark"):
+			result = EcuLocator.benchmark (data ["screenshots"], data ["images"], data.get ("repeats", 10))
+		elif (service == "doc_metrics"):
+			result = EcuAzure.getMetricsSummary ()
+		elif (service == "doc_stages"):
+			result = EcuDocStages.getMetrics ()
+		elif (service == "pipeline_processing"):
+			if type (data) is dict:
+				result = EcuServer.runFolder (service, EcuPipeline.run, data.get ("workingDir"), data)
+			else:
+				result = EcuServer.runFolder (service, EcuPipeline.run, data)
+		elif (service == "watch_start"):
+			result = EcuWatcher.start (dirs=data)
+		elif (service == "watch_stop"):
+			result = EcuWatcher.stop (dirs=data)
+		elif (service == "watch_status"):
+			result = EcuWatcher.getStatus ()
 		elif (service == "stop"):
 			EcuServer.stop_server ()
 		else:
@@ -85,148 +272,852 @@ class EcuServer:
 		EcuServer.printx (result)
 		return {'result': result}
 
+	#-- Run the service on a folder. A request for a folder (with the same options)
+	#-- already in process joins it and gets its result; other folders run concurrently.
+	def runFolder (service, function, workingDir, options={}):
+		workingDir = os.path.abspath (workingDir) if type (workingDir) is str else workingDir
+		filters = {k: v for k, v in options.items () if k != "workingDir"}
+		key = f"{service}:{workingDir}:{json.dumps (filters, sort_keys=True, default=str)}"
+		return EcuSingleFlight.run (key, function, workingDir, options)
+
+	#-- With concurrent requests sys.exit would only end the request thread:
+	#-- the server is closed from another thread after the reply is sent
 	def stop_server ():
 		EcuServer.printx ("Cerrando servidor Ecuapass ...")
-		EcuServer.should_stop = True
-		sys.exit (0)
+		EcuServer.shouldStop = True
+		server = EcuServer.server
+		if server is None:
+			sys.exit (0)
+		close = server.close if hasattr (server, "close") else server.shutdown   # waitress or werkzeug
+		threading_Thread (target=lambda: (time.sleep (0.5), close ()), daemon=True).start ()
 
 	def printx (*args, flush=True):
 		print ("SERVER:", *args, flush=flush)
 
-	#-- Concurrently process all documents in workingDir
-	def processDocuments (workingDir):
-		if workingDir is None: 
-			return jsonify({'error': f"Directorio de trabajo: '{workingDir}' inválido."}), 400
-
-		# Create and start threads for processing files
-		inputFiles = [x for x in os.listdir (workingDir, ) if EcuServer.isValidDocument (x)]
-		threads = []
-		os.chdir (workingDir)
-		for filename in inputFiles:
-			thread = threading_Thread (target=mainDoc, args=(filename,))
-			threads.append (thread)
-			thread.start()
-
-		# Wait for all threads to finish
-		for k, thread in enumerate (threads):
-			thread.join()
-			docFilepath = os.path.join (workingDir, inputFiles [k])
-			EcuServer.printx (f"Procesamiento exitoso del documento: '{docFilepath}'")
+	#-- Concurrently process all documents in workingDir through the stages pipeline.
+	#-- Options (dict): recursive, fromTime, toTime (mtime window), pattern (glob)
+	def processDocuments (workingDir, options={}):
+		if workingDir is None or not os.path.isdir (workingDir):
+			return f"Directorio de trabajo: '{workingDir}' inválido."
+		error = EcuServer.checkOptions (options)
+		if error:
+			return error
+
+		results     = {"rejected": {}, "deferred": [], "error": {}}
+		resultsLock = threading_Lock ()
+		finished    = threading_Event ()
+
+		# Called by the last stage with each finished document and then with END
+		def onDone (item):
+			if item is EcuStage.END:
+				finished.set ()
+				return
+			EcuServer.printx (f"Resultado del documento '{item ['path']}': {item ['message']}")
+			with resultsLock:
+				if item ["status"] == "rejected":
+					results ["rejected"][item ["path"]] = item ["message"]
+				elif item ["status"] == "deferred":
+					results ["deferred"].append (item ["path"])
+				elif item ["status"] == "error":
+					results ["error"][item ["path"]] = item ["message"]
+
+		stages = EcuDocStages.start (onDone)
+		stages [0].put ({"workingDir": os.path.abspath (workingDir), "options": options})
+		stages [0].put (EcuStage.END)
+		finished.wait ()
 
 		message = "Procesamiento exitoso de todos los documentos."
+		if results ["rejected"]:
+			message += f" Rechazados: {results ['rejected']}"
+		if results ["deferred"]:
+			message += f" Diferidos por cuota mensual de Azure agotada: {results ['deferred']}"
+		if results ["error"]:
+			message += f" Con errores: {results ['error']}"
 		return message
-		
+
+	#-- Yield paths of documents in workingDir without listing it first.
+	#-- Filters by extension, modification time window and glob pattern.
+	def walkDocuments (workingDir, options={}):
+		recursive = options.get ("recursive", EcuConfig.get ("docRecursive", False))
+		pattern   = options.get ("pattern")
+		fromTime  = EcuServer.getTimestamp (options.get ("fromTime"))
+		toTime    = EcuServer.getTimestamp (options.get ("toTime"))
+
+		dirsStack = [workingDir]
+		while dirsStack:
+			dirPath = dirsStack.pop ()
+			try:
+				with os.scandir (dirPath) as entries:
+					for entry in entries:
+						if entry.is_dir (follow_symlinks=False):
+							if recursive:
+								dirsStack.append (entry.path)
+							continue
+						if not entry.is_file () or not EcuServer.isValidDocument (entry.name):
+							continue
+						if pattern and not fnmatch (entry.name, pattern):
+							continue
+						if fromTime or toTime:
+							mtime = entry.stat ().st_mtime
+							if (fromTime and mtime < fromTime) or (toTime and mtime > toTime):
+								continue
+						yield entry.path
+			except OSError as ex:
+				EcuServer.printx (f"ERROR: No se pudo leer el directorio '{dirPath}': {ex}")
+
+	#-- Error message if the documents options are invalid (None if they are valid)
+	def checkOptions (options):
+		for key in ["fromTime", "toTime"]:
+			try:
+				EcuServer.getTimestamp (options.get (key))
+			except (ValueError, TypeError):
+				return f"Opción '{key}' inválida: '{options [key]}'. Use segundos o fecha ISO ('2023-09-01')."
+		return None
+
+	#-- Error message if the bot request isn't a RESULTS file or a dict with it in "file" (None if it is valid)
+	def checkBotRequest (data):
+		jsonFilepath = data.get ("file") if type (data) is dict else data
+		if type (jsonFilepath) is not str or not jsonFilepath:
+			return f"Petición de bot inválida: '{data}'. Use el archivo RESULTS o un diccionario con 'file'."
+		return None
+
+	#-- Time as epoch seconds from a number or an ISO date string ("2023-09-01")
+	def getTimestamp (value):
+		if value is None or type (value) in [int, float]:
+			return value
+		return datetime.fromisoformat (value).timestamp ()
+
 	#-- Check if document filename is an image (.png) or a PDF file (.pdf)
 	def isValidDocument (filename):
-		extension = filename.split (".")[1]
-		if extension.lower() in ["png", "pdf"]:
+		extension = os.path.splitext (filename)[1]
+		if extension.lower() in [".png", ".pdf"]:
 			return True
 		return False
 
-#----------------------------------------------------------
-# Run Azure analysis for custom "cartaporte" document
-#----------------------------------------------------------
-def mainDoc (inputFilepath):
-	try:
-		filename	  = os.path.basename (inputFilepath)
+#-----------------------------------------------------------
+# Watch directories and process new scanned documents as they
+# arrive (inotify on Linux, directory polling otherwise).
+# A file is processed when it stays unchanged WATCH_DEBOUNCE secs.
+#-----------------------------------------------------------
+class EcuWatcher:
+	IN_CLOSE_WRITE = 0x08
+	IN_MOVED_TO    = 0x80
+
+	MAX_RESULTS = 100    # Last results, rejected and deferred documents kept
+
+	lock      = threading_Lock ()
+	watches   = {}       # Watched dir : stop event
+	stages    = None     # Stages pipeline shared by all watches
+	nDocs     = 0        # Documents queued by all watches
+	results   = collections_deque (maxlen=MAX_RESULTS)
+	rejected  = {}       # Path : reason (the last MAX_RESULTS)
+	deferred  = collections_deque (maxlen=MAX_RESULTS)
+
+	#-- Invalid dirs are skipped (reported in the result), the others are watched
+	def start (dirs):
+		dirs    = [dirs] if type (dirs) is str else (dirs or [])
+		invalid = []
+		for dirPath in dirs:
+			dirPath = os.path.abspath (dirPath) if type (dirPath) is str else dirPath
+			if type (dirPath) is not str or not os.path.isdir (dirPath):
+				EcuServer.printx (f"ERROR: Directorio a vigilar: '{dirPath}' inválido.")
+				invalid.append (dirPath)
+				continue
+			with EcuWatcher.lock:
+				if dirPath in EcuWatcher.watches:
+					continue
+				EcuWatcher.startStages ()
+				stopEvent = threading_Event ()
+				EcuWatcher.watches [dirPath] = stopEvent
+			threading_Thread (target=EcuWatcher.watchDir, args=(dirPath, stopEvent), daemon=True).start ()
+
+		message = f"Vigilando directorios: {list (EcuWatcher.watches)}"
+		if invalid:
+			message += f". Directorios inválidos: {invalid}"
+		return message
 
-		print (">>> Input File	  : ", inputFilepath)
-		print (">>> Current Dir   : ", os.getcwd())
+	#-- Stop watching the given dirs (all if None)
+	def stop (dirs=None):
+		dirs = [dirs] if type (dirs) is str else dirs
+		with EcuWatcher.lock:
+			for dirPath in list (EcuWatcher.watches):
+				if dirs is None or dirPath in [os.path.abspath (x) for x in dirs]:
+					EcuWatcher.watches.pop (dirPath).set ()
+		return f"Vigilando directorios: {list (EcuWatcher.watches)}"
+
+	def getStatus ():
+		with EcuWatcher.lock:
+			return {"dirs": list (EcuWatcher.watches), "results": list (EcuWatcher.results),
+			        "rejected": dict (EcuWatcher.rejected), "deferred": list (EcuWatcher.deferred)}
+
+	#-- Stages pipeline (without end) for documents found by all watches
+	def startStages ():
+		if EcuWatcher.stages is not None:
+			return
 
-		# Document analysis using Azure cloud
-		docJsonFile  = EcuDoc.processDocument (inputFilepath)
-		mainFields	 = EcuInfo.getMainFields (docJsonFile)
+		def onDone (item):
+			with EcuWatcher.lock:
+				EcuWatcher.results.append (item ["message"])
+				if item ["status"] == "rejected":
+					EcuWatcher.rejected.pop (item ["path"], None)
+					EcuWatcher.rejected [item ["path"]] = item ["message"]
+					if len (EcuWatcher.rejected) > EcuWatcher.MAX_RESULTS:
+						del EcuWatcher.rejected [next (iter (EcuWatcher.rejected))]    # The oldest
+				elif item ["status"] == "deferred":
+					EcuWatcher.deferred.append (item ["path"])
+			EcuServer.printx (f"Resultado del documento '{item ['path']}': {item ['message']}")
+
+		EcuWatcher.stages = EcuDocStages.start (onDone, daemon=True)
+
+	#-- Errors are logged and the watch goes on (by polling) until it is stopped
+	def watchDir (dirPath, stopEvent):
+		EcuServer.printx (f"Vigilando directorio '{dirPath}'...")
+		# Files already in the dir are not processed
+		known   = EcuWatcher.scanDir (dirPath)
+		pending = {}
+		try:
+			if sys.platform.startswith ("linux"):
+				EcuWatcher.watchInotify (dirPath, stopEvent, known, pending)
+				return
+		except OSError as ex:
+			EcuServer.printx (f"ERROR: inotify no disponible ({ex}). Vigilando por sondeo...")
+		except Exception as ex:
+			EcuServer.printx (f"EXCEPCION vigilando '{dirPath}' con inotify: {ex}. Vigilando por sondeo...")
+			print (traceback_format_exc())
+		EcuWatcher.watchPolling (dirPath, stopEvent, known, pending)
 
-		EcuDoc.saveFields (mainFields, filename, "RESULTS")
-	except Exception as ex:
-		print ("ERROR procesando documentos:", ex) 
-		return (f"ERROR procesando documento '{inputFilepath}'")
+	def watchInotify (dirPath, stopEvent, known, pending):
+		libc = ctypes.CDLL (ctypes.util.find_library ("c"), use_errno=True)
+		fd   = libc.inotify_init1 (os.O_NONBLOCK)
+		if fd < 0:
+			raise OSError (ctypes.get_errno (), "inotify_init1")
+		try:
+			mask = EcuWatcher.IN_CLOSE_WRITE | EcuWatcher.IN_MOVED_TO
+			if libc.inotify_add_watch (fd, os.fsencode (dirPath), mask) < 0:
+				raise OSError (ctypes.get_errno (), "inotify_add_watch")
+
+			while not stopEvent.is_set ():
+				ready, _, _ = select.select ([fd], [], [], 0.5)
+				if ready:
+					for name in EcuWatcher.readInotifyEvents (fd):
+						filepath = os.path.join (dirPath, name)
+						if EcuServer.isValidDocument (name) and os.path.isfile (filepath):
+							pending [filepath] = None
+				EcuWatcher.checkPending (pending, known)
+		finally:
+			os.close (fd)
+
+	#-- Names of files in the events read from inotify (struct inotify_event)
+	def readInotifyEvents (fd):
+		names = []
+		data, offset = os.read (fd, 65536), 0
+		while offset < len (data):
+			wd, mask, cookie, length = struct.unpack_from ("iIII", data, offset)
+			name = os.fsdecode (data [offset+16 : offset+16+length].rstrip (b"\0"))
+			offset += 16 + length
+			if name:
+				names.append (name)
+		return names
+
+	#-- A failed scan (e.g. dir removed or unmounted) is logged and retried in the next one
+	def watchPolling (dirPath, stopEvent, known, pending):
+		interval = EcuConfig.get ("watchPollInterval", WATCH_POLL_INTERVAL)
+		while not stopEvent.wait (interval):
+			try:
+				for filepath, state in EcuWatcher.scanDir (dirPath).items ():
+					if known.get (filepath) != state and filepath not in pending:
+						pending [filepath] = None
+				EcuWatcher.checkPending (pending, known)
+			except Exception as ex:
+				EcuServer.printx (f"EXCEPCION vigilando '{dirPath}': {ex}")
+				print (traceback_format_exc())
+
+	#-- Documents in dir with their state (size, mtime). Unreadable dir: no documents
+	def scanDir (dirPath):
+		files = {}
+		try:
+			with os.scandir (dirPath) as entries:
+				for entry in entries:
+					try:
+						if entry.is_file () and EcuServer.isValidDocument (entry.name):
+							info = entry.stat ()
+							files [entry.path] = (info.st_size, info.st_mtime)
+					except OSError:    # Removed while scanning
+						continue
+		except OSError as ex:
+			EcuServer.printx (f"ERROR: No se pudo leer el directorio '{dirPath}': {ex}")
+		return files
+
+	#-- Queue pending files that didn't change during the debounce time
+	def checkPending (pending, known):
+		debounce = EcuConfig.get ("watchDebounce", WATCH_DEBOUNCE)
+		now      = time.monotonic ()
+		for filepath, lastCheck in list (pending.items ()):
+			try:
+				info  = os.stat (filepath)
+				state = (info.st_size, info.st_mtime)
+			except OSError:
+				pending.pop (filepath)
+				continue
+
+			if lastCheck is None or lastCheck [0] != state:
+				pending [filepath] = (state, now)
+			elif now - lastCheck [1] >= debounce and state [0] > 0:
+				pending.pop (filepath)
+				known [filepath] = state
+				EcuServer.printx (f"Nuevo documento: '{filepath}'")
+				# Found by the watch: a job of one document (its pages are reserved by 'discover')
+				with EcuWatcher.lock:
+					seq = EcuWatcher.nDocs
+					EcuWatcher.nDocs += 1
+				dirPath = os.path.dirname (filepath)
+				EcuWatcher.stages [0].put ({"workingDir": dirPath, "options": {}, "paths": [filepath], "seq": seq})
 
-	return (f"{inputFilepath} successfuly processed")
+#-----------------------------------------------------------
+# Pipeline from documents to ECUAPASS: documents go through the
+# analysis stages ahead of the bot, which fills the RESULTS files
+# in the order scheduled by the discover stage. A bounded queue before
+# the bot stops the analysis stages when the bot is behind.
+#-----------------------------------------------------------
+class EcuPipeline:
+	#-- Options (dict) are the same of 'processDocuments'
+	def run (workingDir, options={}):
+		if workingDir is None or not os.path.isdir (workingDir):
+			return f"Directorio de trabajo: '{workingDir}' inválido."
+		error = EcuServer.checkOptions (options)
+		if error:
+			return error
+
+		resultsQueue = queue_Queue (maxsize=EcuConfig.get ("pipelineBotQueue", PIPELINE_BOT_QUEUE))
+		rejectedFiles, deferredFiles, errorFiles = {}, [], {}
+		stats = {"nDocs": None, "nDone": 0, "botBusy": 0, "botWait": 0, "botResults": []}
+		statsLock = threading_Lock ()
+
+		# Analysis stages: finished documents go to the bot queue
+		def onDone (item):
+			if item is EcuStage.END:
+				resultsQueue.put (("END", stats ["nDone"], None))
+				return
+			if "seq" not in item:    # Failed listing the working dir: not a document
+				errorFiles [item ["path"]] = item ["message"]
+				return
+			with statsLock:
+				stats ["nDone"] += 1
+				if item ["status"] == "rejected":
+					rejectedFiles [item ["path"]] = item ["message"]
+				elif item ["status"] == "deferred":
+					deferredFiles.append (item ["path"])
+			resultsFile = EcuDoc.getResultsFilename (item ["path"]) if item ["status"] == "ok" else None
+			resultsQueue.put ((item ["seq"], item ["path"], resultsFile))
+
+		# Last stage: bot fills finished RESULTS in sequence order.
+		# A failed fill is the result of its document and the bot goes on
+		def botWorker ():
+			finished, nextSeq = {}, 0
+			while stats ["nDocs"] is None or nextSeq < stats ["nDocs"]:
+				if nextSeq in finished:
+					filepath, resultsFile = finished.pop (nextSeq)
+					nextSeq += 1
+					if resultsFile is None:
+						stats ["botResults"].append (f"ERROR: Documento '{filepath}' no analizado")
+						continue
+					startTime = time.monotonic ()
+					try:
+						result = EcuBotQueue.run (resultsFile)
+					except Exception as ex:
+						EcuServer.printx (f"EXCEPCION: Problemas al llenar documento '{resultsFile}': {ex}")
+						print (traceback_format_exc())
+						result = f"ERROR: Documento '{filepath}' no ingresado: {ex}"
+					stats ["botResults"].append (result)
+					stats ["botBusy"] += time.monotonic () - startTime
+					continue
+
+				startTime = time.monotonic ()
+				seq, filepath, resultsFile = resultsQueue.get ()
+				stats ["botWait"] += time.monotonic () - startTime
+				if seq == "END":
+					stats ["nDocs"] = filepath
+				else:
+					finished [seq] = (filepath, resultsFile)
+
+		# The bot queue is taken until END (also if the bot fails), so the stages
+		# blocked sending documents to it finish
+		def botThreadRun ():
+			try:
+				botWorker ()
+			finally:
+				while stats ["nDocs"] is None:
+					seq, filepath, resultsFile = resultsQueue.get ()
+					if seq == "END":
+						stats ["nDocs"] = filepath
+
+		startTime = time.monotonic ()
+		botThread = threading_Thread (target=botThreadRun)
+		botThread.start ()
+		stages = EcuDocStages.start (onDone)
+		stages [0].put ({"workingDir": os.path.abspath (workingDir), "options": options})
+		stages [0].put (EcuStage.END)
+		botThread.join ()
+		wallTime = time.monotonic () - startTime
+
+		# Per-stage utilization: busy time over available time
+		stagesMetrics = [stage.getMetrics () for stage in stages]
+		botUse = stats ["botBusy"] / wallTime if wallTime else 0
+		stagesUse = {x ["stage"]: x ["use"] for x in stagesMetrics}
+		stagesUse ["bot"] = round (botUse, 3)
+		return {"documents"   : stats ["nDocs"],
+		        "wallTime"    : round (wallTime, 3),
+		        "stages"      : stagesMetrics,
+		        "botUse"      : round (botUse, 3),
+		        "botWait"     : round (stats ["botWait"], 3),
+		        "bottleneck"  : max (stagesUse, key=stagesUse.get),
+		        "botResults"  : stats ["botResults"],
+		        "rejected"    : rejectedFiles,
+		        "deferred"    : deferredFiles,
+		        "error"       : errorFiles}
 
 #-----------------------------------------------------------
-# Run cloud analysis
+# Stage of the documents pipeline: a bounded input queue served
+# by its own workers, which send processed items to the next
+# stage (or to a function after the last one). A full queue
+# blocks the stage before it. Keeps queue depth and service
+# time to find the slow stage and tune its workers.
 #-----------------------------------------------------------
-class EcuDoc:
-	def processDocument (inputFilepath):
-		print ("\n>>>", EcuAzure.getCloudName(), "document processing...")
-		docJsonFile = None
+class EcuStage:
+	END = None       # Item ending the workers of all stages
+
+	def __init__ (self, name, function, nWorkers, queueSize, priority=None):
+		self.name      = name
+		self.function  = function    # Returns an item, a list/generator of items or None
+		self.nWorkers  = nWorkers
+		self.priority  = priority    # Function with the item priority (lower first)
+		self.queue     = queue_PriorityQueue (queueSize) if priority else queue_Queue (queueSize)
+		self.nextStage = None        # EcuStage or function
+		self.lock      = threading_Lock ()
+		self.nRunning  = 0
+		self.nPut      = 0
+		self.nItems    = 0
+		self.busyTime  = 0
+		self.maxDepth  = 0
+		self.startTime = None
+
+	def start (self, daemon=False):
+		self.startTime = time.monotonic ()
+		self.nRunning  = self.nWorkers
+		for i in range (self.nWorkers):
+			threading_Thread (target=self.worker, daemon=daemon).start ()
+
+	def put (self, item):
+		if self.priority:
+			with self.lock:
+				self.nPut += 1
+				nPut = self.nPut
+			itemPriority = float ("inf") if item is EcuStage.END else self.priority (item)
+			self.queue.put ((itemPriority, nPut, item))
+		else:
+			self.queue.put (item)
+		self.maxDepth = max (self.maxDepth, self.queue.qsize ())
+
+	def get (self):
+		item = self.queue.get ()
+		return item [2] if self.priority else item
+
+	def send (self, item):
+		if isinstance (self.nextStage, EcuStage):
+			self.nextStage.put (item)
+		else:
+			self.nextStage (item)
+
+	#-- The END item is put back for the other workers and the
+	#-- last worker sends it to the next stage (also if the worker fails,
+	#-- so the stages after it and the caller waiting for END don't block)
+	def worker (self):
+		try:
+			while True:
+				item = self.get ()
+				if item is EcuStage.END:
+					return
+				try:
+					self.serve (item)
+				except Exception as ex:
+					print (f"EXCEPCION en etapa '{self.name}' enviando resultados: {ex}")
+					print (traceback_format_exc())
+		finally:
+			with self.lock:
+				self.nRunning -= 1
+				isLast = self.nRunning == 0
+			if isLast:
+				self.send (EcuStage.END)
+			else:
+				self.put (EcuStage.END)
+
+	#-- Process the item and send its results.
+	#-- Time sending items (blocked by next stage) is not service time
+	def serve (self, item):
+		busyTime  = 0
+		startTime = time.monotonic ()
+		for outItem in self.process (item):
+			busyTime += time.monotonic () - startTime
+			self.send (outItem)
+			startTime = time.monotonic ()
+		busyTime += time.monotonic () - startTime
+		with self.lock:
+			self.nItems   += 1
+			self.busyTime += busyTime
+
+	#-- Finished items (done) pass through. Errors (also while iterating the
+	#-- items of a generator) finish the item: the items already sent go on.
+	def process (self, item):
+		if item.get ("done"):
+			yield item
+			return
 		try:
-			filename = os.path.basename (inputFilepath)
-			docJsonFile = EcuDoc.loadPreviousDocument (filename)
-			if (docJsonFile is None):
-				docJsonFile = EcuAzure.analyzeDocument (inputFilepath)
+			outItems = self.function (item)
+			if outItems is None:
+				return
+			for outItem in ([outItems] if type (outItems) is dict else outItems):
+				yield outItem
 		except Exception as ex:
-			print (f"ERROR procesando documento '{inputFilepath}'") 
-			raise
-		return docJsonFile
+			print (f"EXCEPCION en etapa '{self.name}':")
+			print (traceback_format_exc())
+			item.setdefault ("path", item.get ("workingDir"))    # A job item (discover stage)
+			yield EcuDocStages.setDone (item, "error", f"ERROR en etapa '{self.name}': {ex}")
+
+	def getMetrics (self):
+		elapsed = time.monotonic () - self.startTime if self.startTime else 0
+		return {"stage"       : self.name,
+		        "workers"     : self.nWorkers,
+		        "queueDepth"  : self.queue.qsize (),
+		        "maxDepth"    : self.maxDepth,
+		        "items"       : self.nItems,
+		        "serviceTime" : round (self.busyTime / self.nItems, 3) if self.nItems else 0,
+		        "use"         : round (self.busyTime / (self.nWorkers * elapsed), 3) if elapsed else 0}
 
-	#-- Load previous result.
-	def loadPreviousDocument (filename):
-		try:
-			docJsonFile = None
-			#filename = os.path.basename (filename)
-			pickleFilename = f"{filename.split ('.')[0]}-{EcuAzure.getCloudName()}-CACHE.pkl"
-			print ("\t>>> Looking for previous file: ", pickleFilename)
-			if os.path.isfile (pickleFilename): 
-				print ("\t>>> Loading previous result from pickle file:", pickleFilename )
-				with open (pickleFilename, 'rb') as inFile:
-					result = pickle_load (inFile)
-				docJsonFile = EcuAzure.saveResults (result, filename)
-		except:
-			print (f"ERROR cargando documento: '{filename}'")
-			raise
+#-----------------------------------------------------------
+# Stages of document processing: discover, preflight, cache
+# lookup, upload/poll, newline reconstruction, field extraction
+# and write. Items are dicts with the document path and its
+# sequence number, updated by each stage. Rejected, deferred or
+# failed documents are marked as done and pass to the end.
+#-----------------------------------------------------------
+class EcuDocStages:
+	current = collections_deque (maxlen=8)    # Stages of the last pipelines (for metrics)
+
+	#-- Create and start the stages. Finished items and END go to 'onDone'
+	def start (onDone, daemon=False):
+		nWorkers  = dict (STAGE_WORKERS, upload=EcuConfig.get ("docWorkers", DOC_WORKERS))
+		nWorkers.update (EcuConfig.get ("stageWorkers", {}))
+		queueSize = EcuConfig.get ("docQueueSize", DOC_QUEUE_SIZE)
+
+		def newStage (name, function, priority=None):
+			return EcuStage (name, function, nWorkers [name], queueSize, priority)
+
+		# Documents with less pages (cached ones have 0) are uploaded first
+		stages = [newStage ("discover",  EcuDocStages.discover),
+		          newStage ("preflight", EcuDocStages.preflight),
+		          newStage ("cache",     EcuDocStages.lookupCache),
+		          newStage ("upload",    EcuDocStages.upload, priority=lambda item: item.get ("nPages", 0)),
+		          newStage ("newlines",  EcuDocStages.addNewlines),
+		          newStage ("extract",   EcuDocStages.extractFields),
+		          newStage ("write",     EcuDocStages.writeFields)]
+
+		# Same document requested while in progress waits for the leader's result.
+		# Pages reserved and not used (rejected, cached, failed documents) are released.
+		def finish (item):
+			if item is not EcuStage.END:
+				EcuQuota.release (item.pop ("reserved", 0))
+			if item is not EcuStage.END and item.pop ("isLeader", False):
+				error = None if item ["status"] == "ok" else Exception (item ["message"])
+				EcuSingleFlight.end (item ["flightKey"], item ["message"], error)
+			onDone (item)
+
+		for stage, nextStage in zip (stages, stages [1:] + [finish]):
+			stage.nextStage = nextStage
+		for stage in stages:
+			stage.start (daemon)
+		EcuDocStages.current.append (stages)
+		return stages
+
+	def getMetrics ():
+		return [[stage.getMetrics () for stage in stages] for stages in EcuDocStages.current]
+
+	def setDone (item, status, message):
+		item ["done"], item ["status"], item ["message"] = True, status, message
+		return item
+
+	#-- Items of the job documents (found in its working dir or its "paths") ordered by the
+	#-- scheduler with their pages reserved, once for the whole job. Those over the Azure
+	#-- budget are deferred (done).
+	def discover (job):
+		docsPaths = job.get ("paths") or EcuServer.walkDocuments (job ["workingDir"], job ["options"])
+		scheduled, deferred = EcuScheduler.orderDocuments (docsPaths)
+		seq = job.get ("seq", 0)
+		for filepath, nPages in scheduled:
+			yield {"path": filepath, "seq": seq, "reserved": nPages}
+			seq += 1
+		for filepath in deferred:
+			yield EcuDocStages.setDone ({"path": filepath, "seq": seq}, "deferred", "Cuota mensual de páginas de Azure agotada")
+			seq += 1
+
+	#-- Reject invalid documents
+	def preflight (item):
+		reason = EcuPreflight.checkDocument (item ["path"])
+		if reason is not None:
+			EcuServer.printx (f"Documento '{item ['path']}' rechazado: {reason}")
+			return EcuDocStages.setDone (item, "rejected", reason)
+		return item
+
+	#-- Documents not in the cache start their reduction while they wait to be uploaded
+	def lookupCache (item):
+		filepath = item ["path"]
+		item ["docKey"]    = EcuSingleFlight.getDocumentKey (filepath)
+		item ["flightKey"] = f"{item ['docKey']}:{filepath}"
+		isLeader, call = EcuSingleFlight.begin (item ["flightKey"])
+		if not isLeader:
+			print ("\t>>> Documento ya en proceso. Esperando su resultado...")
+			call ["event"].wait ()
+			status = "ok" if call ["error"] is None else "error"
+			return EcuDocStages.setDone (item, status, call ["result"] or str (call ["error"]))
+
+		item ["isLeader"] = True
+		cacheFilename = EcuDoc.getCacheFilename (filepath)
+		if os.path.isfile (cacheFilename):
+			print ("\t>>> Loading previous result from pickle file:", cacheFilename)
+			with open (cacheFilename, "rb") as fp:
+				item ["result"] = pickle_load (fp)
+		else:
+			item ["nPages"] = EcuScheduler.countPages (filepath)
+			EcuPrep.submitDocuments ([filepath])
+		return item
+
+	#-- Documents with same content share one Azure call (the reduction
+	#-- of the documents that weren't uploaded is dropped). The analysis takes
+	#-- the pages reserved for the document. Over the budget it is deferred.
+	def upload (item):
+		if "result" not in item:
+			def analyze ():
+				nReserved, item ["reserved"] = item.get ("reserved", 0), 0
+				return EcuAzure.analyzeResult (item ["path"], nReserved)
+			try:
+				item ["result"] = EcuSingleFlight.run (item ["docKey"], analyze)
+			except EcuQuotaError as ex:
+				return EcuDocStages.setDone (item, "deferred", str (ex))
+			finally:
+				EcuPrep.discardDocument (item ["path"])
+		return item
+
+	def addNewlines (item):
+		item ["docJsonFile"] = EcuAzure.saveResults (item.pop ("result"), item ["path"])
+		return item
+
+	def extractFields (item):
+		item ["fields"] = EcuInfo.getMainFields (item ["docJsonFile"])
+		return item
+
+	def writeFields (item):
+		EcuDoc.saveFields (item.pop ("fields"), item ["path"], "RESULTS")
+		return EcuDocStages.setDone (item, "ok", f"{item ['path']} successfuly processed")
+
+#-----------------------------------------------------------
+# Output files of a document (cloud cache, RESULTS), next to it
+#-----------------------------------------------------------
+class EcuDoc:
+	#-- Name of the pickle file with the previous cloud result
+	def getCacheFilename (filename):
+		return f"{EcuDoc.getRootName (filename)}-{EcuAzure.getCloudName()}-CACHE.pkl"
+
+	def getResultsFilename (filepath):
+		return f"{EcuDoc.getRootName (filepath)}-RESULTS.json"
 
-		return (docJsonFile)
+	#-- Path without extension used to name output files (same dir as document)
+	def getRootName (filepath):
+		return os.path.splitext (filepath)[0]
 
-	#-- Save fields dict in JSON 
+	#-- Save fields dict in JSON
 	def saveFields (fieldsDict, filename, suffixName):
-		prefixName	= filename.split(".")[0]
+		prefixName	= EcuDoc.getRootName (filename)
 		outFilename = f"{prefixName}-{suffixName}.json"
 		print ("\t>>> Saving fields into", outFilename)
 		with open (outFilename, "w") as fp:
 			json.dump (fieldsDict, fp, indent=4, default=str)
 
+#-----------------------------------------------------------
+# Coalesce concurrent calls with the same key: the first caller
+# runs the function and the others wait and get its result (or
+# its exception). Used to analyze a document only once when it
+# is requested again while still in progress.
+#-----------------------------------------------------------
+class EcuSingleFlight:
+	lock     = threading_Lock ()
+	inFlight = {}     # Key : call info (done event, result, error)
+
+	def run (key, function, *args):
+		isLeader, call = EcuSingleFlight.begin (key)
+		if not isLeader:
+			print ("\t>>> Documento ya en proceso. Esperando su resultado...")
+			call ["event"].wait ()
+			if call ["error"] is not None:
+				raise call ["error"]
+			return call ["result"]
+
+		try:
+			result = function (*args)
+		except Exception as ex:
+			EcuSingleFlight.end (key, None, ex)
+			raise
+		EcuSingleFlight.end (key, result)
+		return result
+
+	#-- Return if the caller leads the call with key and the call info.
+	#-- The leader must call 'end' with the result when it is done.
+	def begin (key):
+		with EcuSingleFlight.lock:
+			call     = EcuSingleFlight.inFlight.get (key)
+			isLeader = call is None
+			if isLeader:
+				call = {"event": threading_Event (), "result": None, "error": None}
+				EcuSingleFlight.inFlight [key] = call
+		return isLeader, call
+
+	def end (key, result, error=None):
+		with EcuSingleFlight.lock:
+			call = EcuSingleFlight.inFlight.pop (key)
+		call ["result"], call ["error"] = result, error
+		call ["event"].set ()
+
+	#-- Key of a document: SHA-256 of its content
+	def getDocumentKey (filepath):
+		sha = hashlib.sha256 ()
+		with open (filepath, "rb") as fp:
+			for block in iter (lambda: fp.read (1024*1024), b""):
+				sha.update (block)
+		return sha.hexdigest ()
+
 #-----------------------------------------------------------
 # Custom document built with the Azure Form Recognizer client library. 
 #-----------------------------------------------------------
 class EcuAzure:
 	AzureKeyCredential = azure.core.credentials.AzureKeyCredential
 
-	#-- Online processing request return the first document 
-	def analyzeDocument (docFilepath):
-		docJsonFile = None
+	#-- Azure analysis result of the document (within limits and quota).
+	#-- Pages already reserved for it ('nReserved') are committed or released here.
+	def analyzeResult (docFilepath, nReserved=0):
+		uploadFilepath = None
 		try:
+			# The reservation is adjusted to the pages uploaded (a reduced PDF may have less)
+			uploadFilepath, prepInfo = EcuPrep.getUploadFile (docFilepath)
+			nPages = EcuScheduler.countPages (uploadFilepath)
+			if nPages > nReserved and not EcuQuota.reserve (nPages - nReserved):
+				raise EcuQuotaError (f"Cuota mensual de páginas de Azure agotada. Documento '{docFilepath}' diferido.")
+			EcuQuota.release (max (nReserved - nPages, 0))
+			nReserved = nPages
 
 			print ("\t>>>", "Analyzing document...")
 			credentialsDict  = EcuAzure.initCredentials ()
 			lgEndpoint		 = credentialsDict ["endpoint"]
-			lgKey			 = credentialsDict ["key"]	
+			lgKey			 = credentialsDict ["key"]
 			lgLocale		 = credentialsDict ["locale"]
 			lgModel			 = credentialsDict ["modelId"]
 
 			lgCredential = EcuAzure.AzureKeyCredential (lgKey)
-			docClient	 = DocumentAnalysisClient (endpoint = lgEndpoint, 
+			docClient	 = DocumentAnalysisClient (endpoint = lgEndpoint,
 												   credential = lgCredential)
-			# Read the file into memory
-			with open(docFilepath, "rb") as fp:
-				poller = docClient.begin_analyze_document (lgModel, document=fp, locale=lgLocale)
-
-			print ("\t>>>", "Polling result....")
-			result	  = poller.result()
-			document  = result.documents [0]
-			docDict   = document.to_dict ()
-
-			# Save original result as pickled and json files
-			print ("\t>>>", "Saving result....")
-			docFilename = os.path.basename (docFilepath)
-			docJsonFile = EcuAzure.saveResults (result, docFilename)
+			result = EcuAzure.analyzeWithLimits (docClient, lgModel, lgLocale, docFilepath,
+												 lgEndpoint, nPages, uploadFilepath, prepInfo)
+			EcuQuota.commit (nReserved, len (result.pages))
+			nReserved = 0
+		except EcuQuotaError:
+			raise
 		except Exception as ex:
 			print ("EXCEPCION analizando documento." )
 			print (traceback_format_exc())
-			sys.exit (1)
-			
-		return (docJsonFile)
+			raise
+		finally:
+			EcuQuota.release (nReserved)
+			if uploadFilepath:
+				EcuPrep.removeUploadFile (uploadFilepath, docFilepath)
+
+		return (result)
+
+	#-- Run 'begin_analyze_document' inside the shared rate limiter.
+	#-- A 429 answer blocks all workers for the 'Retry-After' time and retries.
+	#-- An analysis over the deadline is canceled and started again in place (the
+	#-- worker keeps the document: it isn't put back at the end of the upload queue).
+	def analyzeWithLimits (docClient, lgModel, lgLocale, docFilepath, lgEndpoint, nPages,
+	                       uploadFilepath=None, prepInfo={}):
+		uploadFilepath = uploadFilepath or docFilepath
+		deadline   = EcuConfig.get ("azureDocDeadline", AZURE_DOC_DEADLINE)
+		nRetries   = EcuConfig.get ("azureDocRetries", EcuConfig.get ("azureDocRequeues", AZURE_DOC_RETRIES))
+		maxRetries = EcuConfig.get ("azureMaxRetries", AZURE_MAX_RETRIES)
+		nTries, nDeadlines = 0, 0
+		while True:
+			polling = EcuPolling (docFilepath, lgEndpoint)
+			polling.info.update (prepInfo)
+			EcuLimiter.acquire ()
+			polling.times ["limiter"] = polling.getElapsed ()
+			try:
+				# Read the file into memory
+				with open(uploadFilepath, "rb") as fp:
+					poller = docClient.begin_analyze_document (lgModel, document=fp, locale=lgLocale,
+															   polling=polling)
+				polling.startPolling ()
+
+				print ("\t>>>", "Polling result....")
+				poller.wait (timeout=max (deadline - polling.getElapsed (), 0))
+				if poller.done ():
+					result = poller.result ()
+					EcuAzure.addMetrics (polling.getMetrics ())
+					return result
+
+				polling.cancel ()
+				EcuAzure.addMetrics (polling.getMetrics ())
+				# Pages of the canceled analysis are charged and reserved again for its retry
+				nDeadlines += 1
+				if nDeadlines > nRetries:
+					EcuQuota.commit (0, nPages)
+					raise TimeoutError (f"Análisis de '{docFilepath}' supera {deadline} segundos")
+				if not EcuQuota.reserve (nPages):
+					EcuQuota.commit (0, nPages)
+					raise EcuQuotaError (f"Cuota mensual de páginas de Azure agotada. Reintento de '{docFilepath}' diferido.")
+				EcuQuota.commit (nPages, nPages)
+				print (f"\t>>> Análisis supera {deadline} segundos. Cancelado y reiniciado...")
+			except HttpResponseError as ex:
+				nTries += 1
+				if ex.status_code != 429 or nTries > maxRetries:
+					raise
+				retryAfter = EcuLimiter.getRetryAfter (ex)
+				print (f"\t>>> Azure ocupado (429). Reintentando en {retryAfter} segundos...")
+				EcuLimiter.penalize (retryAfter)
+			finally:
+				EcuLimiter.release ()
+
+	#-- Keep timing metrics of the last analysis
+	metrics = collections_deque (maxlen=200)
+
+	def addMetrics (metricsDict):
+		EcuAzure.metrics.append (metricsDict)
+		print ("\t>>> Tiempos Azure:", metricsDict)
+
+	#-- Averages of upload, Azure queue, running, poll idle and total times
+	def getMetricsSummary ():
+		metricsList = list (EcuAzure.metrics)
+		if not metricsList:
+			return "Sin métricas de Azure."
+		keys = ["limiter", "upload", "queue", "running", "idle", "total", "polls"]
+		summary = {"documents": len (metricsList),
+		           "canceled": sum (1 for x in metricsList if x ["canceled"])}
+		for key in keys:
+			summary [key] = round (sum (x [key] for x in metricsList) / len (metricsList), 3)
+
+		# Reduced documents: bytes saved and change of mean end-to-end latency
+		prepList = [x for x in metricsList if x.get ("prep")]
+		rawList  = [x for x in metricsList if not x.get ("prep")]
+		summary ["savedBytes"] = sum (x.get ("savedBytes", 0) for x in prepList)
+		if prepList and rawList:
+			prepLatency = sum (x ["total"] + x ["prepWait"] for x in prepList) / len (prepList)
+			rawLatency  = sum (x ["total"] for x in rawList) / len (rawList)
+			summary ["latencyChange"] = round (prepLatency - rawLatency, 3)
+		return summary
 
 	#-----------------------------------------------------------
 	# Read Azure account variables from environment Azure variable
@@ -247,13 +1138,13 @@ class EcuAzure:
 		except Exception as ex:
 			print ("EXCEPCION: Problemas inicializando credenciales.")
 			print (traceback_format_exc())
-			sys.exit (1)
+			raise
 
 		return (credentialsDict)
 
 	#-- Save request result as pickle and json files
 	def saveResults (result, docFilepath):
-		rootName = docFilepath.split ('.')[0]
+		rootName = EcuDoc.getRootName (docFilepath)
 
 		print (f"\t>>> Guardando resultados de Azure en %s-XXX.yyy" % rootName)
 
@@ -336,18 +1227,473 @@ class EcuAzure:
 
 		return (resultsDict ["documents"][0])
 
+#-----------------------------------------------------------
+# Reduce documents before uploading them: images are converted
+# to grayscale, downscaled and recompressed as JPEG; PDFs keep
+# only the pages to analyze. Runs in a process pool while the
+# documents wait for their turn to be uploaded.
+#-----------------------------------------------------------
+class EcuPrep:
+	lock     = threading_Lock ()
+	executor = None
+	futures  = {}      # Document path : future with reduction info
+
+	def isEnabled ():
+		return EcuConfig.get ("docPreprocess", DOC_PREPROCESS)
+
+	#-- Start reduction of documents in the process pool (doesn't wait)
+	def submitDocuments (inputFiles):
+		if not EcuPrep.isEnabled ():
+			return
+		settings = {"maxSide"  : EcuConfig.get ("docPrepMaxSide", DOC_PREP_MAX_SIDE),
+		            "quality"  : EcuConfig.get ("docPrepQuality", DOC_PREP_QUALITY),
+		            "pdfPages" : EcuConfig.get ("docPrepPdfPages", DOC_PREP_PDF_PAGES)}
+		with EcuPrep.lock:
+			if EcuPrep.executor is None:
+				nWorkers = EcuConfig.get ("docPrepWorkers", DOC_PREP_WORKERS)
+				EcuPrep.executor = concurrent_ProcessPoolExecutor (max_workers=nWorkers)
+			for filepath in inputFiles:
+				key = os.path.abspath (filepath)
+				if key not in EcuPrep.futures:
+					EcuPrep.futures [key] = EcuPrep.executor.submit (EcuPrep.prepareDocument, key, settings)
+
+	#-- Return file to upload (reduced or original) and reduction info
+	def getUploadFile (docFilepath):
+		with EcuPrep.lock:
+			future = EcuPrep.futures.pop (os.path.abspath (docFilepath), None)
+		if future is None:
+			return docFilepath, {"prep": False}
+
+		startTime = time.monotonic ()
+		try:
+			info = future.result ()
+		except Exception as ex:
+			print (f"ERROR: Reduciendo documento '{docFilepath}': {ex}. Se envía el original.")
+			return docFilepath, {"prep": False}
+		prepWait = time.monotonic () - startTime
+
+		if info ["prepFilepath"] is None:
+			return docFilepath, {"prep": False}
+		if info ["prepBytes"] >= info ["bytes"]:
+			os.remove (info ["prepFilepath"])
+			return docFilepath, {"prep": False}
+
+		print (f"\t>>> Documento reducido de {info ['bytes']} a {info ['prepBytes']} bytes")
+		prepInfo = {"prep": True, "bytes": info ["bytes"], "prepBytes": info ["prepBytes"],
+		            "savedBytes": info ["bytes"] - info ["prepBytes"],
+		            "prepTime": round (info ["time"], 3), "prepWait": round (prepWait, 3)}
+		return info ["prepFilepath"], prepInfo
+
+	#-- Drop the reduction of a document that won't be uploaded: the future
+	#-- is canceled or its temporal file removed when it finishes
+	def discardDocument (docFilepath):
+		with EcuPrep.lock:
+			future = EcuPrep.futures.pop (os.path.abspath (docFilepath), None)
+		if future is not None and not future.cancel ():
+			future.add_done_callback (EcuPrep.removePrepFile)
+
+	def removePrepFile (future):
+		try:
+			prepFilepath = future.result () ["prepFilepath"]
+		except Exception:
+			return
+		if prepFilepath is not None and os.path.isfile (prepFilepath):
+			os.remove (prepFilepath)
+
+	def removeUploadFile (uploadFilepath, docFilepath):
+		if uploadFilepath != docFilepath and os.path.isfile (uploadFilepath):
+			os.remove (uploadFilepath)
+
+	#-- Run in a pool process: reduce the document into a temporal file
+	def prepareDocument (docFilepath, settings):
+		startTime = time.monotonic ()
+		info = {"bytes": os.path.getsize (docFilepath), "prepFilepath": None, "prepBytes": None}
+		if docFilepath.lower().endswith (".pdf"):
+			prepFilepath = EcuPrep.preparePdf (docFilepath, settings ["pdfPages"])
+		else:
+			prepFilepath = EcuPrep.prepareImage (docFilepath, settings ["maxSide"], settings ["quality"])
+
+		if prepFilepath is not None:
+			info ["prepFilepath"] = prepFilepath
+			info ["prepBytes"]    = os.path.getsize (prepFilepath)
+		info ["time"] = time.monotonic () - startTime
+		return info
+
+	def prepareImage (docFilepath, maxSide, quality):
+		from PIL import Image, ImageOps
+
+		with Image.open (docFilepath) as img:
+			img   = ImageOps.exif_transpose (img).convert ("L")
+			scale = maxSide / max (img.size)
+			if scale < 1:
+				newSize = (round (img.width * scale), round (img.height * scale))
+				img     = img.resize (newSize, Image.LANCZOS)
+			fd, prepFilepath = tempfile_mkstemp (prefix="ecuapass-", suffix=".jpg")
+			os.close (fd)
+			img.save (prepFilepath, "JPEG", quality=quality, optimize=True)
+		return prepFilepath
+
+	#-- Keep only the first pages. None if the PDF has no more pages.
+	def preparePdf (docFilepath, nPages):
+		from PyPDF2 import PdfReader, PdfWriter
+
+		reader = PdfReader (docFilepath)
+		if len (reader.pages) <= nPages:
+			return None
+		writer = PdfWriter ()
+		for page in reader.pages [:nPages]:
+			writer.add_page (page)
+		fd, prepFilepath = tempfile_mkstemp (prefix="ecuapass-", suffix=".pdf")
+		with os.fdopen (fd, "wb") as fp:
+			writer.write (fp)
+		return prepFilepath
+
+#-----------------------------------------------------------
+# Polling of Azure analysis with short first intervals that grow
+# for long jobs (SDK default waits a fixed interval).
+# Records times: upload, waiting in Azure queue ("notStarted"),
+# running, and idle between polls.
+#-----------------------------------------------------------
+class EcuPolling (LROBasePolling):
+	def __init__ (self, docFilepath, lgEndpoint):
+		self.interval  = EcuConfig.get ("azurePollInitial", AZURE_POLL_INITIAL)
+		self.maxInterval = EcuConfig.get ("azurePollMax", AZURE_POLL_MAX)
+		self.backoff   = EcuConfig.get ("azurePollBackoff", AZURE_POLL_BACKOFF)
+		super().__init__ (timeout=self.interval, lro_options={"final-state-via": "location"},
+		                  path_format_arguments={"endpoint": lgEndpoint})
+		self.docFilepath = docFilepath
+		self.canceled    = False
+		self.nPolls      = 0
+		self.startTime   = time.monotonic ()
+		self.pollTime    = None    # Time when upload finished
+		self.runTime     = None    # Time when Azure started running the analysis
+		self.endTime     = None
+		self.times       = {"limiter":0, "idle":0}
+		self.info        = {}      # Extra info added to metrics (e.g. preprocessing)
+
+	#-- Called when 'begin_analyze_document' returns (upload done)
+	def startPolling (self):
+		if self.pollTime is None:
+			self.pollTime = time.monotonic ()
+
+	def cancel (self):
+		self.canceled = True
+
+	def getElapsed (self):
+		return time.monotonic () - self.startTime
+
+	def _delay (self):
+		if self.canceled:
+			raise Exception (f"Análisis cancelado para '{self.docFilepath}'")
+		delay = self.interval
+		self.interval = min (self.interval * self.backoff, self.maxInterval)
+		self._sleep (delay)
+		self.times ["idle"] += delay
+
+	def update_status (self):
+		self.startPolling ()
+		super().update_status ()
+		self.nPolls += 1
+		status = str (self.status ()).lower ()
+		now = time.monotonic ()
+		if self.runTime is None and status != "notstarted":
+			self.runTime = now
+		if status in ["succeeded", "failed", "canceled"]:
+			self.endTime = now
+
+	def getMetrics (self):
+		now      = time.monotonic ()
+		pollTime = self.pollTime or now
+		runTime  = self.runTime or now
+		endTime  = self.endTime or now
+		return {"document" : self.docFilepath,
+		        "limiter"  : round (self.times ["limiter"], 3),
+		        "upload"   : round (pollTime - self.startTime - self.times ["limiter"], 3),
+		        "queue"    : round (runTime - pollTime, 3),
+		        "running"  : round (endTime - runTime, 3),
+		        "idle"     : round (self.times ["idle"], 3),
+		        "total"    : round (endTime - self.startTime, 3),
+		        "polls"    : self.nPolls,
+		        "canceled" : self.canceled,
+		        **self.info}
+
+#-----------------------------------------------------------
+# Shared rate limiter for Azure calls: token bucket for the
+# requests per second plus a cap of concurrent operations.
+# Callers are served in arrival order (ticket numbers).
+#-----------------------------------------------------------
+class EcuLimiter:
+	condition    = threading_Condition ()
+	tokens       = None    # Available requests (bucket)
+	lastRefill   = None    # Time of last bucket refill
+	running      = 0       # Operations in progress
+	blockedUntil = 0       # No calls until this time (after a 429)
+	nextTicket   = 0       # Ticket for the next caller
+	servingTicket = 0      # Ticket allowed to go next
+
+	def acquire ():
+		maxTPS        = EcuLimiter.getSetting ("azureMaxTPS", AZURE_MAX_TPS)
+		maxConcurrent = EcuLimiter.getSetting ("azureMaxConcurrent", AZURE_MAX_CONCURRENT)
+		with EcuLimiter.condition:
+			ticket = EcuLimiter.nextTicket
+			EcuLimiter.nextTicket += 1
+			while True:
+				now = time.monotonic ()
+				EcuLimiter.refill (now, maxTPS)
+				waitTime = None
+				if ticket == EcuLimiter.servingTicket and EcuLimiter.running < maxConcurrent:
+					if now < EcuLimiter.blockedUntil:
+						waitTime = EcuLimiter.blockedUntil - now
+					elif EcuLimiter.tokens < 1:
+						waitTime = (1 - EcuLimiter.tokens) / maxTPS
+					else:
+						EcuLimiter.tokens        -= 1
+						EcuLimiter.running       += 1
+						EcuLimiter.servingTicket += 1
+						EcuLimiter.condition.notify_all ()
+						return
+				EcuLimiter.condition.wait (waitTime)
+
+	def release ():
+		with EcuLimiter.condition:
+			EcuLimiter.running -= 1
+			EcuLimiter.condition.notify_all ()
+
+	#-- Limit from the config. Not a positive number (0 would block all calls): the default
+	def getSetting (key, default):
+		value = EcuConfig.get (key, default)
+		if type (value) not in [int, float] or value <= 0:
+			print (f"ERROR: Valor de '{key}' inválido: '{value}'. Usando {default}.")
+			return default
+		return value
+
+	#-- Refill bucket according to the elapsed time (burst of one second)
+	def refill (now, maxTPS):
+		capacity = max (maxTPS, 1)
+		if EcuLimiter.lastRefill is None:
+			EcuLimiter.tokens, EcuLimiter.lastRefill = capacity, now
+		elapsed = now - EcuLimiter.lastRefill
+		EcuLimiter.tokens     = min (capacity, EcuLimiter.tokens + elapsed * maxTPS)
+		EcuLimiter.lastRefill = now
+
+	#-- Block all callers for 'seconds' and empty the bucket
+	def penalize (seconds):
+		with EcuLimiter.condition:
+			EcuLimiter.blockedUntil = max (EcuLimiter.blockedUntil, time.monotonic () + seconds)
+			EcuLimiter.tokens = 0
+			EcuLimiter.condition.notify_all ()
+
+	#-- Seconds to wait from the 'Retry-After' header of a 429 answer
+	def getRetryAfter (ex, default=5):
+		try:
+			return float (ex.response.headers.get ("Retry-After", default))
+		except:
+			return default
+
+#-----------------------------------------------------------
+# Monthly budget of Azure pages. Pages are reserved before
+# the call and committed with the real count from the result.
+#-----------------------------------------------------------
+class EcuQuota:
+	lock     = threading_Lock ()
+	month    = None    # "YYYY-MM" of the loaded counters
+	used     = 0       # Pages analyzed this month
+	reserved = 0       # Pages of operations in progress
+
+	def getBudget ():
+		return EcuConfig.get ("azureMonthlyPages", AZURE_MONTHLY_PAGES)
+
+	def getFilename ():
+		return EcuConfig.getDataPath ("azure-pages-quota.json")
+
+	#-- Load counters from file, reset them when a new month starts
+	def load ():
+		month = time.strftime ("%Y-%m")
+		if EcuQuota.month == month:
+			return
+		EcuQuota.month, EcuQuota.used = month, 0
+		try:
+			if os.path.isfile (EcuQuota.getFilename ()):
+				with open (EcuQuota.getFilename ()) as fp:
+					EcuQuota.used = json.load (fp).get (month, 0)
+		except:
+			print (f"ERROR: Leyendo cuota de páginas de Azure. Iniciando en cero.")
+
+	def save ():
+		with open (EcuQuota.getFilename (), "w") as fp:
+			json.dump ({EcuQuota.month: EcuQuota.used}, fp, indent=4)
+
+	def reserve (nPages):
+		with EcuQuota.lock:
+			EcuQuota.load ()
+			budget = EcuQuota.getBudget ()
+			if budget and EcuQuota.used + EcuQuota.reserved + nPages > budget:
+				return False
+			EcuQuota.reserved += nPages
+			return True
+
+	def release (nPages):
+		with EcuQuota.lock:
+			EcuQuota.reserved -= nPages
+
+	#-- Change a reservation for the pages really consumed
+	def commit (nReserved, nUsed):
+		with EcuQuota.lock:
+			EcuQuota.load ()
+			EcuQuota.reserved -= nReserved
+			EcuQuota.used     += nUsed
+			EcuQuota.save ()
+
+#-----------------------------------------------------------
+# Document over the monthly budget of Azure pages: it is deferred
+# (not an error), to be processed when there are pages again.
+#-----------------------------------------------------------
+class EcuQuotaError (Exception):
+	pass
+
+#-----------------------------------------------------------
+# Fast local checks of documents before paying Azure analysis:
+# file size, header (magic bytes), PDF pages, image dimensions
+# and orientation. Documents are checked by the 'preflight' stage workers.
+#-----------------------------------------------------------
+class EcuPreflight:
+	PNG_MAGIC = b"\x89PNG\r\n\x1a\n"
+	PDF_MAGIC = b"%PDF-"
+
+	#-- Return the reason to reject the document or None if it is valid
+	def checkDocument (filepath):
+		try:
+			size = os.path.getsize (filepath)
+			if size == 0:
+				return "Archivo vacío"
+			if size > EcuConfig.get ("preflightMaxBytes", PREFLIGHT_MAX_BYTES):
+				return f"Archivo muy grande ({size} bytes)"
+
+			with open (filepath, "rb") as fp:
+				head = fp.read (1024)
+				fp.seek (max (size - 1024, 0))
+				tail = fp.read ()
+
+			if filepath.lower().endswith (".pdf"):
+				return EcuPreflight.checkPdf (filepath, head, tail)
+			return EcuPreflight.checkPng (head, tail)
+		except Exception as ex:
+			return f"Archivo no se puede leer ({ex})"
+
+	def checkPdf (filepath, head, tail):
+		if EcuPreflight.PDF_MAGIC not in head:
+			return "No es un archivo PDF"
+		if b"%%EOF" not in tail:
+			return "PDF incompleto o dañado (sin '%%EOF')"
+
+		# Pages of PDFs with compressed objects can't be counted here
+		nPages, hasObjStm = EcuScheduler.scanPdf (filepath)
+		if nPages == 0 and not hasObjStm:
+			return "PDF sin páginas"
+		if nPages > EcuConfig.get ("preflightMaxPages", PREFLIGHT_MAX_PAGES):
+			return f"PDF con demasiadas páginas ({nPages})"
+		return None
+
+	#-- Dimensions are read from the PNG header (IHDR chunk)
+	def checkPng (head, tail):
+		if not head.startswith (EcuPreflight.PNG_MAGIC) or head [12:16] != b"IHDR":
+			return "No es una imagen PNG"
+		if b"IEND" not in tail:
+			return "Imagen PNG incompleta o dañada (sin 'IEND')"
+
+		width, height = int.from_bytes (head [16:20], "big"), int.from_bytes (head [20:24], "big")
+		minSide = EcuConfig.get ("preflightMinSide", PREFLIGHT_MIN_SIDE)
+		maxSide = EcuConfig.get ("preflightMaxSide", PREFLIGHT_MAX_SIDE)
+		if min (width, height) < minSide or max (width, height) > maxSide:
+			return f"Dimensiones de imagen inválidas ({width}x{height})"
+		if EcuConfig.get ("preflightPortrait", PREFLIGHT_PORTRAIT) and width > height:
+			return f"Imagen en orientación horizontal ({width}x{height})"
+		return None
+
+#-----------------------------------------------------------
+# Order pending documents for processing: cached documents
+# first (no Azure cost), then by number of pages. Their pages
+# are reserved from the monthly budget in that order and the
+# documents that don't fit are deferred.
+#-----------------------------------------------------------
+class EcuScheduler:
+	PAGE_PATTERN = re.compile (rb"/Type\s{0,32}/Page\b")
+	CHUNK_SIZE   = 1024*1024   # Bytes read at a time scanning PDFs
+	OVERLAP      = 64          # Bytes kept between chunks: longer than the patterns
+	scans        = {}          # (path, size, mtime) : (pages, has compressed objects), last PDFs scanned
+
+	#-- Scheduled (filename, pages reserved) and deferred filenames. The caller
+	#-- releases the reserved pages not committed by the analysis (EcuQuota)
+	def orderDocuments (inputFiles):
+		docsInfo = []
+		for filename in inputFiles:
+			isCached = os.path.isfile (EcuDoc.getCacheFilename (filename))
+			nPages   = 0 if isCached else EcuScheduler.countPages (filename)
+			docsInfo.append ((nPages, filename))
+		docsInfo.sort (key=lambda x: x [0])
+
+		scheduled, deferred = [], []
+		for nPages, filename in docsInfo:
+			if EcuQuota.reserve (nPages):
+				scheduled.append ((filename, nPages))
+			else:
+				deferred.append (filename)
+		return scheduled, deferred
+
+	#-- Number of pages charged by Azure: one for images, pages count for PDFs
+	def countPages (filepath):
+		if not filepath.lower().endswith (".pdf"):
+			return 1
+		try:
+			return max (EcuScheduler.scanPdf (filepath) [0], 1)
+		except:
+			return 1
+
+	#-- Page objects and if it has compressed objects (/ObjStm), read in chunks (not the
+	#-- whole file in memory). Cached by file state: preflight and scheduling read it once.
+	def scanPdf (filepath):
+		info = os.stat (filepath)
+		key  = (os.path.abspath (filepath), info.st_size, info.st_mtime)
+		if key in EcuScheduler.scans:
+			return EcuScheduler.scans [key]
+
+		nPages, hasObjStm, carry = 0, False, b""
+		with open (filepath, "rb") as fp:
+			while True:
+				chunk  = fp.read (EcuScheduler.CHUNK_SIZE)
+				buffer = carry + chunk
+				# Matches starting in the overlap are counted with the next chunk
+				end = len (buffer) - EcuScheduler.OVERLAP if chunk else len (buffer)
+				nPages += sum (1 for x in EcuScheduler.PAGE_PATTERN.finditer (buffer) if x.start () < end)
+				hasObjStm = hasObjStm or b"/ObjStm" in buffer
+				if not chunk:
+					break
+				carry = buffer [max (end, 0):]
+
+		if len (EcuScheduler.scans) > 1000:
+			EcuScheduler.scans.clear ()
+		EcuScheduler.scans [key] = (nPages, hasObjStm)
+		return nPages, hasObjStm
+
 #----------------------------------------------------------
-# Class that gets main info from Ecuapass document 
+# Class that gets main info from Ecuapass document
 #----------------------------------------------------------
 class EcuInfo:
 	ecudoc = {}		  # Dic for Ecuappass document info
+	lock   = threading_Lock ()
 
 	#-- Main function for testing
 	def main ():
 		inputJsonFile = "CPI-COCO003629-DOCUMENT.json"
 		EcuInfo.getMainFields (inputJsonFile)
 
+	#-- Fields are built in the shared 'ecudoc' dict: one document at a time
 	def getMainFields (inputJsonFile):
+		with EcuInfo.lock:
+			EcuInfo.ecudoc = {}
+			return dict (EcuInfo.extractMainFields (inputJsonFile))
+
+	def extractMainFields (inputJsonFile):
 		""" Get data and value from document main fields"""
 
 		print (">>> Obteniendo principales valores del documento %s..." % inputJsonFile)
@@ -1007,217 +2353,854 @@ class EcuDB:
 	def getNumeroIdEmpresa (empresa):
 		return EcuDB.ecudb ["empresas"][empresa]["numeroId"]
 
-#----------------------------------------------------------
-# Globals
-#----------------------------------------------------------
-win    = None	 # Global Ecuapass window  object
-
 #----------------------------------------------------------
 # Main function for testing
 #----------------------------------------------------------
-def mainBot (jsonFilepath):
+def mainBot (jsonFilepath, resume=False):
 	EcuBot.printx (">> External bot scrip")
 	EcuBot.printx ("\t>>> Working dir: ", os.getcwd())
 	EcuBot.printx ("\t>>> Input file : ", jsonFilepath)
-	result = EcuBot.fillEcuapass (jsonFilepath)
+	result = EcuBot.fillEcuapass (jsonFilepath, resume)
 	EcuBot.printx ("\t>>> Output result : ", result)
 	return result
 
+#-----------------------------------------------------------
+# Queue of RESULTS files for the bot. One worker owns the screen
+# and runs the fills one at a time (GUI lock), by priority and
+# then in arrival order. Pending fills show their position and
+# ETA from the mean time of the last fills.
+#-----------------------------------------------------------
+class EcuBotQueue:
+	guiLock   = threading_Lock ()          # Held while the bot drives the screen
+	cond      = threading_Condition ()     # Guards the queue state
+	pending   = []                         # Jobs waiting, sorted by (priority, id)
+	current   = None                       # Job being filled
+	history   = collections_deque (maxlen=100)
+	fillTimes = collections_deque (maxlen=20)
+	running   = []                         # Jobs being filled
+	nJobs     = 0
+	sessions  = []                         # Sessions filling the queue, one worker each
+
+	#-- Queue one RESULTS file and wait for its fill result
+	def run (jsonFilepath, priority=BOT_PRIORITY, resume=False, force=False):
+		job = EcuBotQueue.enqueue ([jsonFilepath], priority, resume, force=force) [0]
+		job ["event"].wait ()
+		return job ["result"]
+
+	#-- Queue from a request: a file, a list of files or a dict with "files" or "workingDir"
+	#-- (+ 'processDocuments' options), "priority", "resume", "validate" and "force"
+	def enqueueRequest (data):
+		options = data if type (data) is dict else {"files": data}
+		files   = EcuBotQueue.getRequestFiles (options)
+		if type (files) is str:
+			return files
+
+		jobs = EcuBotQueue.enqueue (files, options.get ("priority", BOT_PRIORITY), options.get ("resume", False),
+		                            options.get ("validate", True), options.get ("force", False))
+		ids  = [job ["id"] for job in jobs if job ["status"] == "pending"]
+		notQueued = [EcuBotQueue.getJobInfo (job) for job in jobs if job ["status"] != "pending"]
+		return [info for info in EcuBotQueue.getStatus () ["pending"] if info ["id"] in ids] + notQueued
+
+	#-- Validation errors of the request files (as in 'enqueueRequest') without queueing them
+	def validateRequest (data):
+		options = data if type (data) is dict else {"files": data}
+		files   = EcuBotQueue.getRequestFiles (options)
+		if type (files) is str:
+			return files
+		return {x : EcuValidator.validate (x) for x in files}
+
+	#-- Files of a request: "files" or RESULTS files in "workingDir" (error message if invalid)
+	def getRequestFiles (options):
+		files = options.get ("files")
+		if files is None:
+			workingDir = options.get ("workingDir")
+			if workingDir is None or not os.path.isdir (workingDir):
+				return f"Directorio de trabajo: '{workingDir}' inválido."
+			files = EcuBotQueue.getResultsFiles (workingDir, options)
+		return [files] if type (files) is str else files
+
+	#-- RESULTS files of the documents in workingDir, oldest first (e.g. a day's documents)
+	def getResultsFiles (workingDir, options={}):
+		docsPaths = EcuServer.walkDocuments (os.path.abspath (workingDir), options)
+		files = [EcuDoc.getResultsFilename (x) for x in docsPaths]
+		files = [x for x in files if os.path.isfile (x)]
+		return sorted (files, key=os.path.getmtime)
+
+	#-- Queue the files. With 'validate' files with errors are rejected (done) with them.
+	#-- Unless 'force' is set, files already filled (ledger) are skipped and files of a
+	#-- document queued or being filled (same number or content) join its job (same result).
+	def enqueue (jsonFilepaths, priority=BOT_PRIORITY, resume=False, validate=True, force=False):
+		errors = {x : EcuValidator.validate (x) if validate else [] for x in jsonFilepaths}
+		filled = {x : None if force or errors [x] else EcuLedger.findFilled (x) for x in jsonFilepaths}
+		keys   = {x : EcuLedger.getKeys (x) for x in jsonFilepaths}
+		jobs   = []
+		with EcuBotQueue.cond:
+			for jsonFilepath in jsonFilepaths:
+				EcuBotQueue.nJobs += 1
+				job = {"id": EcuBotQueue.nJobs, "path": os.path.abspath (jsonFilepath),
+				       "priority": priority, "resume": resume, "force": force, "status": "pending", "result": None,
+				       "numero": keys [jsonFilepath][0], "hash": keys [jsonFilepath][1], "followers": [],
+				       "queued": time.time (), "started": None, "finished": None,
+				       "event": threading_Event ()}
+				jobs.append (job)
+				leader = None if force or errors [jsonFilepath] or filled [jsonFilepath] else EcuBotQueue.findActive (job)
+				if errors [jsonFilepath]:
+					EcuBot.printx (f"Documento '{jsonFilepath}' rechazado: {errors [jsonFilepath]}")
+					job ["errors"] = errors [jsonFilepath]
+					EcuBotQueue.finish (job, "rejected", "Documento rechazado: " + "; ".join (errors [jsonFilepath]))
+				elif filled [jsonFilepath]:
+					EcuBotQueue.skip (job, filled [jsonFilepath])
+				elif leader:
+					EcuBot.printx (f"Documento '{jsonFilepath}' ya en cola o ingresándose ('{leader ['path']}'). Esperando su resultado...")
+					job ["status"], job ["joined"] = "joined", leader ["id"]
+					leader ["followers"].append (job)
+				else:
+					EcuBotQueue.pending.append (job)
+			EcuBotQueue.pending.sort (key=lambda job: (job ["priority"], job ["id"]))
+			if not EcuBotQueue.sessions:
+				EcuBotQueue.startSessions ()
+			EcuBotQueue.cond.notify_all ()
+		return jobs
+
+	#-- Pending or running job of the same document (number or content) as the job (None if there is none)
+	def findActive (job):
+		for other in EcuBotQueue.running + EcuBotQueue.pending:
+			if (job ["hash"] and other ["hash"] == job ["hash"]) or (job ["numero"] and other ["numero"] == job ["numero"]):
+				return other
+		return None
+
+	#-- Finish the job and the jobs joined to it with its result
+	def finish (job, status, result):
+		jobs = [job] + job ["followers"]
+		with EcuBotQueue.cond:
+			for x in jobs:
+				x ["status"], x ["result"], x ["finished"] = status, result, time.time ()
+				EcuBotQueue.history.append (x)
+		for x in jobs:
+			x ["event"].set ()
+
+	#-- Finish the job of a document already filled (ledger entry 'fill')
+	def skip (job, fill):
+		job ["filled"] = fill
+		result = (f"Documento '{fill ['numero']}' ya ingresado el {fill ['time']} "
+		          f"('{fill ['path']}'). Use 'force' para ingresarlo otra vez.")
+		EcuBot.printx (result)
+		EcuBotQueue.finish (job, "skipped", result)
+
+	#-- One worker per session: the desktop, or one per X display in "botDisplays"
+	def startSessions ():
+		displays = EcuConfig.get ("botDisplays", BOT_DISPLAYS)
+		if displays:
+			EcuBotQueue.sessions = [EcuDisplaySession (x) for x in displays]
+		else:
+			keepOpen = EcuConfig.get ("botSession", BOT_SESSION)
+			EcuBotQueue.sessions = [EcuSession (lock=EcuBotQueue.guiLock, keepOpen=keepOpen)]
+		for session in EcuBotQueue.sessions:
+			threading_Thread (target=EcuBotQueue.work, args=(session,), daemon=True).start ()
+
+	#-- Worker of a session filling the next queued file when it is free.
+	#-- The ledger is checked again: the document may have been filled while it waited.
+	def work (session):
+		while True:
+			with EcuBotQueue.cond:
+				while not EcuBotQueue.pending:
+					EcuBotQueue.cond.wait ()
+				job = EcuBotQueue.pending.pop (0)
+				job ["status"], job ["started"], job ["session"] = "running", time.time (), session.name
+				EcuBotQueue.running.append (job)
+
+			try:
+				filled = None if job ["force"] else EcuLedger.findFilled (job ["path"])
+			except Exception as ex:
+				EcuBot.printx (f"EXCEPCION: Consultando el registro de ingresos de '{job ['path']}': {ex}")
+				with EcuBotQueue.cond:
+					EcuBotQueue.running.remove (job)
+				EcuBotQueue.finish (job, "error", f"ERROR: Consultando el registro de ingresos: {ex}")
+				continue
+			if filled:
+				with EcuBotQueue.cond:
+					EcuBotQueue.running.remove (job)
+				EcuBotQueue.skip (job, filled)
+				continue
+
+			startTime = time.monotonic ()
+			with session.lock:
+				try:
+					result = session.fill (job ["path"], job ["resume"])
+				except Exception as ex:
+					EcuBot.printx (f"EXCEPCION: Problemas al llenar documento '{job ['path']}'")
+					result = str (ex)
+
+			with EcuBotQueue.cond:
+				EcuBotQueue.fillTimes.append (time.monotonic () - startTime)
+				job ["input"] = session.input
+				EcuBotQueue.running.remove (job)
+			EcuBotQueue.finish (job, "done", result)
+
+	#-- Mean secs of the last fills
+	def getFillTime ():
+		fillTimes = EcuBotQueue.fillTimes
+		if not fillTimes:
+			return EcuConfig.get ("botFillTime", BOT_FILL_TIME)
+		return sum (fillTimes) / len (fillTimes)
+
+	#-- Fills running, pending fills with position and ETA (next free session), and last fills
+	def getStatus ():
+		with EcuBotQueue.cond:
+			now      = time.time ()
+			fillTime = EcuBotQueue.getFillTime ()
+			running  = EcuBotQueue.running
+			freeIn   = [max (fillTime - (now - x ["started"]), 0) for x in running]
+			freeIn  += [0] * (max (len (EcuBotQueue.sessions), 1) - len (running))
+
+			pending = []
+			for position, job in enumerate (EcuBotQueue.pending, 1):
+				free  = freeIn.index (min (freeIn))
+				freeIn [free] += fillTime
+				wait  = freeIn [free]
+				info  = EcuBotQueue.getJobInfo (job)
+				info.update ({"position": position, "etaSecs": round (wait),
+				              "etaTime": datetime.fromtimestamp (now + wait).strftime ("%H:%M:%S")})
+				pending.append (info)
+
+			return {"current"  : EcuBotQueue.getJobInfo (running [0]) if running else None,
+			        "running"  : [EcuBotQueue.getJobInfo (x) for x in running],
+			        "pending"  : pending,
+			        "fillTime" : round (fillTime, 3),
+			        "locator"  : EcuLocator.getStats (),
+			        "checkpoints": EcuCheckpoints.getAll (),
+			        "sessions" : [x.getInfo () for x in EcuBotQueue.sessions],
+			        "done"     : [EcuBotQueue.getJobInfo (x) for x in EcuBotQueue.history]}
+
+	def getJobInfo (job):
+		info = {k: v for k, v in job.items () if k not in ["event", "followers"]}
+		info ["followers"] = [x ["id"] for x in job.get ("followers", [])]
+		return info
+
 #--------------------------------------------------------------------
-# EcuBot for filling Ecuapass cartaporte web form (in flash)
+# Cartaporte form layout compiled to the plan of actions run by the
+# bot: fields in tab order (a city after its country), consecutive
+# Tabs merged, scrolls only when the section anchor changes, and
+# waits for the screen to settle at section changes and after the
+# fields other fields depend on.
 #--------------------------------------------------------------------
-class EcuBot:
-	#-- Main function for testing
-	def fillEcuapass (jsonFilepath):
-		py.sleep (1)
+class EcuPlan:
+	# Field, widget, tab index (from '01_Distrito'), scroll anchor (scroll steps), section, depends on
+	LAYOUT = [
+		("01_Distrito",                "boxIter",        0,  0, "Encabezado",    None),
+		("02_NumeroCPIC",              "text",           1,  0, "Encabezado",    None),
+		("03_MRN",                     "text",           2,  0, "Encabezado",    None),
+		("04_MSN",                     "text",           3,  0, "Encabezado",    None),
+		("05_TipoProcedimiento",       "box",            4,  0, "Encabezado",    None),
+		("07_DepositoMercancia",       "box",            6,  0, "Encabezado",    None),   # 06 selected by default
+		("08_DirTransportista",        "text",           7,  0, "Encabezado",    None),
+		("09_NroIdentificacion",       "text",           8,  0, "Encabezado",    None),
+		("10_PaisRemitente",           "box",            9,  5, "Remitente",     None),
+		("11_TipoIdRemitente",         "box",           10,  5, "Remitente",     None),
+		("12_NroIdRemitente",          "text",          11,  5, "Remitente",     None),
+		("13_NroCertSanitario",        "text",          12,  5, "Remitente",     None),
+		("14_NombreRemitente",         "box",           13,  5, "Remitente",     None),
+		("15_DireccionRemitente",      "text",          14,  5, "Remitente",     None),
+		("16_PaisDestinatario",        "textSel",       15,  5, "Destinatario",  None),
+		("17_TipoIdDestinatario",      "textSel",       16,  5, "Destinatario",  None),
+		("18_NroIdDestinatario",       "text",          17,  5, "Destinatario",  None),   # 18: boton buscar
+		("19_NombreDestinatario",      "textSel",       19,  5, "Destinatario",  None),
+		("20_DireccionDestinatario",   "text",          20,  5, "Destinatario",  None),
+		("21_PaisConsignatario",       "box",           21,  5, "Consignatario", None),
+		("22_TipoIdConsignatario",     "box",           22,  5, "Consignatario", None),
+		("23_NroIdConsignatario",      "text",          23,  5, "Consignatario", None),   # 24: boton buscar
+		("24_NombreConsignatario",     "text",          25,  5, "Consignatario", None),
+		("25_DireccionConsignatario",  "text",          26,  5, "Consignatario", None),
+		("26_NombreNotificado",        "text",          27, 15, "Notificado",    None),
+		("27_DireccionNotificado",     "text",          28, 15, "Notificado",    None),
+		("28_PaisNotificado",          "box",           29, 15, "Notificado",    None),
+		("29_PaisRecepcion",           "box",           30, 25, "Lugares",       None),
+		("30_CiudadRecepcion",         "box",           31, 25, "Lugares",       "29_PaisRecepcion"),
+		("31_FechaRecepcion",          "date",          32, 25, "Lugares",       None),
+		("32_PaisEmbarque",            "box",           33, 25, "Lugares",       None),
+		("33_CiudadEmbarque",          "box",           34, 25, "Lugares",       "32_PaisEmbarque"),
+		("34_FechaEmbarque",           "date",          35, 25, "Lugares",       None),
+		("35_PaisEntrega",             "box",           36, 25, "Lugares",       None),
+		("36_CiudadEntrega",           "box",           37, 25, "Lugares",       "35_PaisEntrega"),
+		("37_FechaEntrega",            "date",          38, 25, "Lugares",       None),
+		("38_CondicionesTransporte",   "condTransporte",39, 35, "Condiciones",   None),
+		("39_CondicionesPago",         "condPago",      40, 35, "Condiciones",   None),
+		("40_PesoNeto",                "text",          41, 35, "Mercancia",     None),
+		("41_PesoBruto",               "text",          42, 35, "Mercancia",     None),
+		("42_TotalBultos",             "text",          43, 35, "Mercancia",     None),
+		("43_Volumen",                 "text",          44, 35, "Mercancia",     None),
+		("44_OtraUnidad",              "text",          45, 35, "Mercancia",     None),
+		("45_PrecioMercancias",        "text",          46, 35, "Mercancia",     None),
+		("46_INCOTERM",                "box",           47, 35, "Incoterm",      None),
+		("47_TipoMoneda",              "box",           48, 35, "Incoterm",      None),
+		("48_PaisMercancia",           "box",           49, 35, "Incoterm",      None),
+		("49_CiudadMercancia",         "box",           50, 35, "Incoterm",      "48_PaisMercancia"),
+		("50_GastosRemitente",         "text",          51, 40, "Gastos",        None),
+		("51_MonedaRemitente",         "box",           52, 40, "Gastos",        None),
+		("52_GastosDestinatario",      "text",          53, 40, "Gastos",        None),
+		("53_MonedaDestinatario",      "box",           54, 40, "Gastos",        None),
+		("54_OtrosGastosRemitente",    "text",          55, 40, "Gastos",        None),
+		("55_OtrosMonedaRemitente",    "box",           56, 40, "Gastos",        None),
+		("56_OtrosGastosDestinatario", "text",          57, 40, "Gastos",        None),
+		("57_OtrosMonedaDestinataio",  "box",           58, 40, "Gastos",        None),
+		("58_TotalRemitente",          "text",          59, 40, "Gastos",        None),
+		("59_TotalDestinatario",       "text",          60, 40, "Gastos",        None),
+		("60_DocsRemitente",           "text",          61, 45, "Emision",       None),
+		("61_FechaEmision",            "date",          62, 45, "Emision",       None),
+		("62_PaisEmision",             "box",           63, 45, "Emision",       None),
+		("63_CiudadEmision",           "box",           64, 45, "Emision",       "62_PaisEmision"),
+		("64_Instrucciones",           "text",          65, 45, "Emision",       None),
+		("65_Observaciones",           "text",          66, 45, "Emision",       None),
+		("66_Secuencia",               "text",          70, 55, "Detalles",      None),
+		("67_CantidadBultos",          "text",          71, 55, "Detalles",      None),
+		("68_TipoEmbalaje",            "embalaje",      72, 55, "Detalles",      None),
+		("69_MarcasNumeros",           "text",          73, 55, "Detalles",      None),
+		("70_PesoNeto",                "text",          74, 55, "Detalles",      None),
+		("71_PesoBruto",               "text",          75, 55, "Detalles",      None),
+		("72_Volumen",                 "text",          76, 55, "Detalles",      None),
+		("73_OtraUnidad",              "text",          77, 55, "Detalles",      None),
+		("74_Subpartida",              "text",          78, 55, "IMOs",          None),
+		("75_IMO1",                    "box",           80, 55, "IMOs",          None),
+		("76_IMO2",                    "box",           81, 55, "IMOs",          None),
+		("77_IMO2",                    "box",           82, 55, "IMOs",          None),
+		("78_NroCertSanitario",        "text",          83, 55, "IMOs",          None),
+		("79_DescripcionCarga",        "text",          84, 55, "IMOs",          None)]
+
+	# Widget : EcuBot fill function
+	WIDGETS = {"text": "fillText", "textSel": "fillTextSelection", "box": "fillBox",
+	           "boxIter": "fillBoxSimpleIteration", "date": "fillFecha",
+	           "condTransporte": "fillCondicionesTransporte", "condPago": "fillCondicionesPago",
+	           "embalaje": "fillTipoEmbalaje"}
+
+	plan     = None     # Compiled plan of LAYOUT
+	lastRun  = []       # Actions of the last run with their secs
+
+	def getPlan ():
+		if EcuPlan.plan is None:
+			EcuPlan.plan = EcuPlan.compile (EcuPlan.LAYOUT)
+		return EcuPlan.plan
+
+	#-- Plan actions: ("tab", n) (n < 0: shift+Tab), ("scroll", steps), ("wait",), ("fill", widget, field)
+	def compile (layout):
+		# Tab order, moving a field after the field it depends on
+		order = sorted (layout, key=lambda x: x [2])
+		for entry in list (order):
+			if entry [5] is not None:
+				dependency = [x for x in order if x [0] == entry [5]][0]
+				if order.index (entry) < order.index (dependency):
+					order.remove (entry)
+					order.insert (order.index (dependency) + 1, entry)
+
+		plan, tab, scroll, section, lastField = [], 0, 0, None, None
+		for field, widget, fieldTab, fieldScroll, fieldSection, dependsOn in order:
+			EcuPlan.addAction (plan, ("tab", fieldTab - tab))
+			if fieldScroll != scroll:
+				EcuPlan.addAction (plan, ("scroll", fieldScroll - scroll))
+			elif fieldSection != section or (dependsOn is not None and dependsOn == lastField):
+				EcuPlan.addAction (plan, ("wait",))
+			EcuPlan.addAction (plan, ("fill", widget, field))
+			tab, scroll, section, lastField = fieldTab, fieldScroll, fieldSection, field
+		EcuPlan.addAction (plan, ("tab", 1))
+		return plan
+
+	#-- Add action merging it with the last one (Tabs, scrolls, waits)
+	def addAction (plan, action):
+		last = plan [-1] if plan else None
+		if action [0] in ["tab", "scroll"] and action [1] == 0:
+			return
+		if last and last [0] == action [0] and action [0] in ["tab", "scroll"]:
+			plan [-1] = (action [0], last [1] + action [1])
+			if plan [-1][1] == 0:
+				plan.pop ()
+		elif not (last and last [0] == action [0] == "wait"):
+			plan.append (action)
+
+	#-- Run the plan actions. 'progress' gets the last field filled and its section.
+	def run (plan, fields, progress=None):
+		progress = {} if progress is None else progress
+		timings  = EcuPlan.lastRun = []
+		driver   = EcuDriver.get ()
+		sections = {x [0] : x [4] for x in EcuPlan.LAYOUT}
+		for action, nextField in zip (plan, EcuPlan.getNextFields (plan)):
+			before    = EcuInput.getStats ()
+			startTime = driver.clock ()
+			EcuPlan.runAction (action, fields, nextField)
+			timings.append ((action, driver.clock () - startTime))
+			EcuBotMetrics.add (action, before, startTime)
+			if action [0] == "fill":
+				progress.update ({"field": action [2], "section": sections.get (action [2])})
+
+	#-- Plan after the fill of a field: the Tabs and scrolls up to it in one
+	#-- move (from the first field, top of the form) and the actions after it
+	def resume (plan, field):
+		fills = [i for i, x in enumerate (plan) if x [0] == "fill" and x [2] == field]
+		if not fills:
+			raise Exception (f"Campo '{field}' no está en el plan del formulario")
+
+		skipped = plan [: fills [0] + 1]
+		resumed = []
+		EcuPlan.addAction (resumed, ("tab", sum (x [1] for x in skipped if x [0] == "tab")))
+		EcuPlan.addAction (resumed, ("scroll", sum (x [1] for x in skipped if x [0] == "scroll")))
+		for action in plan [fills [0] + 1 :]:
+			EcuPlan.addAction (resumed, action)
+		return resumed
+
+	#-- Field filled by or after each action (None after the last fill)
+	def getNextFields (plan):
+		nextFields, field = [], None
+		for action in reversed (plan):
+			field = action [2] if action [0] == "fill" else field
+			nextFields.append (field)
+		return nextFields [::-1]
+
+	#-- Scrolls and waits poll the region of the next field or its section (EcuVerify)
+	def runAction (action, fields, nextField=None):
+		if action [0] == "tab" and action [1] > 0:
+			EcuInput.press ("Tab", action [1])
+		elif action [0] == "tab":
+			EcuInput.hotkey ("shift", "Tab", n=-action [1])
+		elif action [0] == "scroll":
+			Utils.scrollN (abs (action [1]), "down" if action [1] > 0 else "up", EcuVerify.getRegion (nextField))
+		elif action [0] == "wait":
+			EcuWait.forStable (EcuVerify.getRegion (nextField))
+		elif action [0] == "fill":
+			getattr (EcuBot, EcuPlan.WIDGETS [action [1]]) (fields, action [2])
+
+	#-- Text line of an action (with field value for dry runs)
+	def getActionText (action, fields=None):
+		text = " ".join (str (x) for x in action)
+		if fields is not None and action [0] == "fill":
+			text += f" = {fields.get (action [2])!r}"
+		return text
+
+	#-- Plan info for the "bot_plan" service. Options (dict): "dryRun" (RESULTS
+	#-- file to show the values filled) or "timing" (secs of the last run actions)
+	def getInfo (options):
+		plan  = EcuPlan.getPlan ()
+		stats = {"actions": len (plan),
+		         "fills"  : sum (1 for x in plan if x [0] == "fill"),
+		         "tabs"   : sum (x [1] for x in plan if x [0] == "tab" and x [1] > 0),
+		         "backTabs": sum (-x [1] for x in plan if x [0] == "tab" and x [1] < 0),
+		         "scrolls": sum (abs (x [1]) for x in plan if x [0] == "scroll"),
+		         "waits"  : sum (1 for x in plan if x [0] == "wait")}
+		if options.get ("timing"):
+			return {"stats": stats, "timing": [(EcuPlan.getActionText (x), round (secs, 3))
+			                                   for x, secs in EcuPlan.lastRun]}
+
+		fields = Utils.readJsonFile (options ["dryRun"]) if options.get ("dryRun") else None
+		return {"stats": stats, "plan": [EcuPlan.getActionText (x, fields) for x in plan]}
+
+#--------------------------------------------------------------------
+# Checks of RESULTS files before the bot takes the screen: fields of
+# the form present, required fields, known combo values (EcuDB),
+# dates and numbers. A file with errors is rejected with them instead
+# of failing in the middle of the form.
+#--------------------------------------------------------------------
+class EcuValidator:
+	PAISES   = ["10_PaisRemitente", "16_PaisDestinatario", "21_PaisConsignatario", "28_PaisNotificado",
+	            "29_PaisRecepcion", "32_PaisEmbarque", "35_PaisEntrega", "48_PaisMercancia", "62_PaisEmision"]
+	TIPOS_ID = ["11_TipoIdRemitente", "17_TipoIdDestinatario", "22_TipoIdConsignatario"]
+	NUMBERS  = ["40_PesoNeto", "41_PesoBruto", "42_TotalBultos", "43_Volumen", "44_OtraUnidad",
+	            "45_PrecioMercancias", "50_GastosRemitente", "52_GastosDestinatario",
+	            "54_OtrosGastosRemitente", "56_OtrosGastosDestinatario", "58_TotalRemitente",
+	            "59_TotalDestinatario", "67_CantidadBultos", "70_PesoNeto", "71_PesoBruto",
+	            "72_Volumen", "73_OtraUnidad"]
+
+	#-- Error messages of the RESULTS file (empty list if it can be filled)
+	def validate (jsonFilepath):
+		try:
+			with open (jsonFilepath) as fp:
+				fields = json.load (fp)
+		except (OSError, ValueError) as ex:
+			return [f"No se pudo leer el archivo: {ex}"]
+		if type (fields) is not dict:
+			return ["El archivo no tiene campos"]
+
+		errors   = []
+		required = EcuConfig.get ("botRequiredFields", BOT_REQUIRED_FIELDS)
+		for field, widget, *_ in EcuPlan.LAYOUT:
+			if field not in fields:
+				errors.append (f"Falta el campo '{field}'")
+				continue
+			value = fields [field]
+			if value in [None, ""]:
+				if field in required:
+					errors.append (f"Campo requerido '{field}' vacío")
+				continue
+			if type (value) is not str:
+				errors.append (f"Campo '{field}' no es texto: {value!r}")
+				continue
+			error = EcuValidator.checkValue (field, widget, value)
+			if error:
+				errors.append (f"Campo '{field}': {error}")
+		return errors
+
+	#-- Error of a field value or None
+	def checkValue (field, widget, value):
+		if field == "01_Distrito" and value.upper () not in EcuDB.ecudb ["distritos"]:
+			return f"distrito '{value}' desconocido"
+		if field in EcuValidator.PAISES and value.upper () not in [x.upper () for x in EcuDB.getPaises ()]:
+			return f"país '{value}' desconocido"
+		if field in EcuValidator.TIPOS_ID and value.upper () not in EcuDB.getTiposId ():
+			return f"tipo de identificación '{value}' desconocido"
+		if field == "46_INCOTERM" and value.upper () not in EcuDB.getIncoterms ():
+			return f"INCOTERM '{value}' desconocido"
+		if widget == "condTransporte" and EcuBot.getCondicionesTransporte (value) == None:
+			return f"condiciones de transporte '{value}' desconocidas"
+		if widget == "date":
+			try:
+				datetime.strptime (value, "%d-%m-%Y")
+			except ValueError:
+				return f"fecha '{value}' no tiene el formato dd-mm-aaaa"
+		if field in EcuValidator.NUMBERS and not re.fullmatch (r"\d[\d.,]*", value.strip ()):
+			return f"número '{value}' inválido"
+		return None
+
+#--------------------------------------------------------------------
+# Metrics of bot fills: one record per plan action (field fills,
+# Tabs, scrolls, waits, and the setup before them) with its start and
+# end secs in the form, keys, key calls, clipboard round-trips, screen
+# hashes, template matches and retries, saved in a JSONL file per document.
+# The summary ranks the slowest fields and widgets of the last files.
+#--------------------------------------------------------------------
+class EcuBotMetrics:
+	local    = threading_local ()     # Records of the fill of each thread (session)
+	COUNTERS = ["keys", "calls", "clipboard", "screen", "locates", "retries"]
+
+	def getDir ():
+		path = EcuConfig.getDataPath ("bot-metrics")
+		os.makedirs (path, exist_ok=True)
+		return path
+
+	def getFiles ():
+		path = EcuBotMetrics.getDir ()
+		return sorted ([os.path.join (path, x) for x in os.listdir (path) if x.endswith (".jsonl")],
+		               key=os.path.getmtime)
+
+	#-- Start the records of a document fill
+	def start (jsonFilepath):
+		local = EcuBotMetrics.local
+		local.doc, local.started, local.startTime = jsonFilepath, datetime.now (), EcuDriver.get ().clock ()
+		local.records = []
+
+	#-- Record of an action from the form stats and clock taken before it
+	def add (action, before, startTime):
+		local = EcuBotMetrics.local
+		if getattr (local, "records", None) is None:
+			return
+		endTime = EcuDriver.get ().clock ()
+		after   = EcuInput.getStats ()
+		record  = {"action": action [0],
+		           "field" : action [2] if action [0] == "fill" else None,
+		           "widget": action [1] if action [0] == "fill" else None,
+		           "start" : round (startTime - local.startTime, 3),
+		           "end"   : round (endTime - local.startTime, 3),
+		           "secs"  : round (endTime - startTime, 3)}
+		for key in EcuBotMetrics.COUNTERS:
+			record [key] = after [key] - before [key]
+		local.records.append (record)
+
+	#-- Write the JSONL file of the fill: a line with the document and result, and one per action
+	def save (result):
+		local = EcuBotMetrics.local
+		if getattr (local, "records", None) is None:
+			return
+		header = {"doc": os.path.abspath (local.doc), "time": local.started.isoformat (timespec="seconds"),
+		          "result": result, "secs": round (EcuDriver.get ().clock () - local.startTime, 3),
+		          "input": EcuInput.getStats ()}
+		docName  = os.path.splitext (os.path.basename (local.doc)) [0]
+		filename = os.path.join (EcuBotMetrics.getDir (), f"{docName}-{local.started:%Y%m%d-%H%M%S-%f}.jsonl")
+		try:
+			with open (filename, "w") as fp:
+				for record in [header] + local.records:
+					fp.write (json.dumps (record, default=str) + "\n")
+			for oldFile in EcuBotMetrics.getFiles () [: -EcuConfig.get ("botMetricsFiles", BOT_METRICS_FILES)]:
+				os.remove (oldFile)
+		except OSError as ex:
+			EcuBot.printx (f"EXCEPCION: Guardando métricas del bot '{filename}': {ex}")
+		local.records = None
+
+	#-- Slowest fields, widgets and actions (mean secs) of the last documents.
+	#-- Options (dict): "last" (documents, 50) and "top" (fields and widgets, 10)
+	def getSummary (options):
+		files  = EcuBotMetrics.getFiles () [-options.get ("last", 50):]
+		groups = {"fields": {}, "widgets": {}, "actions": {}}
+		for filename in files:
+			with open (filename) as fp:
+				records = [json.loads (line) for line in fp if line.strip ()] [1:]
+			for record in records:
+				keys = {"actions": record ["action"]}
+				if record ["action"] == "fill":
+					keys.update ({"fields": record ["field"], "widgets": record ["widget"]})
+				for group, key in keys.items ():
+					totals = groups [group].setdefault (key, dict.fromkeys (["count", "secs"] + EcuBotMetrics.COUNTERS, 0))
+					totals ["count"] += 1
+					for name in ["secs"] + EcuBotMetrics.COUNTERS:
+						totals [name] += record [name]
+
+		summary = {"documents": len (files)}
+		for group, groupTotals in groups.items ():
+			rows = []
+			for key, totals in groupTotals.items ():
+				row = {"name": key, "count": totals ["count"], "totalSecs": round (totals ["secs"], 3)}
+				for name in ["secs"] + EcuBotMetrics.COUNTERS:
+					row ["mean" + name.capitalize ()] = round (totals [name] / totals ["count"], 3)
+				rows.append (row)
+			rows.sort (key=lambda x: -x ["meanSecs"])
+			summary [group] = rows if group == "actions" else rows [: options.get ("top", 10)]
+		return summary
+
+#--------------------------------------------------------------------
+# Ledger of the documents filled by the bot (SQLite in the data dir):
+# a row per fill with the document number (02_NumeroCPIC), the hash
+# of its form fields, the outcome and the time. The bot queue skips
+# documents already filled unless the request forces them.
+#--------------------------------------------------------------------
+class EcuLedger:
+	def connect ():
+		conn = sqlite3_connect (EcuConfig.getDataPath ("ecuapass-bot-ledger.sqlite"), timeout=30)
+		conn.row_factory = sqlite3_Row
+		conn.execute ("CREATE TABLE IF NOT EXISTS fills (numero TEXT, hash TEXT, path TEXT, "
+		              "status TEXT, result TEXT, time TEXT, session TEXT)")
+		conn.execute ("CREATE INDEX IF NOT EXISTS fillsNumero ON fills (numero)")
+		conn.execute ("CREATE INDEX IF NOT EXISTS fillsHash ON fills (hash)")
+		return conn
+
+	#-- Run the SQL statement and return its rows as dicts
+	def execute (sql, params=()):
+		conn = EcuLedger.connect ()
+		try:
+			with conn:
+				return [dict (x) for x in conn.execute (sql, params).fetchall ()]
+		finally:
+			conn.close ()
+
+	#-- Document number and SHA-256 of the form fields of a RESULTS file ((None, None) if unreadable)
+	def getKeys (jsonFilepath):
+		try:
+			with open (jsonFilepath) as fp:
+				fields = json.load (fp)
+		except (OSError, ValueError):
+			return None, None
+		formFields = {x [0] : fields.get (x [0]) for x in EcuPlan.LAYOUT}
+		text = json.dumps (formFields, sort_keys=True, ensure_ascii=False, default=str)
+		return fields.get ("02_NumeroCPIC") or None, hashlib.sha256 (text.encode ()).hexdigest ()
+
+	#-- Record the outcome of a fill: "ok" or "error"
+	def add (jsonFilepath, status, result, session=None):
+		numero, hash = EcuLedger.getKeys (jsonFilepath)
+		try:
+			EcuLedger.execute ("INSERT INTO fills VALUES (?, ?, ?, ?, ?, ?, ?)",
+			                   (numero, hash, os.path.abspath (jsonFilepath), status, result,
+			                    datetime.now ().strftime ("%Y-%m-%d %H:%M:%S"), session))
+		except sqlite3_Error as ex:
+			EcuBot.printx (f"EXCEPCION: Registrando '{jsonFilepath}' en el registro de ingresos: {ex}")
+
+	#-- Last successful fill of the same document number or fields (None if not filled)
+	def findFilled (jsonFilepath):
+		numero, hash = EcuLedger.getKeys (jsonFilepath)
+		if hash is None:
+			return None
+		rows = EcuLedger.execute ("SELECT * FROM fills WHERE status = 'ok' AND (numero = ? OR hash = ?) "
+		                          "ORDER BY time DESC LIMIT 1", (numero, hash))
+		return rows [0] if rows else None
+
+	#-- Fills of a document number ({"numero"}) or the last ones ({"last"}, 50)
+	def getFills (options):
+		if options.get ("numero"):
+			return EcuLedger.execute ("SELECT * FROM fills WHERE numero = ? ORDER BY time DESC", (options ["numero"],))
+		return EcuLedger.execute ("SELECT * FROM fills ORDER BY time DESC LIMIT ?", (options.get ("last", 50),))
+
+#--------------------------------------------------------------------
+# Bot session on the ECUAPASS window: the window is detected and
+# maximized, and the clear button and cartaporte page are checked,
+# once. Next documents only clear the form (clicking the known clear
+# button). After a failed fill the next one opens the session again.
+#--------------------------------------------------------------------
+class EcuSession:
+	local = threading_local ()
+
+	#-- driver: input/screen driver of the session (None: the default one). lock: held
+	#-- while filling (shared by sessions on one screen). keepOpen: False opens it each fill.
+	def __init__ (self, driver=None, name="desktop", lock=None, keepOpen=True):
+		self.driver   = driver
+		self.name     = name
+		self.lock     = lock or threading_Lock ()
+		self.keepOpen = keepOpen
+		self.win      = None      # ECUAPASS window
+		self.clearXY  = None      # Center of the clear button
+		self.input    = None      # Keyboard stats of the last fill
+		self.stats    = {"opens": 0, "docs": 0, "errors": 0}
+
+	#-- Session filling in the current thread
+	def get ():
+		return getattr (EcuSession.local, "session", None)
+
+	#-- Detect, activate and maximize the ECUAPASS window
+	def open (self):
+		self.win = Utils.activateEcuapassWindow ()
+		EcuWait.until (lambda: getattr (self.win, "isActive", True), timeout=1)
 		EcuBot.printx (">>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>><<")
+		#Utils.maximizeWindow (self.win)
+		self.win.maximize ()
+		self.clearXY = None
+		self.stats ["opens"] += 1
+
+	#-- Fill the document. With 'resume' a form left partially filled
+	#-- (checkpoint) is kept and filled after its last field.
+	def fill (self, jsonFilepath, resume=False):
+		EcuBot.printx (">>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>><<")
+		EcuSession.local.session = self
+		if self.driver is not None:
+			EcuDriver.set (self.driver)
+		EcuInput.startForm ()
+		EcuBotMetrics.start (jsonFilepath)
+		checkpoint = EcuCheckpoints.get (jsonFilepath) if resume else None
+		progress   = dict (checkpoint or {})
+		result     = None
 		try:
-			global win
+			setupStats, setupTime = EcuInput.getStats (), EcuDriver.get ().clock ()
 			fields = Utils.readJsonFile (jsonFilepath)
-			#py.sleep (1)
-			win    = Utils.activateEcuapassWindow ()
-			EcuBot.printx (">>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>><<")
-			#Utils.maximizeWindow (win)
-			win.maximize ()
+			isOpen = self.win is not None
+			if not isOpen:
+				self.open ()
+			elif not getattr (self.win, "isActive", True):
+				self.win.activate ()
+
 			#EcuBot.printx ("Scrolling up..")
 			#Utils.scrollN (40, direction="up")
-			#py.sleep (1)
-			Utils.clearWebpageContent ()
-			py.press ("Tab"); py.press ("Tab")
-			Utils.checkCPITWebpage ()
-
-			# Encabezado
-			time.sleep (PAUSE)
-			EcuBot.fillBoxSimpleIteration (fields, "01_Distrito"); py.press ("Tab")
-			EcuBot.fillText (fields, "02_NumeroCPIC"); py.press ("Tab")
-			EcuBot.fillText (fields, "03_MRN"); py.press ("Tab"); 
-			EcuBot.fillText (fields, "04_MSN"); py.press ("Tab")
-			EcuBot.fillBox (fields, "05_TipoProcedimiento"); py.press ("Tab")
-			#EcuBot.fillTextSelection (fields, "06_EmpresaTransporte") # Selected by default
-			py.press ("Tab")
-			EcuBot.fillBox (fields, "07_DepositoMercancia"); py.press ("Tab")
-
-			EcuBot.fillText (fields, "08_DirTransportista"); py.press ("Tab");
-			EcuBot.fillText (fields, "09_NroIdentificacion"); py.press ("Tab")
-
-			Utils.scrollN (5)
-
-			# Remitente
-			time.sleep (PAUSE)
-			EcuBot.fillBox (fields, "10_PaisRemitente"); py.press ("Tab")
-			EcuBot.fillBox (fields, "11_TipoIdRemitente") ; py.press ("Tab")
-			EcuBot.fillText (fields, "12_NroIdRemitente"); py.press ("Tab")
-			EcuBot.fillText (fields, "13_NroCertSanitario"); py.press ("Tab")
-			EcuBot.fillBox (fields, "14_NombreRemitente"); py.press ("Tab")
-			EcuBot.fillText (fields, "15_DireccionRemitente"); py.press ("Tab")
-
-
-			# Destinatario
-			time.sleep (PAUSE)
-			EcuBot.fillTextSelection (fields, "16_PaisDestinatario"); py.press ("Tab")
-			EcuBot.fillTextSelection (fields, "17_TipoIdDestinatario"); py.press ("Tab")
-			EcuBot.fillText (fields, "18_NroIdDestinatario"); py.press ("Tab")
-			py.press ("Tab")   # Skip Boton buscar
-			EcuBot.fillTextSelection (fields, "19_NombreDestinatario"); py.press ("Tab")
-			EcuBot.fillText (fields, "20_DireccionDestinatario"); py.press ("Tab")
-
-
-			# Consignatario
-			time.sleep (PAUSE)
-			EcuBot.fillBox (fields, "21_PaisConsignatario"); py.press ("Tab")
-			EcuBot.fillBox (fields, "22_TipoIdConsignatario"); py.press ("Tab")
-			EcuBot.fillText (fields, "23_NroIdConsignatario"); py.press ("Tab")
-			py.press ("Tab")    # Boton buscar consignatario por Id
-			EcuBot.fillText (fields, "24_NombreConsignatario"); py.press ("Tab")
-			EcuBot.fillText (fields, "25_DireccionConsignatario"); py.press ("Tab")
-
-			Utils.scrollN (10)
-
-			# Notificado
-			time.sleep (PAUSE)
-			EcuBot.fillText (fields, "26_NombreNotificado"); py.press ("Tab")
-			EcuBot.fillText (fields, "27_DireccionNotificado"); py.press ("Tab")
-			EcuBot.fillBox (fields, "28_PaisNotificado"); py.press ("Tab")
-
-			# Paises: Recepcion, Embarque, Entrega
-			#time.sleep (PAUSE)
-			Utils.scrollN (10)
-			EcuBot.fillBox (fields, "29_PaisRecepcion"); 
-			py.press ("Tab"); py.press ("Tab"); py.press ("Tab")
-			EcuBot.fillBox (fields, "32_PaisEmbarque"); 
-			py.press ("Tab"); py.press ("Tab"); py.press ("Tab")
-			EcuBot.fillBox (fields, "35_PaisEntrega"); 
-
-			# Pais INCOTERM
-			time.sleep (PAUSE)
-			[py.press ("Tab") for i in range (13)]
-			EcuBot.fillBox (fields, "48_PaisMercancia"); 
-
-			# Pais Emision
-			time.sleep (PAUSE)
-			[py.press ("Tab") for i in range (14)]
-			EcuBot.fillBox (fields, "62_PaisEmision"); 
-
-			[py.hotkey ("shift", "Tab") for i in range (32)]
-
-			# Fechas: Recepcion, Embarque, Entrega
-			time.sleep (PAUSE)
-			EcuBot.fillBox (fields, "30_CiudadRecepcion"); py.press ("Tab")
-			EcuBot.fillFecha (fields, "31_FechaRecepcion"); 
-			py.press ("Tab"); py.press ("Tab"); 
-
-			EcuBot.fillBox (fields, "33_CiudadEmbarque"); py.press ("Tab")
-			EcuBot.fillFecha (fields, "34_FechaEmbarque"); 
-			py.press ("Tab"); py.press ("Tab"); 
-			EcuBot.fillBox (fields, "36_CiudadEntrega"); py.press ("Tab")
-			EcuBot.fillFecha (fields, "37_FechaEntrega"); py.press ("Tab") 
-
-			Utils.scrollN (10)
-
-			# Condiciones
-			time.sleep (PAUSE)
-			EcuBot.fillCondicionesTransporte (fields, "38_CondicionesTransporte"); py.press ("Tab")
-			EcuBot.fillCondicionesPago (fields, "39_CondicionesPago"); py.press ("Tab")
-
-			# Mercancia
-			time.sleep (PAUSE)
-			EcuBot.fillText (fields, "40_PesoNeto"); py.press ("Tab")
-			EcuBot.fillText (fields, "41_PesoBruto"); py.press ("Tab")
-			EcuBot.fillText (fields, "42_TotalBultos"); py.press ("Tab")
-			EcuBot.fillText (fields, "43_Volumen"); py.press ("Tab")
-			EcuBot.fillText (fields, "44_OtraUnidad"); py.press ("Tab")
-			EcuBot.fillText (fields, "45_PrecioMercancias"); py.press ("Tab")
-
-			# INCOTERM
-			time.sleep (PAUSE)
-			EcuBot.fillBox (fields, "46_INCOTERM"); py.press ("Tab")
-			EcuBot.fillBox (fields, "47_TipoMoneda"); py.press ("Tab")
-			py.press ("Tab")
-			EcuBot.fillBox (fields, "49_CiudadMercancia"); py.press ("Tab")
-
-			Utils.scrollN (5)
-
-			# Gastos
-			time.sleep (PAUSE)
-			EcuBot.fillText (fields, "50_GastosRemitente"); py.press ("Tab")
-			EcuBot.fillBox (fields, "51_MonedaRemitente"); py.press ("Tab")
-			EcuBot.fillText (fields, "52_GastosDestinatario"); py.press ("Tab")
-			EcuBot.fillBox (fields, "53_MonedaDestinatario"); py.press ("Tab")
-			EcuBot.fillText (fields, "54_OtrosGastosRemitente"); py.press ("Tab")
-			EcuBot.fillBox (fields, "55_OtrosMonedaRemitente"); py.press ("Tab")
-			EcuBot.fillText (fields, "56_OtrosGastosDestinatario"); py.press ("Tab")
-			EcuBot.fillBox (fields, "57_OtrosMonedaDestinataio"); py.press ("Tab")
-			EcuBot.fillText (fields, "58_TotalRemitente"); py.press ("Tab")
-			EcuBot.fillText (fields, "59_TotalDestinatario"); py.press ("Tab")
-
-			Utils.scrollN (5)
-
-			# Documentos
-			EcuBot.fillText (fields, "60_DocsRemitente"); py.press ("Tab")
-
-			# Emision
-			EcuBot.fillFecha (fields, "61_FechaEmision"); py.press ("Tab")
-			py.press ("Tab")
-			EcuBot.fillBox (fields, "63_CiudadEmision"); py.press ("Tab")
-
-			# Instrucciones
-			EcuBot.fillText (fields, "64_Instrucciones"); py.press ("Tab")
-			EcuBot.fillText (fields, "65_Observaciones"); py.press ("Tab")
-
-			[py.press ("Tab") for i in range (3)]
-
-			Utils.scrollN (10)
-			# Detalles
-			time.sleep (PAUSE)
-			EcuBot.fillText (fields, "66_Secuencia"); py.press ("Tab")
-			EcuBot.fillText (fields, "67_CantidadBultos"); py.press ("Tab")
-			EcuBot.fillTipoEmbalaje (fields, "68_TipoEmbalaje"); py.press ("Tab")
-			EcuBot.fillText (fields, "69_MarcasNumeros"); py.press ("Tab")
-			EcuBot.fillText (fields, "70_PesoNeto"); py.press ("Tab")
-			EcuBot.fillText (fields, "71_PesoBruto"); py.press ("Tab")
-			EcuBot.fillText (fields, "72_Volumen"); py.press ("Tab")
-			EcuBot.fillText (fields, "73_OtraUnidad"); py.press ("Tab")
-
-			# IMOs
-			time.sleep (PAUSE)
-			EcuBot.fillText (fields, "74_Subpartida"); py.press ("Tab"); py.press ("Tab")
-			EcuBot.fillBox (fields, "75_IMO1"); py.press ("Tab")
-			EcuBot.fillBox (fields, "76_IMO2"); py.press ("Tab")
-			EcuBot.fillBox (fields, "77_IMO2"); py.press ("Tab")
-			EcuBot.fillText (fields, "78_NroCertSanitario"); py.press ("Tab")
-			EcuBot.fillText (fields, "79_DescripcionCarga"); py.press ("Tab")
+			# A new session checks the page and locates the clear button in one screenshot
+			plan = EcuPlan.getPlan ()
+			if not isOpen:
+				Utils.checkCPITWebpage ()
+			if checkpoint is None:
+				self.clearXY = Utils.clearWebpageContent (self.clearXY, grab=isOpen)
+				startTabs    = EcuConfig.get ("botClearTabs", BOT_CLEAR_TABS)
+			else:
+				EcuBot.printx (f"Continuando formulario después del campo '{checkpoint ['field']}'...")
+				Utils.focusFormStart ()
+				plan      = EcuPlan.resume (plan, checkpoint ["field"])
+				startTabs = EcuConfig.get ("botTitleTabs", BOT_TITLE_TABS)
+			EcuInput.press ("Tab", startTabs)
+			EcuBotMetrics.add (("setup",), setupStats, setupTime)
+
+			# Fields in the order of the compiled form plan
+			EcuPlan.run (plan, fields, progress)
 		except Exception as ex:
 			EcuBot.printx (f"EXCEPCION: Problemas al llenar documento '{jsonFilepath}'")
 			print (traceback_format_exc())
-			return (str(ex))
+			EcuCheckpoints.save (jsonFilepath, progress, ex)
+			self.win = None
+			self.stats ["errors"] += 1
+			result = str (ex)
+			self.addLedger (jsonFilepath, "error", result)
+			return (result)
+		finally:
+			self.input = EcuInput.getStats ()
+			EcuBot.printx ("Tiempo de teclado del formulario:", self.input)
+			EcuBotMetrics.save (result or "ok")
+
+		EcuCheckpoints.drop (jsonFilepath)
+		self.stats ["docs"] += 1
+		if not self.keepOpen:
+			self.win = None
+		result = f"Ingresado exitosamente el documento {jsonFilepath}"
+		self.addLedger (jsonFilepath, "ok", result)
+		return (result)
+
+	#-- Fills of the fake driver are not real entries
+	def addLedger (self, jsonFilepath, status, result):
+		if not EcuDriver.get ().isFake:
+			EcuLedger.add (jsonFilepath, status, result, self.name)
+
+	def getInfo (self):
+		return dict (self.stats, name=self.name, isOpen=self.win is not None, clearXY=self.clearXY)
 
-		return (f"Ingresado exitosamente el documento {jsonFilepath}")
+#--------------------------------------------------------------------
+# Bot session on its own X display (e.g. Xvfb ":1" with its ECUAPASS
+# browser): a bot process with DISPLAY set, so pyautogui, clipboard
+# and window are the ones of that display. Files are sent to its
+# stdin; its output is echoed until the line with the fill result.
+# Names starting with "fake" run the process with the fake driver.
+#--------------------------------------------------------------------
+class EcuDisplaySession:
+	RESULT = "@@ECUAPASS-SESSION-RESULT "
+
+	def __init__ (self, display):
+		self.name     = display
+		self.lock     = threading_Lock ()
+		self.process  = None
+		self.input    = None
+		self.info     = {}       # Info of the session in the process
+		self.timedOut = False
+
+	#-- Start the bot process of the display
+	def start (self):
+		command = [sys.executable] if getattr (sys, "frozen", False) else [sys.executable, os.path.abspath (__file__)]
+		env     = dict (os.environ) if self.name.startswith ("fake") else dict (os.environ, DISPLAY=self.name)
+		EcuBot.printx (f"Iniciando sesión del bot en pantalla '{self.name}'...")
+		self.process = subprocess_Popen (command + ["--session", self.name], env=env, text=True,
+		                                 stdin=subprocess_PIPE, stdout=subprocess_PIPE)
+
+	#-- A process without result after 'botSessionTimeout' secs is killed (hung bot)
+	def fill (self, jsonFilepath, resume=False):
+		if self.process is None or self.process.poll () is not None:
+			self.start ()
+		process, self.timedOut = self.process, False
+		timer = threading_Timer (EcuConfig.get ("botSessionTimeout", BOT_SESSION_TIMEOUT), self.kill, (process,))
+		timer.start ()
+		try:
+			process.stdin.write (json.dumps ({"file": jsonFilepath, "resume": resume}) + "\n")
+			process.stdin.flush ()
+			for line in process.stdout:
+				if line.startswith (EcuDisplaySession.RESULT):
+					reply = json.loads (line [len (EcuDisplaySession.RESULT):])
+					self.input, self.info = reply ["input"], reply ["info"]
+					return reply ["result"]
+				print (f"[{self.name}]", line, end="", flush=True)
+		except OSError as ex:
+			EcuBot.printx (f"EXCEPCION: Sesión '{self.name}': {ex}")
+		finally:
+			timer.cancel ()
+		self.process = None
+		if self.timedOut:
+			raise Exception (f"Sesión del bot en pantalla '{self.name}' sin resultado en el tiempo máximo. Proceso terminado")
+		raise Exception (f"Sesión del bot en pantalla '{self.name}' terminó sin resultado")
+
+	def kill (self, process):
+		EcuBot.printx (f"ALERTA: Sesión del bot en pantalla '{self.name}' sin respuesta. Terminando su proceso...")
+		self.timedOut = True
+		process.kill ()
+
+	def getInfo (self):
+		pid = self.process.pid if self.process and self.process.poll () is None else None
+		return dict (self.info, name=self.name, pid=pid)
+
+	#-- Bot process loop: fill the files read from stdin in one session
+	def serve (name):
+		session = EcuSession (EcuFakeDriver () if name.startswith ("fake") else None, name)
+		for line in sys.stdin:
+			request = json.loads (line)
+			result  = session.fill (request ["file"], request.get ("resume", False))
+			reply   = {"result": result, "input": session.input, "info": session.getInfo ()}
+			print (EcuDisplaySession.RESULT + json.dumps (reply, default=str), flush=True)
+
+#--------------------------------------------------------------------
+# EcuBot for filling Ecuapass cartaporte web form (in flash)
+#--------------------------------------------------------------------
+class EcuBot:
+	#-- Fill one document in a new session. With 'resume' a form left
+	#-- partially filled (checkpoint) is kept and filled after its last field.
+	def fillEcuapass (jsonFilepath, resume=False):
+		return EcuSession ().fill (jsonFilepath, resume)
 
 	#--------------------------------------------------------------------
 	# Special fields
 	#--------------------------------------------------------------------
 	#-- Fill '68 Tipo Embalaje' combo box
 	def fillTipoEmbalaje (fields, fieldName):
+		if fields [fieldName] == None:
+			return
 		value = fields [fieldName].upper()
 		if value.upper() in ["ESTIBA", "PALLETS"]:
 			value = "PALLETES"
@@ -1228,19 +3211,30 @@ class EcuBot:
 
 	#-- Fill '38 Condiciones Transporte' combo box
 	def fillCondicionesTransporte (fields, fieldName):
-		value = fields [fieldName].upper()
-		if "DIRECTO" in value and "SIN" in value:
-			text = "DIRECTO, SIN CAMBIO DEL CAMION"
-		elif "DIRECTO" in value and "CON" in value:
-			text = "DIRECTO, CON CAMBIO DEL TRACTO-CAMION"
-		elif "TRANSBORDO" in value:
-			text = "TRANSBORDO"
+		if fields [fieldName] == None:
+			return
+		text = EcuBot.getCondicionesTransporte (fields [fieldName])
+		if text == None:
+			raise Exception (f"Condiciones de transporte '{fields [fieldName]}' desconocidas")
 
 		fields [fieldName] = text
 		EcuBot.fillBox (fields, fieldName)
+
+	#-- Option of '38 Condiciones Transporte' for the document text (None if unknown)
+	def getCondicionesTransporte (value):
+		value = value.upper()
+		if "DIRECTO" in value and "SIN" in value:
+			return "DIRECTO, SIN CAMBIO DEL CAMION"
+		elif "DIRECTO" in value and "CON" in value:
+			return "DIRECTO, CON CAMBIO DEL TRACTO-CAMION"
+		elif "TRANSBORDO" in value:
+			return "TRANSBORDO"
+		return None
 		
 	#-- 39_CondicionesPago
 	def fillCondicionesPago (fields, fieldName):
+		if fields [fieldName] == None:
+			return
 		value = fields [fieldName].upper()
 		if "CREDITO" in value: 
 			text = "POR COBRAR"
@@ -1264,47 +3258,74 @@ class EcuBot:
 			return
 		# Copy field text
 		fieldText = value.upper()
-		pyperclip_copy (fieldText)
-		py.hotkey ("ctrl", "v")
-		py.press ("down")
+		EcuDriver.get ().copy (fieldText)
+		if EcuConfig.get ("botVerify", BOT_VERIFY) == "screen":
+			region = EcuVerify.paste (fieldName, ftype="box")
+		else:
+			region = None
+			EcuInput.hotkey ("ctrl", "v", ftype="box")
 
-		# Check if selection is null
-		py.hotkey ("ctrl", "c")
-		if pyperclip_paste () == fieldText:
+		# Check if selection is null (the field doesn't change going down or the copied text is the same)
+		if region is not None:
+			isNull = not EcuVerify.pressChanges (region, "down", ftype="box")
+		else:
+			EcuInput.press ("down", ftype="box")
+			text   = EcuWait.copyText (ftype="box")
+			isNull = text is None or text == fieldText
+		if isNull:
 			EcuBot.printx (f"No se encontró la opción '{fieldText}' en el campo '{fieldName}'")
-			py.press ("--")
+			EcuInput.count ("retries")
+			EcuInput.press ("--", ftype="box")
 		else:
-			pyperclip_copy (fieldText)
-			py.hotkey ("ctrl", "v")
+			EcuDriver.get ().copy (fieldText)
+			EcuInput.hotkey ("ctrl", "v", ftype="box")
 
-		py.press ("down")
-		py.press ("enter")
+		EcuInput.press ("down", ftype="box")
+		EcuInput.press ("enter", ftype="box")
 
 	#-- Fill box iterating, copying, comparing.
+	#-- Known options are selected going down to their cached index.
 	def fillBoxSimpleIteration (fields, fieldName):
 		fieldText = fields [fieldName].upper()
 		EcuBot.printx (f"> >> Llenando simple CBox '{fieldName} : {fieldText}'...")
 
+		index = EcuCombos.getIndex (fieldName, fieldText)
+		if index is not None:
+			EcuInput.press ("down", index, ftype="box")
+			EcuInput.hotkey ("ctrl", "a", ftype="box")
+			if fieldText in (EcuWait.copyText (ftype="box") or "").upper():
+				EcuInput.press ("enter", ftype="box")
+				return
+			EcuBot.printx (f"\t\t Opciones de '{fieldName}' cambiaron. Recorriendo opciones...")
+			EcuInput.count ("retries")
+			EcuCombos.dropOptions (fieldName)
+			EcuInput.press ("up", index, ftype="box")
+
+		options  = []
 		lastText = "XXXYYYZZZ"
 		while True:
-			py.hotkey ("ctrl", "a");py.hotkey ("ctrl","c"); 
-			text = pyperclip_paste().upper()
+			EcuInput.hotkey ("ctrl", "a", ftype="box")
+			text = (EcuWait.copyText (ftype="box") or "").upper()
 			if fieldText in text:
 				EcuBot.printx (f"\t\t Encontrado {fieldText} en {text}") 
-				py.press ("enter"); 
+				EcuInput.press ("enter", ftype="box"); 
+				options.append (text)
 				break
 
 			if (text == lastText):
 				EcuBot.printx (f"\t\t No se pudo encontrar '{fieldText}'!")
 				break
 
-			py.press ("down");
+			EcuInput.press ("down", ftype="box");
+			EcuInput.count ("retries")
+			options.append (text)
 			lastText = text 
+		EcuCombos.addOptions (fieldName, options)
 
 	#-- fill text field with selection
 	def fillTextSelection (fields, fieldName, imageName=None):
 		EcuBot.fillText (fields, fieldName, imageName)
-		py.press ("Enter")
+		EcuInput.press ("Enter")
 
 
 	#-- fill text field
@@ -1314,43 +3335,67 @@ class EcuBot:
 		if value == None:
 			return
 
-		pyperclip_copy (value)
+		EcuDriver.get ().copy (value)
 		if imageName == None:
 			#py.write (value)
-			py.hotkey ("ctrl", "v")
+			EcuInput.hotkey ("ctrl", "v", ftype="text")
 
 
 	#-- fill combo box iterating over all values (Ctrl+x+v+a+back)
+	#-- Known options are reached without reading the other options.
 	def fillCBoxFieldByIterating (fields, fieldName):
 		#py.pause = 0.05
 		fieldText = fields [fieldName].lower()
 		EcuBot.printx (f"> >> Llenando CBox iterando uno a uno '{fieldName} : {fieldText}'...")
 
-		py.hotkey ("ctrl","c"); py.hotkey ("ctrl","v"); py.hotkey ("ctrl","a");
-		py.press ("backspace");
-		py.press ("down");
+		EcuInput.hotkey ("ctrl","c", ftype="box"); EcuInput.hotkey ("ctrl","v", ftype="box"); EcuInput.hotkey ("ctrl","a", ftype="box");
+		EcuInput.press ("backspace", ftype="box");
+		EcuInput.press ("down", ftype="box");
 
+		index = EcuCombos.getIndex (fieldName, fieldText)
+		for i in range (index or 0):
+			EcuInput.hotkey ("ctrl","a", ftype="box"); EcuInput.press ("backspace", ftype="box"); EcuInput.press ("down", ftype="box");
+
+		options  = [] if index is None else None    # Learned only from the first option
 		lastText = "XXXYYYZZZ"
 		while True:
-			py.hotkey ("ctrl","c"); py.hotkey ("ctrl","v")
-			text = pyperclip_paste().lower()
+			text = (EcuWait.copyText (ftype="box") or "").lower()
+			EcuInput.hotkey ("ctrl","v", ftype="box")
 			value = Utils.strCompare (fieldText, text) 
 			EcuBot.printx (f"\t\t Comparando texto campo '{fieldText}' con texto CBox '{text}', valor: {value}")
 			#if value > 0.8:
 			if fieldText in text:
 				EcuBot.printx (f"\t\t Encontrado!") 
-				py.press ("enter"); py.press ("enter")
+				EcuInput.press ("enter", ftype="box"); EcuInput.press ("enter", ftype="box")
+				if options is not None:
+					options.append (text)
 				break
 
 			if (text == lastText):
 				EcuBot.printx (f"\t\tERROR: No se pudo encontrar '{fieldText}'!")
 				break
 
-			py.hotkey ("ctrl","a"); py.press ("backspace"); py.press ("down");
+			# Cached index was wrong: back to the first option, the options are learned again
+			if index is not None:
+				EcuBot.printx (f"\t\t Opciones de '{fieldName}' cambiaron. Recorriendo opciones...")
+				EcuInput.count ("retries")
+				EcuCombos.dropOptions (fieldName)
+				EcuInput.hotkey ("ctrl","a", ftype="box"); EcuInput.press ("backspace", ftype="box");
+				EcuInput.press ("up", index, ftype="box")
+				index, options, lastText = None, [], "XXXYYYZZZ"
+				continue
+
+			EcuInput.hotkey ("ctrl","a", ftype="box"); EcuInput.press ("backspace", ftype="box"); EcuInput.press ("down", ftype="box");
+			EcuInput.count ("retries")
+			if options is not None:
+				options.append (text)
 			lastText = text 
+		if options:
+			EcuCombos.addOptions (fieldName, options)
 
 
-	#-- Fill Date box widget (month, year, day)
+	#-- Fill Date box widget typing the date. If the widget doesn't
+	#-- take it, the date is selected in the calendar (month, year, day)
 	def fillFecha (fields, fieldName):
 		EcuBot.printx (f"Llenando fecha '{fieldName}' : {fields [fieldName]}'...")
 		fechaText = fields [fieldName]
@@ -1360,23 +3405,43 @@ class EcuBot:
 		items = fechaText.split("-")
 		day, month, year = int (items[0]), int (items[1]), int (items[2])
 
+		if EcuConfig.get ("botDateEntry", BOT_DATE_ENTRY) == "type":
+			if EcuBot.typeFecha (day, month, year):
+				return
+			EcuBot.printx (f"Fecha '{fechaText}' no aceptada en '{fieldName}'. Usando el calendario...")
+			EcuInput.count ("retries")
+		EcuBot.selectFecha (day, month, year)
+
+	#-- Paste the date in the box and check it with one read (constant keystrokes)
+	def typeFecha (day, month, year):
+		EcuDriver.get ().copy ("%.2d/%.2d/%d" % (day, month, year))
+		EcuInput.hotkey ("ctrl", "a", ftype="date")
+		EcuInput.hotkey ("ctrl", "v", ftype="date")
+
+		EcuInput.hotkey ("ctrl", "a", ftype="date")
+		try:
+			return [int (x) for x in EcuWait.copyText (ftype="date").split ("/")] == [day, month, year]
+		except (AttributeError, ValueError):
+			return False
+
+	#-- Select the date navigating the calendar from the current box date
+	def selectFecha (day, month, year):
 		boxDate    = EcuBot.getBoxDate ()
 		dayBox	   = boxDate [0]
 		monthBox   = boxDate [1]
 		yearBox    = boxDate [2]
 
-		py.hotkey ("ctrl", "down")
+		EcuInput.hotkey ("ctrl", "down", ftype="date")
 		EcuBot.setYear  (year, yearBox)
 		EcuBot.setMonth (month, monthBox)
 		EcuBot.setDay (day)
 
 	#-- Get current date fron date box widget
 	def getBoxDate ():
-		py.hotkey ("ctrl", "down")
-		py.press ("home")
-		py.hotkey ("ctrl", "a")
-		py.hotkey ("ctrl", "c")
-		text	 = pyperclip_paste ()
+		EcuInput.hotkey ("ctrl", "down", ftype="date")
+		EcuInput.press ("home", ftype="date")
+		EcuInput.hotkey ("ctrl", "a", ftype="date")
+		text	 = EcuWait.copyText (ftype="date") or ""
 		boxDate  = text.split ("/") 
 		boxDate  = [int (x) for x in boxDate]
 		return (boxDate)
@@ -1387,13 +3452,7 @@ class EcuBot:
 		pageKey = "pageup" if diff < 0 else "pagedown"
 		EcuBot.printx (f"Localizando año. Doc: {yearDoc}. OCR: {yearOCR}. Diff: {diff}...")
 
-		for i in range (abs(diff)):
-			EcuBot.printx (f"Año %.2d: " % (i+1), end="")
-			for k in range (12):
-				EcuBot.printx (f">%.2d " % (k+1), end="")
-				py.press (pageKey)
-			EcuBot.printx ("")
-		EcuBot.printx ("")
+		EcuInput.press (pageKey, 12 * abs (diff), ftype="date")
 
 	#-- Set month
 	def setMonth (monthDoc, monthOCR):											 
@@ -1401,9 +3460,7 @@ class EcuBot:
 		pageKey = "pageup" if diff < 0 else "pagedown"
 		EcuBot.printx (f"Localizando mes. Doc: {monthDoc}. OCR: {monthOCR}. Diff: {diff}...")
 
-		for i in range (abs(diff)):
-			EcuBot.printx (f"> %.2d " % (i+1), end="")
-			py.press (pageKey)
+		EcuInput.press (pageKey, abs (diff), ftype="date")
 
 	#-- Set day
 	def setDay (dayDoc):
@@ -1412,11 +3469,11 @@ class EcuBot:
 			nDays  = dayDoc % 7 - 1
 			EcuBot.printx (f"Localizando dia {dayDoc}. Semanas: {nWeeks}, Dias: {nDays}...")
 
-			py.press ("home")
-			[py.press ("down") for i in range (nWeeks)]
-			[py.press ("right") for i in range (nDays)]
+			EcuInput.press ("home", ftype="date")
+			EcuInput.press ("down", nWeeks, ftype="date")
+			EcuInput.press ("right", nDays, ftype="date")
 
-			py.press ("enter")
+			EcuInput.press ("enter", ftype="date")
 		except:
 			EcuBot.printx (f"EXCEPTION: Al buscar el dia '{dayDoc}'")
 			raise
@@ -1424,6 +3481,881 @@ class EcuBot:
 	def printx (*args, flush=True, end="\n"):
 		print ("BOT:", *args, flush=flush, end=end)
 
+#--------------------------------------------------------------------
+# Exclusive lock of a data file shared by the bot sessions of several
+# processes (a '.lock' file next to it): read-merge-write updates.
+#--------------------------------------------------------------------
+class EcuFileLock:
+	def __init__ (self, filename):
+		self.filename = f"{filename}.lock"
+		self.fp       = None
+
+	def __enter__ (self):
+		self.fp = open (self.filename, "a+")
+		if sys.platform == "win32":
+			import msvcrt
+			while True:      # LK_LOCK gives up after 10 secs
+				try:
+					self.fp.seek (0)
+					msvcrt.locking (self.fp.fileno (), msvcrt.LK_LOCK, 1)
+					break
+				except OSError:
+					pass
+		else:
+			import fcntl
+			fcntl.flock (self.fp.fileno (), fcntl.LOCK_EX)
+		return self
+
+	def __exit__ (self, *args):
+		if sys.platform == "win32":
+			import msvcrt
+			self.fp.seek (0)
+			msvcrt.locking (self.fp.fileno (), msvcrt.LK_UNLCK, 1)
+		else:
+			import fcntl
+			fcntl.flock (self.fp.fileno (), fcntl.LOCK_UN)
+		self.fp.close ()
+
+	#-- JSON dict of the file ({} if it doesn't exist or it is invalid)
+	def readJson (filename):
+		try:
+			with open (filename) as fp:
+				return json.load (fp)
+		except (OSError, ValueError):
+			return {}
+
+	#-- Written to a temporary file first: readers never see it half written
+	def writeJson (filename, data):
+		with open (f"{filename}.{os.getpid ()}", "w") as fp:
+			json.dump (data, fp, indent=4)
+		os.replace (f"{filename}.{os.getpid ()}", filename)
+
+#--------------------------------------------------------------------
+# Option lists of ECUAPASS combo boxes, learned while iterating them
+# and saved by ECUAPASS version. Known options are selected going to
+# their index; an option not found there drops the field list.
+#--------------------------------------------------------------------
+class EcuCombos:
+	versions = None      # ECUAPASS version : {combo field name : option texts in order}
+
+	def getFilename ():
+		return EcuConfig.getDataPath ("ecuapass-combos-cache.json")
+
+	#-- Option lists of the current ECUAPASS version
+	def getOptions ():
+		if EcuCombos.versions is None:
+			EcuCombos.versions = EcuFileLock.readJson (EcuCombos.getFilename ())
+		return EcuCombos.versions.setdefault (EcuCombos.getVersion (), {})
+
+	def getVersion ():
+		return EcuConfig.get ("ecuapassVersion", ECUAPASS_VERSION)
+
+	#-- Change the options of a field in the file as saved by other processes
+	#-- (read-merge-write): 'change' gets the field options and returns the new ones (None drops them)
+	def update (fieldName, change):
+		filename = EcuCombos.getFilename ()
+		with EcuFileLock (filename):
+			versions = EcuFileLock.readJson (filename)
+			options  = versions.setdefault (EcuCombos.getVersion (), {})
+			newOptions = change (options.get (fieldName, []))
+			if newOptions is None:
+				options.pop (fieldName, None)
+			else:
+				options [fieldName] = newOptions
+			EcuFileLock.writeJson (filename, versions)
+		EcuCombos.versions = versions
+
+	#-- Index of the first known option containing the text (None if unknown)
+	def getIndex (fieldName, fieldText):
+		for i, option in enumerate (EcuCombos.getOptions ().get (fieldName, [])):
+			if fieldText.upper () in option.upper ():
+				return i
+		return None
+
+	#-- Options read from the first one. Keeps the longest list read.
+	#-- A list with empty texts (failed reads) is not kept: its indexes would be wrong.
+	def addOptions (fieldName, options):
+		if "" in options:
+			return
+		if len (options) > len (EcuCombos.getOptions ().get (fieldName, [])):
+			EcuCombos.update (fieldName, lambda known: options if len (options) > len (known) else known)
+
+	def dropOptions (fieldName):
+		if fieldName in EcuCombos.getOptions ():
+			EcuCombos.update (fieldName, lambda known: None)
+
+#--------------------------------------------------------------------
+# Checkpoints of forms left partially filled: the last field filled
+# (and its section) when a fill fails, saved by RESULTS file. A fill
+# in resume mode keeps the form and continues after that field.
+#--------------------------------------------------------------------
+class EcuCheckpoints:
+	lock        = threading_Lock ()    # Checkpoints of RESULTS file path : {"field", "section", "error", "time"}
+
+	def getFilename ():
+		return EcuConfig.getDataPath ("ecuapass-bot-checkpoints.json")
+
+	#-- Read from the file each time: sessions in other processes update it
+	def getAll ():
+		with EcuCheckpoints.lock:
+			return EcuFileLock.readJson (EcuCheckpoints.getFilename ())
+
+	def get (jsonFilepath):
+		return EcuCheckpoints.getAll ().get (os.path.abspath (jsonFilepath))
+
+	#-- Save the progress of a failed fill (nothing if no field was filled)
+	def save (jsonFilepath, progress, error):
+		if not progress.get ("field"):
+			return
+		checkpoint = dict (progress, error=str (error), time=datetime.now ().strftime ("%Y-%m-%d %H:%M:%S"))
+		EcuCheckpoints.update (os.path.abspath (jsonFilepath), checkpoint)
+
+	def drop (jsonFilepath):
+		EcuCheckpoints.update (os.path.abspath (jsonFilepath), None)
+
+	#-- Read-merge-write: keeps the checkpoints saved by other processes
+	def update (path, checkpoint):
+		filename = EcuCheckpoints.getFilename ()
+		with EcuCheckpoints.lock, EcuFileLock (filename):
+			checkpoints = EcuFileLock.readJson (filename)
+			if checkpoint is None and path not in checkpoints:
+				return
+			if checkpoint is None:
+				del checkpoints [path]
+			else:
+				checkpoints [path] = checkpoint
+			EcuFileLock.writeJson (filename, checkpoints)
+
+#--------------------------------------------------------------------
+# Input/screen drivers of the bot: keys, mouse, clipboard, screen and
+# windows. The default driver uses pyautogui and pyperclip; the fake
+# driver runs headless (benchmarks, CI). Each thread can set its own
+# driver (e.g. one bot session per thread), the others use the default.
+#--------------------------------------------------------------------
+class EcuDriver:
+	local   = threading_local ()
+	default = None
+	lock    = threading_Lock ()
+
+	#-- Driver of the current thread or the default one ("botDriver": "pyautogui" or "fake")
+	def get ():
+		driver = getattr (EcuDriver.local, "driver", None)
+		if driver is not None:
+			return driver
+		with EcuDriver.lock:
+			if EcuDriver.default is None:
+				name = EcuConfig.get ("botDriver", BOT_DRIVER)
+				EcuDriver.default = EcuFakeDriver () if name == "fake" else EcuPyDriver ()
+			return EcuDriver.default
+
+	#-- Set the driver of the current thread (None: back to the default one)
+	def set (driver):
+		EcuDriver.local.driver = driver
+		return driver
+
+#-- Driver of the desktop with pyautogui (keys, mouse, screen, windows) and pyperclip
+class EcuPyDriver:
+	hasScreen = True    # Screenshots are real images (template matching)
+	isFake    = False
+
+	def __init__ (self):
+		import pyautogui, pyperclip
+		self.py        = pyautogui
+		self.pyperclip = pyperclip
+
+	def setPause (self, secs):
+		self.py.PAUSE = secs
+
+	def clock (self):
+		return time.monotonic ()
+
+	def sleep (self, secs):
+		time.sleep (secs)
+
+	def press (self, key, presses=1, interval=0):
+		self.py.press (key, presses=presses, interval=interval)
+
+	def hotkey (self, *keys):
+		self.py.hotkey (*keys)
+
+	def keyDown (self, key):
+		self.py.keyDown (key)
+
+	def keyUp (self, key):
+		self.py.keyUp (key)
+
+	def scroll (self, amount):
+		self.py.scroll (amount)
+
+	def click (self, x, y):
+		self.py.click (x, y)
+
+	def size (self):
+		return self.py.size ()
+
+	def copy (self, text):
+		self.pyperclip.copy (text)
+
+	def paste (self):
+		return self.pyperclip.paste ()
+
+	def screenshot (self, region=None):
+		return self.py.screenshot (region=region)
+
+	#-- Grayscale pixels of a screen region (left, top, width, height) or full screen
+	def snap (self, region=None):
+		return self.screenshot (region).convert ("L").tobytes ()
+
+	def locateOnScreen (self, imagePath, confidence=0.8, region=None):
+		return self.py.locateOnScreen (imagePath, region=region, confidence=confidence, grayscale=True)
+
+	#-- pyautogui lists windows only on Windows: X displays use xdotool
+	def getWindows (self, title=None):
+		if hasattr (self.py, "getAllWindows"):
+			return self.py.getAllWindows ()
+		return EcuX11Window.getWindows (title)
+
+#-- Window of the X display of the process (DISPLAY, set by its bot session)
+#-- found and managed with xdotool. Same attributes of pyautogui windows.
+class EcuX11Window:
+	TIMEOUT = 5      # Max secs of an xdotool call
+
+	def __init__ (self, winId, title):
+		self.winId = winId
+		self.title = title
+		self.left = self.top = self.width = self.height = 0
+		self.update ()
+
+	#-- Output of the xdotool command ("" if it fails)
+	def xdotool (*args):
+		result = subprocess_run (["xdotool"] + [str (x) for x in args], capture_output=True, text=True,
+		                         timeout=EcuX11Window.TIMEOUT)
+		return result.stdout.strip () if result.returncode == 0 else ""
+
+	#-- Visible windows whose title contains 'title' (all if None)
+	def getWindows (title=None):
+		try:
+			pattern = re.sub (r"([][.^$*+?(){}|\\])", r"\\\1", title) if title else "."    # POSIX regex
+			winIds  = EcuX11Window.xdotool ("search", "--onlyvisible", "--name", pattern).split ()
+			return [EcuX11Window (x, EcuX11Window.xdotool ("getwindowname", x)) for x in winIds]
+		except (OSError, subprocess_TimeoutExpired) as ex:
+			EcuBot.printx (f"EXCEPCION: Buscando ventanas con 'xdotool' en '{os.environ.get ('DISPLAY')}': {ex}")
+			return []
+
+	#-- Position and size of the window
+	def update (self):
+		geometry = dict (x.split ("=") for x in EcuX11Window.xdotool ("getwindowgeometry", "--shell", self.winId).split ())
+		self.left, self.top     = int (geometry.get ("X", 0)), int (geometry.get ("Y", 0))
+		self.width, self.height = int (geometry.get ("WIDTH", 0)), int (geometry.get ("HEIGHT", 0))
+
+	@property
+	def isActive (self):
+		return EcuX11Window.xdotool ("getactivewindow") == self.winId
+
+	#-- As wide as the display (the height leaves space for panels)
+	@property
+	def isMaximized (self):
+		width, height = [int (x) for x in EcuX11Window.xdotool ("getdisplaygeometry").split ()]
+		return self.width >= width and self.height >= 0.9 * height
+
+	def activate (self):
+		EcuX11Window.xdotool ("windowactivate", "--sync", self.winId)
+
+	def maximize (self):
+		EcuX11Window.xdotool ("windowmove", "--sync", self.winId, 0, 0)
+		EcuX11Window.xdotool ("windowsize", "--sync", self.winId, "100%", "100%")
+		self.update ()
+
+	def moveTo (self, x, y):
+		EcuX11Window.xdotool ("windowmove", "--sync", self.winId, x, y)
+		self.update ()
+
+#--------------------------------------------------------------------
+# Headless driver: records every action with its time in a virtual
+# clock (sleeps, key intervals and the pause after each input call,
+# as pyautogui PAUSE, advance it: nothing waits) and simulates the
+# ECUAPASS form of EcuPlan.LAYOUT (drawn in screenshots with PIL):
+# Tab moves the focus, clicks on the clear button or
+# the page title focus the page start (some Tabs before the first
+# field), ctrl+v/ctrl+c paste and copy the focused widget text and combo
+# boxes select options with down/up. As the ECUAPASS combos, a pasted
+# text filters the list to the options containing it and opens it
+# below the field until enter or Tab: down selects the first one and
+# down/up move inside the filtered list until the text is erased.
+# Combos without given options take any text.
+#--------------------------------------------------------------------
+class EcuFakeDriver:
+	hasScreen = False    # Screenshots only show the form (no template matching)
+	isFake    = True     # Its fills are not recorded in the ledger
+	COMBOS    = ["box", "boxIter", "condTransporte", "condPago", "embalaje"]
+
+	START_TABS = {"ClearButton": 2, "CartaporteCarretera": 2}    # Image clicked : Tabs to the first field
+
+	#-- options: {field : combo option texts}. keyTime: secs taken by each key.
+	#-- startTabs: focus after clicking an image, Tabs before the first field (START_TABS)
+	def __init__ (self, options=None, keyTime=0.0, size=(1920, 1080), startTabs=None):
+		self.options   = options or {}
+		self.keyTime   = keyTime
+		self.startTabs = dict (EcuFakeDriver.START_TABS, **(startTabs or {}))
+		self.width, self.height = size
+		self.widgets   = {x [2] : (x [0], x [1]) for x in EcuPlan.LAYOUT}   # Tab index : (field, widget)
+		self.actions   = []     # (secs, action, args)
+		self.now       = 0.0
+		self.pause     = 0.0    # Secs after each input call (setPause)
+		self.calls     = 0      # Input calls (pyautogui calls)
+		self.clipboard = ""
+		self.held      = set ()
+		self.frame     = 0      # Changes with each input, read by 'snap'
+		self.lastImage = ""     # Last image located (clicks target it)
+		self.focus     = -self.startTabs ["ClearButton"]    # Tab index of the focused widget
+		self.clearForm ()
+
+	def clearForm (self):
+		self.values   = {}      # Field : {"value", "index", "typed", "matches"}
+		self.openList = None    # Field of the combo with its list open
+
+	def record (self, action, *args):
+		self.actions.append ((round (self.now, 4), action, args))
+		self.frame += 1
+
+	def setPause (self, secs):
+		self.record ("pause", secs)
+		self.pause = secs
+
+	def clock (self):
+		return self.now
+
+	def sleep (self, secs):
+		self.now += secs
+
+	#-- As pyautogui, each input call waits 'pause' secs after it
+	def endCall (self):
+		self.calls += 1
+		self.now   += self.pause
+
+	def press (self, key, presses=1, interval=0):
+		self.record ("press", key, presses)
+		for i in range (presses):
+			self.pressKey (key)
+			self.now += self.keyTime + interval
+		self.endCall ()
+
+	#-- One call (its keys recorded as keyDown, press, keyUp)
+	def hotkey (self, *keys):
+		pause, calls, self.pause = self.pause, self.calls, 0
+		try:
+			for key in keys [:-1]:
+				self.keyDown (key)
+			self.press (keys [-1])
+			for key in reversed (keys [:-1]):
+				self.keyUp (key)
+		finally:
+			self.pause, self.calls = pause, calls
+		self.endCall ()
+
+	def keyDown (self, key):
+		self.record ("keyDown", key)
+		self.held.add (key.lower ())
+		self.endCall ()
+
+	def keyUp (self, key):
+		self.record ("keyUp", key)
+		self.held.discard (key.lower ())
+		self.endCall ()
+
+	def scroll (self, amount):
+		self.record ("scroll", amount)
+		self.endCall ()
+
+	#-- A click on an image of 'startTabs' focuses it (Tabs before the first field).
+	#-- On the clear button it also clears the form.
+	def click (self, x, y):
+		self.record ("click", x, y)
+		self.endCall ()
+		for image, tabs in self.startTabs.items ():
+			if image in self.lastImage:
+				self.focus = -tabs
+		if "ClearButton" in self.lastImage:
+			self.clearForm ()
+
+	def size (self):
+		return (self.width, self.height)
+
+	def copy (self, text):
+		self.clipboard = text
+
+	def paste (self):
+		return self.clipboard
+
+	#-- Form drawn with PIL: a row per widget (12 pixels) with its field name and value.
+	#-- An open combo list covers the rows below its field (the selected option marked).
+	def screenshot (self, region=None):
+		from PIL import Image, ImageDraw
+		left, top, width, height = region or (0, 0, self.width, self.height)
+		image = Image.new ("L", (width, height), 255)
+		draw  = ImageDraw.Draw (image)
+		for tab, (field, widget) in self.widgets.items ():
+			y = 10 + 12 * tab - top
+			if -12 < y < height:
+				draw.text ((10 - left, y), field, fill=0)
+				draw.text ((300 - left, y), self.values.get (field, {}).get ("value", ""), fill=0)
+		if self.openList:
+			tab   = next (x for x, (field, widget) in self.widgets.items () if field == self.openList)
+			state = self.values [self.openList]
+			y     = 10 + 12 * (tab + 1) + 2 - top    # Below the field text (its glyphs reach the next row)
+			draw.rectangle ((296 - left, y - 1, 600 - left, y + 12 * len (self.getShown (state)) + 2), fill=255, outline=0)
+			for i in self.getShown (state):
+				marker = "> " if i == state ["index"] else "  "
+				draw.text ((300 - left, y), marker + self.options [self.openList][i], fill=0)
+				y += 12
+		return image
+
+	def snap (self, region=None):
+		return str (self.frame).encode ()
+
+	#-- Every image is found at the screen center
+	def locateOnScreen (self, imagePath, confidence=0.8, region=None):
+		self.lastImage = os.path.basename (imagePath)
+		self.record ("locate", self.lastImage)
+		return EcuLocator.Box (self.width // 2, self.height // 2, 1, 1)
+
+	def getWindows (self, title=None):
+		return [EcuFakeWindow (self)]
+
+	#-- Field values of the simulated form
+	def getValues (self):
+		return {field : state ["value"] for field, state in self.values.items () if state ["value"]}
+
+	def getStats (self):
+		presses = [x for x in self.actions if x [1] == "press"]
+		return {"actions": len (self.actions), "calls": self.calls, "keys": sum (x [2][1] for x in presses),
+		        "secs": round (self.now, 3), "fields": len (self.getValues ())}
+
+	#-- Key effect on the focused widget
+	def pressKey (self, key):
+		key = key.lower ()
+		if key in ["tab", "enter"]:
+			self.openList = None
+		if key == "tab":
+			self.focus += -1 if "shift" in self.held else 1
+			return
+
+		field, widget = self.widgets.get (self.focus, (None, None))
+		if field is None:
+			return
+		state   = self.values.setdefault (field, {"value": "", "index": -1, "typed": None, "matches": None})
+		options = self.options.get (field, [])
+		if "ctrl" in self.held:
+			if key == "c" and state ["value"]:
+				self.clipboard = state ["value"]
+			elif key == "v":
+				state ["value"] = state ["typed"] = self.clipboard
+				state ["matches"] = None
+				if widget in EcuFakeDriver.COMBOS and options:
+					self.openList = field
+		elif key == "backspace":
+			state ["value"], state ["typed"], state ["matches"] = "", None, None
+			self.openList = None
+		elif widget in EcuFakeDriver.COMBOS and key in ["down", "up"]:
+			self.moveCombo (state, options, key)
+
+	#-- A typed text filters the options (the first one containing it is selected).
+	#-- Then down/up select the next/previous option of the filtered (or full) list.
+	def moveCombo (self, state, options, key):
+		typed, state ["typed"] = state ["typed"], None
+		if typed:
+			state ["matches"] = [i for i, x in enumerate (options) if typed.upper () in x.upper ()]
+			if state ["matches"]:
+				state ["index"], state ["value"] = state ["matches"][0], options [state ["matches"][0]]
+			elif not options:
+				state ["value"] = typed
+			return
+
+		shown = self.getShown (state, options)
+		if shown:
+			step = 1 if key == "down" else -1
+			pos  = shown.index (state ["index"]) + step if state ["index"] in shown else 0
+			state ["index"] = shown [min (max (pos, 0), len (shown) - 1)]
+			state ["value"] = options [state ["index"]]
+
+	#-- Indexes of the options listed: containing the typed text, else the filtered (or full) list
+	def getShown (self, state, options=None):
+		options = self.options.get (self.openList, []) if options is None else options
+		if state ["typed"]:
+			return [i for i, x in enumerate (options) if state ["typed"].upper () in x.upper ()]
+		return state ["matches"] if state ["matches"] is not None else list (range (len (options)))
+
+#-- ECUAPASS window of the fake driver (always active and maximized)
+class EcuFakeWindow:
+	def __init__ (self, driver):
+		self.driver      = driver
+		self.title       = 'ECUAPASS - SENAE browser'
+		self.left, self.top = 0, 0
+		self.width, self.height = driver.size ()
+		self.isActive    = True
+		self.isMaximized = True
+
+	def activate (self):
+		self.driver.record ("activate")
+
+	def maximize (self):
+		self.driver.record ("maximize")
+
+	def moveTo (self, x, y):
+		self.left, self.top = x, y
+
+#--------------------------------------------------------------------
+# Input engine for EcuBot: a key sequence is sent in one driver
+# call (pyautogui waits PAUSE secs after each call) with a delay
+# between keys set by field type. Records keystroke time per form.
+#--------------------------------------------------------------------
+class EcuInput:
+	local    = threading_local ()     # Form stats of each thread (session)
+	COUNTERS = ["calls", "keys", "time", "clipboard", "screen", "locates", "retries"]
+
+	#-- Reset the form stats and the driver pause
+	def startForm ():
+		EcuDriver.get ().setPause (EcuConfig.get ("inputPause", INPUT_PAUSE))
+		EcuInput.local.stats = dict.fromkeys (EcuInput.COUNTERS, 0)
+
+	def getStats ():
+		stats = getattr (EcuInput.local, "stats", None) or dict.fromkeys (EcuInput.COUNTERS, 0)
+		return dict (stats, time=round (stats ["time"], 3))
+
+	#-- Count a form event: "clipboard" (copy round-trip), "screen" (region hash), "locates" (template match) or "retries"
+	def count (name, n=1):
+		stats = getattr (EcuInput.local, "stats", None)
+		if stats is not None:
+			stats [name] += n
+
+	#-- Secs between keys for the field type ("key", "text", "box", "date", "scroll")
+	def getDelay (ftype):
+		return EcuConfig.get ("inputDelays", {}).get (ftype, INPUT_DELAYS [ftype])
+
+	#-- Press key n times
+	def press (key, n=1, ftype="key"):
+		driver    = EcuDriver.get ()
+		startTime = driver.clock ()
+		driver.press (key, presses=n, interval=EcuInput.getDelay (ftype))
+		EcuInput.addStats (startTime, n)
+
+	#-- Press the last key n times while holding the others (e.g. "shift", "Tab")
+	def hotkey (*keys, n=1, ftype="key"):
+		driver    = EcuDriver.get ()
+		delay     = EcuInput.getDelay (ftype)
+		startTime = driver.clock ()
+		if n == 1:
+			driver.hotkey (*keys)
+			driver.sleep (delay)
+		else:
+			for key in keys [:-1]:
+				driver.keyDown (key)
+			try:
+				driver.press (keys [-1], presses=n, interval=delay)
+			finally:
+				for key in reversed (keys [:-1]):
+					driver.keyUp (key)
+		EcuInput.addStats (startTime, n * len (keys))
+
+	def scroll (amount, n=1):
+		driver    = EcuDriver.get ()
+		delay     = EcuInput.getDelay ("scroll")
+		startTime = driver.clock ()
+		for i in range (n):
+			driver.scroll (amount)
+			driver.sleep (delay)
+		EcuInput.addStats (startTime, n)
+
+	def addStats (startTime, nKeys):
+		stats = EcuInput.local.stats
+		stats ["calls"] += 1
+		stats ["keys"]  += nKeys
+		stats ["time"]  += EcuDriver.get ().clock () - startTime
+
+#--------------------------------------------------------------------
+# Waits for the ECUAPASS browser instead of fixed sleeps: a screen
+# region or the clipboard is polled until the expected change, or
+# until a timeout (the max time the old sleeps waited, if any).
+#--------------------------------------------------------------------
+class EcuWait:
+	SENTINEL = "<ecuapass-bot-nothing-copied>"
+
+	#-- Poll condition until it is true (True) or timeout secs pass (False)
+	def until (condition, timeout=None, interval=None):
+		driver   = EcuDriver.get ()
+		timeout  = EcuConfig.get ("botWaitTimeout", BOT_WAIT_TIMEOUT) if timeout is None else timeout
+		interval = interval or EcuConfig.get ("botWaitInterval", BOT_WAIT_INTERVAL)
+		endTime  = driver.clock () + timeout
+		while not condition ():
+			if driver.clock () >= endTime:
+				return False
+			driver.sleep (interval)
+		return True
+
+	#-- Grayscale pixels of a screen region (left, top, width, height) or full screen
+	def snap (region=None):
+		return EcuDriver.get ().snap (region)
+
+	#-- Wait until the region differs from a snap taken before the action
+	def forChange (before, region=None, timeout=None):
+		return EcuWait.until (lambda: EcuWait.snap (region) != before, timeout)
+
+	#-- Wait until the region stops changing (e.g. after scrolling or typing)
+	def forStable (region=None, timeout=None):
+		last = [None]
+		def isStable ():
+			current = EcuWait.snap (region)
+			isSame, last [0] = current == last [0], current
+			return isSame
+		return EcuWait.until (isStable, timeout)
+
+	#-- Copy (ctrl+c) and wait for the text in the clipboard. None if nothing was copied.
+	def copyText (ftype="key"):
+		driver = EcuDriver.get ()
+		copied = [None]
+		def isCopied ():
+			copied [0] = driver.paste ()
+			return copied [0] != EcuWait.SENTINEL
+
+		driver.copy (EcuWait.SENTINEL)
+		EcuInput.hotkey ("ctrl", "c", ftype=ftype)
+		EcuInput.count ("clipboard")
+		if EcuWait.until (isCopied, EcuConfig.get ("botWaitClipboard", BOT_WAIT_CLIPBOARD)):
+			return copied [0]
+		return None
+
+#--------------------------------------------------------------------
+# Verification of field input on screen instead of the clipboard:
+# the field region is found the first time by diffing the screen
+# before and after pasting (the first rows changed, not the combo list
+# opened below; then remembered by field name), and an
+# input is taken as accepted if the difference hash (dHash) of the
+# region changes. Without PIL or a region the clipboard is used.
+#--------------------------------------------------------------------
+class EcuVerify:
+	regions = {}      # Field name : screen region (left, top, width, height)
+
+	#-- Difference hash of a region scaled down: a bit per pixel brighter than its right neighbor
+	def hash (region):
+		scale  = EcuConfig.get ("verifyHashScale", VERIFY_HASH_SCALE)
+		cols   = max (int (region [2] * scale), 2)
+		rows   = max (int (region [3] * scale), 1)
+		image  = EcuDriver.get ().screenshot (region).convert ("L").resize ((cols + 1, rows))
+		pixels = image.tobytes ()
+		bits   = 0
+		for row in range (rows):
+			for col in range (cols):
+				bits = bits << 1 | (pixels [row * (cols + 1) + col] > pixels [row * (cols + 1) + col + 1])
+		EcuInput.count ("screen")
+		return bits
+
+	def isChanged (hash1, hash2):
+		return bin (hash1 ^ hash2).count ("1") >= EcuConfig.get ("verifyDistance", VERIFY_DISTANCE)
+
+	#-- Paste (ctrl+v) in the focused field and return its region (None if it can't be found)
+	def paste (fieldName, ftype="key"):
+		try:
+			from PIL import ImageChops
+			region = EcuVerify.regions.get (fieldName)
+			before = EcuVerify.hash (region) if region else None
+			screen = None if region else EcuDriver.get ().screenshot ().convert ("L")
+		except Exception as ex:
+			EcuBot.printx (f"Verificación en pantalla no disponible: {ex}")
+			EcuInput.hotkey ("ctrl", "v", ftype=ftype)
+			return None
+
+		EcuInput.hotkey ("ctrl", "v", ftype=ftype)
+		timeout = EcuConfig.get ("verifyTimeout", VERIFY_TIMEOUT)
+		if region and EcuWait.until (lambda: EcuVerify.isChanged (EcuVerify.hash (region), before), timeout):
+			return region
+		if screen is None:      # Field moved: found again
+			EcuVerify.regions.pop (fieldName, None)
+			return None
+
+		diff = [None]
+		def isFound ():
+			diff [0] = ImageChops.difference (screen, EcuDriver.get ().screenshot ().convert ("L"))
+			return diff [0].getbbox () is not None
+		if not EcuWait.until (isFound, timeout):
+			return None
+		left, top, right, bottom = EcuVerify.getFieldBox (diff [0])
+		width = max (right - left, EcuConfig.get ("verifyFieldWidth", VERIFY_FIELD_WIDTH))
+		EcuVerify.regions [fieldName] = (max (left - 4, 0), max (top - 2, 0), width + 8, bottom - top + 4)
+		return EcuVerify.regions [fieldName]
+
+	#-- Box of the field text in the screen difference: its first rows changed (up to a
+	#-- blank row or the max field height), not the combo list opened below it
+	def getFieldBox (diff):
+		left, top, right, bottom = diff.getbbox ()
+		maxBottom = min (bottom, top + EcuConfig.get ("verifyFieldHeight", VERIFY_FIELD_HEIGHT))
+		bottom    = top + 1
+		while bottom < maxBottom and diff.crop ((left, bottom, right, bottom + 1)).getbbox ():
+			bottom += 1
+		left, _, right, _ = diff.crop ((0, top, diff.width, bottom)).getbbox ()
+		return (left, top, right, bottom)
+
+	#-- Region of the field or else the box of the fields found in its section (same scroll).
+	#-- None if none was found (waits poll the full screen)
+	def getRegion (fieldName):
+		if fieldName in EcuVerify.regions:
+			return EcuVerify.regions [fieldName]
+		entry   = next ((x for x in EcuPlan.LAYOUT if x [0] == fieldName), None)
+		regions = [EcuVerify.regions [x [0]] for x in EcuPlan.LAYOUT if entry and x [0] in EcuVerify.regions
+		           and x [3] == entry [3] and x [4] == entry [4]]
+		if not regions:
+			return None
+		left, top = min (x [0] for x in regions), min (x [1] for x in regions)
+		right, bottom = max (x [0] + x [2] for x in regions), max (x [1] + x [3] for x in regions)
+		return (left, top, right - left, bottom - top)
+
+	#-- Press the key and tell if the field region changes
+	def pressChanges (region, key, ftype="key"):
+		before = EcuVerify.hash (region)
+		EcuInput.press (key, ftype=ftype)
+		return EcuWait.until (lambda: EcuVerify.isChanged (EcuVerify.hash (region), before),
+		                      EcuConfig.get ("verifyTimeout", VERIFY_TIMEOUT))
+
+#--------------------------------------------------------------------
+# Template matching for the bot with OpenCV: templates are decoded
+# once in grayscale, a screenshot can be reused by several locates,
+# the box where a template was last found is searched before the
+# full screen, and an optional downscaled search (pyramid) finds
+# candidates checked at full size. Without OpenCV (or a driver
+# screen), the driver 'locateOnScreen' is used.
+#--------------------------------------------------------------------
+class EcuLocator:
+	Box       = collections_namedtuple ("Box", "left top width height")
+	templates = {}      # Image path : grayscale template
+	regions   = {}      # Image path : box where it was last found
+	screen    = None    # Last grayscale screenshot
+	stats     = {"locates": 0, "regionHits": 0, "time": 0}
+
+	#-- Take the screenshot used by the next locates (None without OpenCV)
+	def grab ():
+		try:
+			import numpy, cv2
+		except ImportError:
+			return None
+		EcuLocator.screen = cv2.cvtColor (numpy.array (EcuDriver.get ().screenshot ()), cv2.COLOR_RGB2GRAY)
+		return EcuLocator.screen
+
+	#-- Box of the image on screen or None. Set 'grab' False to reuse the last screenshot.
+	def locate (imagePath, confidence=0.8, region=None, grab=True):
+		driver = EcuDriver.get ()
+		EcuInput.count ("locates")
+		try:
+			import cv2
+		except ImportError:
+			cv2 = None
+		if cv2 is None or not driver.hasScreen:
+			return driver.locateOnScreen (imagePath, confidence, region)
+
+		startTime = time.monotonic ()
+		screen    = EcuLocator.grab () if grab or EcuLocator.screen is None else EcuLocator.screen
+		template  = EcuLocator.getTemplate (imagePath)
+
+		box, lastBox = None, EcuLocator.regions.get (imagePath)
+		if lastBox and region is None:
+			margin = EcuConfig.get ("locatorMargin", LOCATOR_MARGIN)
+			box = EcuLocator.match (screen, template, confidence, EcuLocator.expand (lastBox, margin))
+			EcuLocator.stats ["regionHits"] += box is not None
+		if box is None:
+			box = EcuLocator.match (screen, template, confidence, region,
+			                        EcuConfig.get ("locatorScale", LOCATOR_SCALE))
+		if box is not None:
+			EcuLocator.regions [imagePath] = box
+
+		EcuLocator.stats ["locates"] += 1
+		EcuLocator.stats ["time"]    += time.monotonic () - startTime
+		return box
+
+	#-- Center (x, y) of the image on screen or None
+	def locateCenter (imagePath, confidence=0.8, region=None, grab=True):
+		box = EcuLocator.locate (imagePath, confidence, region, grab)
+		if box is None:
+			return None
+		return (box.left + box.width // 2, box.top + box.height // 2)
+
+	def getTemplate (imagePath):
+		import cv2
+		template = EcuLocator.templates.get (imagePath)
+		if template is None:
+			template = cv2.imread (imagePath, cv2.IMREAD_GRAYSCALE)
+			if template is None:
+				raise Exception (f"No se pudo leer la imagen '{imagePath}'")
+			EcuLocator.templates [imagePath] = template
+		return template
+
+	#-- Best match of template in the screen region (left, top, width, height).
+	#-- With scale < 1 the candidate of a downscaled search is checked at full size
+	#-- (if it isn't the template, the region is searched at full size).
+	def match (screen, template, confidence, region=None, scale=1.0):
+		import cv2
+		left, top = 0, 0
+		if region is not None:
+			left, top, width, height = [int (x) for x in region]
+			left, top = max (left, 0), max (top, 0)
+			screen = screen [top : top+height, left : left+width]
+		height, width = template.shape
+		if screen.shape [0] < height or screen.shape [1] < width:
+			return None
+
+		if scale < 1:
+			small  = cv2.resize (screen, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+			smallT = cv2.resize (template, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+			if min (smallT.shape) > 0:
+				_, _, _, (x, y) = cv2.minMaxLoc (cv2.matchTemplate (small, smallT, cv2.TM_CCOEFF_NORMED))
+				candidate = EcuLocator.expand ((x / scale, y / scale, width, height), int (2 / scale))
+				box = EcuLocator.match (screen, template, confidence, candidate)
+				if box is not None:
+					return EcuLocator.Box (box.left + left, box.top + top, width, height)
+
+		_, maxValue, _, (x, y) = cv2.minMaxLoc (cv2.matchTemplate (screen, template, cv2.TM_CCOEFF_NORMED))
+		if maxValue < confidence:
+			return None
+		return EcuLocator.Box (left + x, top + y, width, height)
+
+	def expand (box, margin):
+		return (box [0] - margin, box [1] - margin, box [2] + 2*margin, box [3] + 2*margin)
+
+	def getStats ():
+		stats = EcuLocator.stats
+		meanTime = stats ["time"] / stats ["locates"] if stats ["locates"] else 0
+		return dict (stats, time=round (stats ["time"], 3), meanTime=round (meanTime, 4))
+
+	#-- Mean locate secs of each image on recorded screenshots (files):
+	#-- pyautogui (template loaded each time), full screen, remembered region and pyramid
+	def benchmark (screenshots, images, repeats=10):
+		import cv2
+		try:
+			import pyautogui
+		except Exception:
+			pyautogui = None
+		scale   = EcuConfig.get ("locatorScale", LOCATOR_SCALE)
+		scale   = scale if scale < 1 else 0.5
+		margin  = EcuConfig.get ("locatorMargin", LOCATOR_MARGIN)
+		results = []
+		for screenshot in screenshots:
+			screen = cv2.imread (screenshot, cv2.IMREAD_GRAYSCALE)
+			for image in images:
+				template = EcuLocator.getTemplate (image)
+				box      = EcuLocator.match (screen, template, 0.8)
+				tests    = {"fullScreen": lambda: EcuLocator.match (screen, template, 0.8),
+				            "pyramid"   : lambda: EcuLocator.match (screen, template, 0.8, None, scale)}
+				if box is not None:
+					tests ["region"] = lambda: EcuLocator.match (screen, template, 0.8, EcuLocator.expand (box, margin))
+				if pyautogui is not None:
+					tests ["pyautogui"] = lambda: pyautogui.locate (image, screenshot, confidence=0.8, grayscale=True)
+
+				times = {}
+				for name, test in tests.items ():
+					startTime = time.monotonic ()
+					for i in range (repeats):
+						test ()
+					times [name] = round ((time.monotonic () - startTime) / repeats, 4)
+				results.append ({"screenshot": screenshot, "image": image, "found": box, "secs": times})
+		return results
+
 #--------------------------------------------------------------------
 # Utility function used in EcuBot class
 #--------------------------------------------------------------------
@@ -1448,7 +4380,7 @@ class Utils:
 	#-- Detect and activate ECUAPASS window
 	def activateEcuapassWindow ():
 		EcuBot.printx ("Detectando ventana del ECUAPASS...")
-		windows = py.getAllWindows ()
+		windows = EcuDriver.get ().getWindows ('ECUAPASS - SENAE browser')
 		ecuWin = None
 		for win in windows:
 			if win.title == 'ECUAPASS - SENAE browser':
@@ -1471,28 +4403,48 @@ class Utils:
 		EcuBot.printx ("\tWin info:", Utils.getWinInfo (win))
 		win.moveTo (0,0)
 
-		xy = py.locateCenterOnScreen (Utils.imagePath ("image-windows-WindowButtons.png"),
-					confidence=0.8, grayscale=True, 
-					region=(win.left, win.top, win.width, win.height))
+		xy = EcuLocator.locateCenter (Utils.imagePath ("image-windows-WindowButtons.png"),
+					confidence=0.8, region=(win.left, win.top, win.width, win.height))
 		if Utils.checkError (xy, "ERROR:No se localizó botón de maximizar la ventana"):
 			return Utils.message
 
-		py.click (xy[0], xy[1])
+		EcuDriver.get ().click (xy[0], xy[1])
 
-		w, h = py.size ()
+		w, h = EcuDriver.get ().size ()
 		win.left = win.top = 0
 		win.width = w
 
-	#-- Clear previous webpage content
-	def clearWebpageContent ():
-		EcuBot.printx ("Localizando botón de borrado...")
-		xy = py.locateCenterOnScreen (Utils.imagePath ("image-field-ClearButton.png"), 
-				confidence=0.8, grayscale=True)
+	#-- Clear previous webpage content. The button is located if its center 'xy' is not
+	#-- given (in the last screenshot of the locator if 'grab' is False).
+	def clearWebpageContent (xy=None, grab=True):
+		if xy is None:
+			EcuBot.printx ("Localizando botón de borrado...")
+			xy = EcuLocator.locateCenter (Utils.imagePath ("image-field-ClearButton.png"), 
+					confidence=0.8, grab=grab)
 		if Utils.checkError (xy, "No se detectó botón de borrado"):
 			return Utils.message
 
-		py.click (xy[0], xy[1], interval=1)    
+		# The fields of the first section are cleared
+		region = EcuVerify.getRegion (EcuPlan.LAYOUT [0][0])
+		before = EcuWait.snap (region)
+		EcuDriver.get ().click (xy[0], xy[1])
+		EcuWait.forChange (before, region, timeout=1)
+
+		return xy
+
+	#-- Focus the page start without clearing the form: scroll to the top and
+	#-- click the page title (focus "botTitleTabs" Tabs before the first field)
+	def focusFormStart ():
+		EcuBot.printx ("Localizando inicio del formulario...")
+		Utils.scrollN (sum (abs (x [1]) for x in EcuPlan.getPlan () if x [0] == "scroll"), direction="up",
+		               region=EcuVerify.getRegion (EcuPlan.LAYOUT [0][0]))
+		imagePath = Utils.imagePath ("image-text-CartaporteCarretera.png")
+		xy = EcuLocator.locateCenter (imagePath, confidence=0.8)
+		if Utils.checkError (xy, "ERROR: No se detectó página de Cartaportes"):
+			return Utils.message
 
+		EcuDriver.get ().click (xy[0], xy[1])
+		EcuWait.forStable (EcuLocator.regions.get (imagePath))
 		return xy
 
 	#-- Check if active webpage is the true working webpage
@@ -1503,13 +4455,12 @@ class Utils:
 		if Utils.checkError (title, "ERROR: No se detectó página de Cartaportes"):
 			return Utils.message
 
-	#-- Scroll down/up N times (30 pixels each scroll)
-	def scrollN (N, direction="down"):
+	#-- Scroll down/up N times (30 pixels each scroll) and wait for the region (None: full screen) to settle
+	def scrollN (N, direction="down", region=None):
 		sizeScroll = -10000 if direction=="down" else 10000
 		#EcuBot.printx (f"\tScrolling {sizeScroll} by {N} times...")
-		for i in range (N):
-			#EcuBot.printx (f"\t\tScrolling {i} : {30*i}")
-			py.scroll (sizeScroll)
+		EcuInput.scroll (sizeScroll, N)
+		EcuWait.forStable (region)
 
 	#-- Center field in window by scrolling down
 	def centerField (imageName):
@@ -1519,7 +4470,7 @@ class Utils:
 		if Utils.checkError (xy, f"ERROR: campo no localizado"):
 			return Utils.message
 
-		while xy.top > 0.7 * win.height:
+		while xy.top > 0.7 * EcuSession.get ().win.height:
 			EcuBot.printx ("\t\tScrolling down:", xy)
 			Utils.scrollN (2)
 			xy = Utils.getBox (imageName, confidence=0.8, grayscale=True)
@@ -1537,11 +4488,14 @@ class Utils:
 				win.left, win.top, win.width, win.height)
 		return (info)
 
+	#-- Similarity ratio (0 to 1) of two strings
+	def strCompare (str1, str2):
+		return difflib_SequenceMatcher (None, str1, str2).ratio ()
+
 	#-- Redefinition of 'locateOnScreen' with error checking
 	def getBox (imgName, region=None, confidence=0.7, grayscale=True):
 		try:
-			box = py.locateOnScreen (imgName, region=region,
-				confidence=confidence, grayscale=grayscale)
+			box = EcuLocator.locate (imgName, confidence=confidence, region=region)
 			return (box)
 		except Exception as ex:
 			EcuBot.printx (f"EXCEPTION: Función 'getBox' falló. ImgName: '{imgName}'. Region: '{region}'.")
@@ -1554,5 +4508,14 @@ class Utils:
 # Call main 
 #--------------------------------------------------------------------
 if __name__ == '__main__':
-	jsonFilepath = sys.argv [1]
-	mainBot (jsonFilepath)
+	multiprocessing_freeze_support ()
+	if sys.argv [1] == "--session":    # Bot process of a display session (EcuDisplaySession)
+		EcuDisplaySession.serve (sys.argv [2])
+	elif sys.argv [1] == "--fake":       # Headless fill: prints the actions and fields of the fake driver
+		driver = EcuDriver.set (EcuFakeDriver ())
+		mainBot (sys.argv [2])
+		EcuBot.printx ("\t>>> Driver fake:", driver.getStats ())
+		EcuBot.printx ("\t>>> Campos:", json.dumps (driver.getValues (), indent=4))
+	else:
+		jsonFilepath = sys.argv [1]
+		mainBot (jsonFilepath)
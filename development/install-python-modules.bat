@@ -1,5 +1,6 @@
 #pip install flask 
 pip install flask
+pip install waitress
 pip install azure-ai-formrecognizer
 pip install pyautogui
 pip install opencv-python
@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+"""
+Keystroke time of one cartaporte fill, before and after the input engine
+(EcuInput), with the fake driver (virtual clock, synthetic RESULTS file):
+
+  before: a pyautogui call per key, each one followed by PAUSE (0.1 secs)
+  after:  key runs in one call, INPUT_PAUSE and the INPUT_DELAYS by field type
+
+Run: python tests/bench_input.py [--pause secs] [--keyTime secs]
+"""
+import os, sys, io, json, argparse, tempfile, contextlib
+
+sys.path.insert (0, os.path.dirname (os.path.abspath (__file__)))
+from test_bot_fake import bot, getResults, getPaisesOptions
+
+#-- Fake driver of the old bot: each key pressed in its own call (a pause after each one)
+class PerKeyDriver (bot.EcuFakeDriver):
+	def press (self, key, presses=1, interval=0):
+		for i in range (presses):
+			super ().press (key, 1, interval)
+
+#-- Fill the RESULTS file (bot messages hidden) with the driver and the config settings.
+#-- Returns the table row: pyautogui calls, keys, fill secs and keystroke secs (EcuInput).
+def fill (jsonFilepath, driver, settings):
+	bot.EcuConfig.settings = settings
+	bot.EcuCombos.versions = {}
+	if os.path.exists (bot.EcuCombos.getFilename ()):
+		os.remove (bot.EcuCombos.getFilename ())
+	bot.EcuDriver.set (driver)
+	try:
+		with contextlib.redirect_stdout (io.StringIO ()):
+			result = bot.EcuBot.fillEcuapass (jsonFilepath)
+	finally:
+		bot.EcuDriver.set (None)
+	if not result.startswith ("Ingresado exitosamente"):
+		sys.exit (f"Fill failed: {result}")
+	stats = driver.getStats ()
+	return stats ["calls"], stats ["keys"], stats ["secs"], bot.EcuInput.getStats () ["time"]
+
+def main ():
+	parser = argparse.ArgumentParser (description=__doc__.strip ().splitlines () [0])
+	parser.add_argument ("--pause", type=float, default=0.1, help="pyautogui PAUSE of the old bot (secs)")
+	parser.add_argument ("--keyTime", type=float, default=0.0, help="secs taken by each key")
+	args = parser.parse_args ()
+
+	jsonFilepath = os.path.join (tempfile.mkdtemp (), "doc-RESULTS.json")
+	with open (jsonFilepath, "w") as fp:
+		json.dump (getResults (), fp)
+
+	noDelays = {x : 0 for x in bot.INPUT_DELAYS}
+	runs = [("before", PerKeyDriver, {"inputPause": args.pause, "inputDelays": noDelays}),
+	        ("after",  bot.EcuFakeDriver, {})]
+	rows = [(name, fill (jsonFilepath, driverClass (options=getPaisesOptions (), keyTime=args.keyTime), settings))
+	        for name, driverClass, settings in runs]
+
+	print (f"{'':8}{'calls':>8}{'keys':>8}{'fill secs':>12}{'input secs':>12}")
+	for name, (calls, keys, secs, inputSecs) in rows:
+		print (f"{name:8}{calls:>8}{keys:>8}{secs:>12.1f}{inputSecs:>12.1f}")
+
+if __name__ == "__main__":
+	main ()
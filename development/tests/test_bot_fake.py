@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+"""
+Headless fills of the cartaporte form with the fake driver (EcuFakeDriver):
+final form values and keys sent for a synthetic RESULTS file.
+"""
+import os, sys, json, tempfile
+import pytest
+
+for module in ["flask", "werkzeug", "azure.ai.formrecognizer", "PIL"]:
+	pytest.importorskip (module)
+
+os.environ ["PYECUAPASS"] = tempfile.mkdtemp (prefix="ecuapass-test-")    # Never the real data dir
+sys.path.insert (0, os.path.dirname (os.path.dirname (os.path.abspath (__file__))))
+import ecuapass_server_bot as bot
+
+PAISES    = ["COLOMBIA", "ECUADOR", "PERU"]
+OPTIONS   = {"01_Distrito": ["HUAQUILLAS", "TULCAN"], "68_TipoEmbalaje": ["CAJAS", "PALLETES"]}
+FILL_KEYS = 338     # Keys sent by a fill of the synthetic RESULTS file (empty combos cache)
+
+#-- Synthetic RESULTS: a value for each field of the form layout
+def getResults ():
+	results = {}
+	for field, widget, tab, scroll, section, dependsOn in bot.EcuPlan.LAYOUT:
+		if widget == "date":
+			results [field] = "15-03-2021"
+		elif widget == "boxIter":
+			results [field] = "TULCAN"
+		elif widget == "condTransporte":
+			results [field] = "DIRECTO SIN CAMBIO"
+		elif widget == "condPago":
+			results [field] = "CREDITO"
+		elif widget == "embalaje":
+			results [field] = "PALLETS"
+		elif "Pais" in field:
+			results [field] = "COLOMBIA"
+		else:
+			results [field] = f"VALOR {field [:2]}"
+	return results
+
+#-- Form values expected after filling the synthetic RESULTS
+def getExpectedValues (results):
+	values = dict (results)
+	for field, widget, tab, scroll, section, dependsOn in bot.EcuPlan.LAYOUT:
+		if widget == "date":
+			values [field] = results [field].replace ("-", "/")
+	values ["38_CondicionesTransporte"] = "DIRECTO, SIN CAMBIO DEL CAMION"
+	values ["39_CondicionesPago"]       = "POR COBRAR"
+	values ["68_TipoEmbalaje"]          = "PALLETES"
+	return values
+
+#-- Fill the RESULTS in a fake driver with the combo options. Returns the driver.
+def fill (tmp_path, results, options):
+	jsonFilepath = tmp_path / "doc-RESULTS.json"
+	jsonFilepath.write_text (json.dumps (results))
+	driver = bot.EcuDriver.set (bot.EcuFakeDriver (options=options))
+	try:
+		result = bot.EcuBot.fillEcuapass (str (jsonFilepath))
+	finally:
+		bot.EcuDriver.set (None)
+	assert result.startswith ("Ingresado exitosamente"), result
+	return driver
+
+#-- Each test starts with an empty combos cache
+@pytest.fixture (autouse=True)
+def emptyCombos ():
+	bot.EcuCombos.versions = {}
+	if os.path.exists (bot.EcuCombos.getFilename ()):
+		os.remove (bot.EcuCombos.getFilename ())
+
+def getPaisesOptions ():
+	options = {field : PAISES for field, *_ in bot.EcuPlan.LAYOUT if "Pais" in field}
+	return dict (options, **OPTIONS)
+
+def test_fill_synthetic_results (tmp_path):
+	results = getResults ()
+	driver  = fill (tmp_path, results, getPaisesOptions ())
+	assert driver.getValues () == getExpectedValues (results)
+	assert driver.getStats () ["keys"] == FILL_KEYS
+
+#-- An option equal to the field text is selected, not the next one
+def test_option_equal_to_text (tmp_path):
+	results = dict (getResults (), **{"10_PaisRemitente": "COLOMBIA"})
+	driver  = fill (tmp_path, results, dict (OPTIONS, **{"10_PaisRemitente": ["COLOMBIA", "ECUADOR"]}))
+	assert driver.getValues () ["10_PaisRemitente"] == "COLOMBIA"
+
+#-- A text without option is left as typed
+def test_option_not_found (tmp_path):
+	results = dict (getResults (), **{"10_PaisRemitente": "CHILE"})
+	driver  = fill (tmp_path, results, dict (OPTIONS, **{"10_PaisRemitente": PAISES}))
+	assert driver.getValues () ["10_PaisRemitente"] == "CHILE"
+
+#-- A wrong cached index goes back to the first option: the options above it are found
+@pytest.mark.parametrize ("fillFunction", ["fillBoxSimpleIteration", "fillCBoxFieldByIterating"])
+def test_combo_cache_changed (fillFunction):
+	bot.EcuCombos.addOptions ("01_Distrito", ["QUITO", "GUAYAQUIL", "HUAQUILLAS"])    # Cached index 2, now 0
+	driver = bot.EcuDriver.set (bot.EcuFakeDriver (options={"01_Distrito": ["HUAQUILLAS", "RUMICHACA", "TULCAN"]}))
+	try:
+		driver.focus = 0      # Tab index of '01_Distrito'
+		getattr (bot.EcuBot, fillFunction) ({"01_Distrito": "HUAQUILLAS"}, "01_Distrito")
+	finally:
+		bot.EcuDriver.set (None)
+	assert driver.getValues () ["01_Distrito"] == "HUAQUILLAS"
+	assert bot.EcuCombos.getIndex ("01_Distrito", "HUAQUILLAS") == 0
+
+#-- Options with failed reads (empty texts) are not learned
+def test_combo_empty_texts ():
+	bot.EcuCombos.addOptions ("01_Distrito", ["HUAQUILLAS", "", "TULCAN"])
+	assert bot.EcuCombos.getIndex ("01_Distrito", "TULCAN") is None
+
+#-- Once the field regions are found (screen verification) waits poll them, not the full screen
+def test_wait_regions (tmp_path, monkeypatch):
+	monkeypatch.setattr (bot.EcuConfig, "settings", {"botVerify": "screen"})
+	monkeypatch.setattr (bot.EcuVerify, "regions", {})
+	snaps, snap = [], bot.EcuWait.snap
+	monkeypatch.setattr (bot.EcuWait, "snap", lambda region=None: snaps.append (region) or snap (region))
+	results = getResults ()
+	fill (tmp_path, results, getPaisesOptions ())
+	snaps.clear ()
+	driver = fill (tmp_path, results, getPaisesOptions ())
+	assert driver.getValues () == getExpectedValues (results)
+	assert 0 < snaps.count (None) < len (snaps) / 4     # Sections without combos (no region found)
+
+#-- Fill failing at '38_CondicionesTransporte' and resumed after the fix of its value. The
+#-- page title leaves the focus 'titleTabs' before the first field ('configTabs' in the bot)
+def resume (tmp_path, monkeypatch, titleTabs, configTabs):
+	monkeypatch.setattr (bot.EcuConfig, "settings", {"botTitleTabs": configTabs})
+	results      = getResults ()
+	jsonFilepath = tmp_path / "doc-RESULTS.json"
+	jsonFilepath.write_text (json.dumps (dict (results, **{"38_CondicionesTransporte": "DESCONOCIDAS"})))
+	driver = bot.EcuDriver.set (bot.EcuFakeDriver (options=getPaisesOptions (), startTabs={"CartaporteCarretera": titleTabs}))
+	try:
+		result = bot.EcuBot.fillEcuapass (str (jsonFilepath))
+		assert "desconocidas" in result
+		assert bot.EcuCheckpoints.get (str (jsonFilepath)) ["field"] == "37_FechaEntrega"
+		jsonFilepath.write_text (json.dumps (results))
+		nKeys  = driver.getStats () ["keys"]
+		result = bot.EcuBot.fillEcuapass (str (jsonFilepath), resume=True)
+	finally:
+		bot.EcuDriver.set (None)
+	assert result.startswith ("Ingresado exitosamente"), result
+	return driver, results, driver.getStats () ["keys"] - nKeys
+
+@pytest.mark.parametrize ("titleTabs", [1, 3])
+def test_resume_focus (tmp_path, monkeypatch, titleTabs):
+	driver, results, nKeys = resume (tmp_path, monkeypatch, titleTabs, titleTabs)
+	assert driver.getValues () == getExpectedValues (results)
+	assert nKeys < FILL_KEYS * 2 / 3     # The fields before the checkpoint are not filled again
+
+#-- Resumed with the focus one Tab away from the expected one the fields are shifted
+def test_resume_focus_wrong (tmp_path, monkeypatch):
+	driver, results, nKeys = resume (tmp_path, monkeypatch, 3, 2)
+	assert driver.getValues () != getExpectedValues (results)
+
+#-- Screen verification (field region hash) takes the same decisions as the clipboard one with
+#-- the combo lists open below the fields: options found (other text) and not found ('CHILE')
+def test_verify_screen_clipboard (tmp_path, monkeypatch):
+	monkeypatch.setattr (bot.EcuVerify, "regions", {})
+	options = dict (OPTIONS, **{field : [x + " - " + x [:2] for x in PAISES] for field in getPaisesOptions () if "Pais" in field})
+	results = dict (getResults (), **{"10_PaisRemitente": "CHILE"})
+	filled  = {}
+	for verify in ["clipboard", "screen"]:
+		monkeypatch.setattr (bot.EcuConfig, "settings", {"botVerify": verify})
+		driver = fill (tmp_path, results, options)
+		filled [verify] = (driver.getValues (), bot.EcuInput.getStats ())
+
+	values, stats = filled ["screen"]
+	assert values ["21_PaisConsignatario"] == "COLOMBIA - CO" and values ["10_PaisRemitente"] == "CHILE"
+	assert values == filled ["clipboard"][0]
+	assert stats ["retries"] == filled ["clipboard"][1]["retries"]     # Options not found
+	assert stats ["clipboard"] < filled ["clipboard"][1]["clipboard"] and stats ["keys"] < filled ["clipboard"][1]["keys"]
+	assert max (x [3] for x in bot.EcuVerify.regions.values ()) < 24    # A form row (12 pixels), not its list
@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+"""
+Documents pipeline (EcuPipeline) with analysis stages that don't call Azure:
+the bot fills the RESULTS files in document order and a failed fill doesn't
+stop the series or the stages before the bot. Documents over the monthly
+Azure budget are deferred.
+"""
+import os, sys, time, tempfile, threading
+import pytest
+
+for module in ["flask", "werkzeug", "azure.ai.formrecognizer", "PIL"]:
+	pytest.importorskip (module)
+
+os.environ ["PYECUAPASS"] = tempfile.mkdtemp (prefix="ecuapass-test-")    # Never the real data dir
+sys.path.insert (0, os.path.dirname (os.path.dirname (os.path.abspath (__file__))))
+import ecuapass_server_bot as bot
+
+N_DOCS    = 12    # More documents than the bot queue and write stage hold
+BOT_QUEUE = 2
+UPLOAD    = bot.EcuDocStages.upload    # Replaced in the stages without Azure
+
+#-- Stages without Azure: the RESULTS file of each document is written by the 'write' stage
+@pytest.fixture
+def docsDir (tmp_path, monkeypatch):
+	for name in ["preflight", "lookupCache", "upload", "addNewlines"]:
+		monkeypatch.setattr (bot.EcuDocStages, name, lambda item: item)
+	monkeypatch.setattr (bot.EcuDocStages, "extractFields", lambda item: dict (item, fields={}))
+	monkeypatch.setattr (bot.EcuConfig, "settings", {"pipelineBotQueue": BOT_QUEUE})
+	for i in range (N_DOCS):
+		(tmp_path / f"doc-{i:02d}.png").write_bytes (b"PNG")
+	return tmp_path
+
+#-- Worker threads of the pipeline stages still running (after 'secs')
+def getStageWorkers (secs=5):
+	endTime = time.monotonic () + secs
+	while time.monotonic () < endTime:
+		workers = [x for x in threading.enumerate () if x.name.endswith ("(worker)")]
+		if not workers:
+			break
+		time.sleep (0.05)
+	return workers
+
+#-- A fill raising (e.g. a sqlite error in the ledger) is the result of its document only
+def test_bot_raises_mid_series (docsDir, monkeypatch):
+	filled = []
+	def fill (jsonFilepath):
+		filled.append (jsonFilepath)
+		if len (filled) == 3:
+			raise bot.sqlite3_Error ("database is locked")
+		return f"Ingresado exitosamente: {jsonFilepath}"
+	monkeypatch.setattr (bot.EcuBotQueue, "run", fill)
+
+	results = {}
+	thread  = threading.Thread (target=lambda: results.update (bot.EcuPipeline.run (str (docsDir))), daemon=True)
+	thread.start ()
+	thread.join (30)
+	assert not thread.is_alive (), "pipeline blocked"
+
+	assert results ["documents"] == N_DOCS
+	assert len (results ["botResults"]) == N_DOCS
+	assert results ["botResults"][2].startswith ("ERROR") and "database is locked" in results ["botResults"][2]
+	assert all (x.startswith ("Ingresado") for i, x in enumerate (results ["botResults"]) if i != 2)
+	assert len (filled) == N_DOCS
+	assert getStageWorkers () == []
+
+#-- Run the pipeline (the bot fills are only recorded) and return its result
+def runPipeline (docsDir, monkeypatch):
+	monkeypatch.setattr (bot.EcuBotQueue, "run", lambda jsonFilepath: f"Ingresado exitosamente: {jsonFilepath}")
+	return bot.EcuPipeline.run (str (docsDir))
+
+#-- Monthly budget of 'budget' pages with none used
+@pytest.fixture
+def quota (monkeypatch):
+	monkeypatch.setattr (bot.EcuQuota, "month", None)
+	monkeypatch.setattr (bot.EcuQuota, "reserved", 0)
+	def setBudget (budget):
+		bot.EcuConfig.settings ["azureMonthlyPages"] = budget
+	return setBudget
+
+#-- Pages are reserved once for the whole job, cached documents (no pages) first
+def test_quota_reserved_by_job (docsDir, quota, monkeypatch):
+	quota (4)
+	(docsDir / "doc-07-azure-CACHE.pkl").write_bytes (b"")
+	results = runPipeline (docsDir, monkeypatch)
+
+	assert results ["documents"] == N_DOCS
+	assert len (results ["deferred"]) == N_DOCS - 5
+	assert str (docsDir / "doc-07.png") not in results ["deferred"]
+	assert results ["botResults"][0].endswith ("doc-07-RESULTS.json")
+	assert bot.EcuQuota.reserved == 0      # Reserved pages not analyzed are released
+
+#-- A document over the budget when it is uploaded is deferred, not an error
+def test_quota_error_deferred (docsDir, quota, monkeypatch):
+	def analyzeResult (docFilepath, nReserved=0):
+		bot.EcuQuota.release (nReserved)    # Not committed: no pages analyzed
+		if docFilepath.endswith ("doc-03.png"):
+			raise bot.EcuQuotaError ("Cuota mensual de páginas de Azure agotada")
+		return "RESULT"
+	monkeypatch.setattr (bot.EcuDocStages, "upload", UPLOAD)
+	monkeypatch.setattr (bot.EcuDocStages, "lookupCache", lambda item: dict (item, docKey=item ["path"]))
+	monkeypatch.setattr (bot.EcuAzure, "analyzeResult", analyzeResult)
+	quota (0)
+	results = runPipeline (docsDir, monkeypatch)
+
+	assert results ["deferred"] == [str (docsDir / "doc-03.png")]
+	assert results ["error"] == {}
+	assert bot.EcuQuota.reserved == 0
@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+"""
+Bot sessions on X displays: the ECUAPASS window found and maximized with
+xdotool (a scripted X server) and queued RESULTS files dispatched to two
+display sessions (bot processes with the fake driver).
+"""
+import os, sys, re, json, tempfile, threading, collections
+import pytest
+
+for module in ["flask", "werkzeug", "azure.ai.formrecognizer", "PIL"]:
+	pytest.importorskip (module)
+
+os.environ ["PYECUAPASS"] = tempfile.mkdtemp (prefix="ecuapass-test-")    # Never the real data dir
+sys.path.insert (0, os.path.dirname (os.path.dirname (os.path.abspath (__file__))))
+import ecuapass_server_bot as bot
+from test_bot_fake import getResults, getExpectedValues, getPaisesOptions
+
+TITLE = "ECUAPASS - SENAE browser"
+
+#-- X display answering the xdotool commands used by EcuX11Window
+class FakeXServer:
+	def __init__ (self, windows, size=(1920, 1080)):
+		self.windows  = windows      # Id : {"name", "x", "y", "width", "height"}
+		self.size     = size
+		self.active   = None
+		self.commands = []
+
+	def xdotool (self, *args):
+		args = [str (x) for x in args]
+		self.commands.append (args)
+		command, args = args [0], [x for x in args [1:] if not x.startswith ("--")]
+		if command == "search":
+			return "\n".join (x for x, win in self.windows.items () if re.search (args [0], win ["name"]))
+		if command == "getdisplaygeometry":
+			return "%s %s" % self.size
+		if command == "getactivewindow":
+			return self.active or ""
+		win = self.windows [args [0]]
+		if command == "getwindowname":
+			return win ["name"]
+		if command == "getwindowgeometry":
+			return f"WINDOW={args [0]}\nX={win ['x']}\nY={win ['y']}\nWIDTH={win ['width']}\nHEIGHT={win ['height']}"
+		if command == "windowactivate":
+			self.active = args [0]
+		elif command == "windowmove":
+			win ["x"], win ["y"] = int (args [1]), int (args [2])
+		elif command == "windowsize":
+			width, height = [self.size [i] if x.endswith ("%") else int (x) for i, x in enumerate (args [1:3])]
+			win ["width"], win ["height"] = width, height
+		return ""
+
+#-- Fake driver of an X display: windows found with xdotool
+class X11FakeDriver (bot.EcuFakeDriver):
+	def getWindows (self, title=None):
+		return bot.EcuX11Window.getWindows (title)
+
+#-- The window with the exact title (not the one containing it) is activated and maximized
+def test_x11_window (tmp_path, monkeypatch):
+	server = FakeXServer ({"71": {"name": TITLE + " (2)", "x": 0, "y": 0, "width": 1920, "height": 1080},
+	                       "72": {"name": TITLE, "x": 200, "y": 100, "width": 800, "height": 600},
+	                       "73": {"name": "Terminal", "x": 0, "y": 0, "width": 400, "height": 300}})
+	monkeypatch.setattr (bot.EcuX11Window, "xdotool", server.xdotool)
+
+	windows = bot.EcuX11Window.getWindows (TITLE)
+	assert sorted (x.winId for x in windows) == ["71", "72"]
+	win = next (x for x in windows if x.title == TITLE)
+	assert (win.left, win.top, win.width, win.height) == (200, 100, 800, 600)
+	assert not win.isMaximized and not win.isActive
+
+	results      = getResults ()
+	jsonFilepath = tmp_path / "doc-RESULTS.json"
+	jsonFilepath.write_text (json.dumps (results))
+	driver = X11FakeDriver (options=getPaisesOptions ())
+	result = bot.EcuSession (driver, ":1").fill (str (jsonFilepath))
+	assert result.startswith ("Ingresado exitosamente"), result
+	assert driver.getValues () == getExpectedValues (results)
+	assert server.active == "72"
+	assert server.windows ["72"] == dict (name=TITLE, x=0, y=0, width=1920, height=1080)
+	assert server.windows ["71"]["width"] == 1920 and server.windows ["71"]["x"] == 0    # Untouched
+
+#-- A display without xdotool has no windows (the fill reports it)
+def test_x11_no_xdotool (monkeypatch):
+	def xdotool (*args):
+		raise FileNotFoundError ("xdotool")
+	monkeypatch.setattr (bot.EcuX11Window, "xdotool", xdotool)
+	assert bot.EcuX11Window.getWindows (TITLE) == []
+
+#-- Queue state of its own (workers of the sessions of other tests wait on their condition)
+@pytest.fixture
+def botQueue (monkeypatch):
+	for name, value in [("cond", threading.Condition ()), ("pending", []), ("running", []), ("sessions", []),
+	                    ("history", collections.deque (maxlen=100)), ("fillTimes", collections.deque (maxlen=20))]:
+		monkeypatch.setattr (bot.EcuBotQueue, name, value)
+	yield bot.EcuBotQueue
+	for session in bot.EcuBotQueue.sessions:
+		if session.process:
+			session.process.stdin.close ()
+			session.process.wait (30)
+
+#-- Files queued are filled by the two display sessions, each one in its own process
+def test_display_sessions (tmp_path, monkeypatch, botQueue):
+	monkeypatch.setattr (bot.EcuConfig, "settings", {"botDisplays": ["fake1", "fake2"]})
+	files = []
+	for i in range (4):
+		files.append (tmp_path / f"doc-{i}-RESULTS.json")
+		files [-1].write_text (json.dumps (dict (getResults (), **{"02_NumeroCPIC": f"CO{i:04d}"})))
+
+	jobs = botQueue.enqueue ([str (x) for x in files], validate=False)    # Synthetic values
+	for job in jobs:
+		assert job ["event"].wait (120), "session without result"
+	assert [x.name for x in botQueue.sessions] == ["fake1", "fake2"]
+	assert all (job ["status"] == "done" and job ["result"].startswith ("Ingresado exitosamente") for job in jobs), \
+	       [job ["result"] for job in jobs]
+	assert {job ["session"] for job in jobs} == {"fake1", "fake2"}
+	assert all (job ["input"]["keys"] > 0 for job in jobs)
+
+	pids = [x.getInfo () ["pid"] for x in botQueue.sessions]
+	assert None not in pids and pids [0] != pids [1] != os.getpid ()
+	assert [x.getInfo () ["docs"] for x in botQueue.sessions] == [
+	       sum (job ["session"] == x.name for job in jobs) for x in botQueue.sessions]